@@ -1,407 +1,4428 @@
-import ccxt
 import asyncio
-from web3 import Web3
-from web3.middleware import geth_poa_middleware
+import contextvars
+from ccxt.base.exchange import Exchange
+from eth_hash.auto import keccak
+from hexbytes import HexBytes
 from decimal import Decimal
 import json
+import math
 from typing import Dict, List, Optional, Any
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from functools import lru_cache, wraps
+import importlib.util
+import os
+import sqlite3
+import sys
+import threading
 import time
+import weakref
 
-class DEXExchange(ccxt.Exchange):
+
+def lazy_import(name: str) -> Any:
+    """Module that only runs on first attribute access, or None if it is not installed"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return None
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# NumPy is optional, only used for array outputs, and loaded on first use
+np = lazy_import('numpy')
+
+# web3 and eth_account take most of the import time, so they load on first use:
+# the first provider, transaction or checksum. ccxt is imported up front because
+# DEXExchange subclasses its Exchange.
+web3 = lazy_import('web3')
+eth_abi = lazy_import('eth_abi')
+eth_account = lazy_import('eth_account')
+eth_utils = lazy_import('eth_utils')
+
+# BatchHTTPProvider, RPCPool and InstrumentedProvider subclass web3's providers
+providers = lazy_import('providers')
+PROVIDER_CLASSES = ('BatchHTTPProvider', 'RPCPool', 'InstrumentedProvider')
+
+
+def __getattr__(name: str) -> Any:
+    # `from app import RPCPool` still works, loading providers.py on first access
+    if name in PROVIDER_CLASSES:
+        return getattr(providers, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Common DEX contract addresses
+DEX_CONTRACTS = {
+    'uniswap_v2_router': '0x7a250d5630B4cF539739dF2C5dAcb4c659F2488D',
+    'uniswap_v3_router': '0xE592427A0AEce92De3Edee1F18E0157C05861564',
+    'sushiswap_router': '0xd9e1cE17f2641f24aE83637ab66a2cca9C378B9F',
+    'pancakeswap_router': '0x10ED43C718714eb63d5aA57B78B54704E256024E',  # BSC
+}
+
+# ERC20 ABI
+ERC20_ABI = (
+    {
+        "constant": True,
+        "inputs": [{"name": "_owner", "type": "address"}],
+        "name": "balanceOf",
+        "outputs": [{"name": "balance", "type": "uint256"}],
+        "type": "function"
+    },
+    {
+        "constant": True,
+        "inputs": [
+            {"name": "_owner", "type": "address"},
+            {"name": "_spender", "type": "address"}
+        ],
+        "name": "allowance",
+        "outputs": [{"name": "", "type": "uint256"}],
+        "type": "function"
+    },
+    {
+        "constant": False,
+        "inputs": [
+            {"name": "_spender", "type": "address"},
+            {"name": "_value", "type": "uint256"}
+        ],
+        "name": "approve",
+        "outputs": [{"name": "", "type": "bool"}],
+        "type": "function"
+    },
+    {
+        "constant": True,
+        "inputs": [],
+        "name": "decimals",
+        "outputs": [{"name": "", "type": "uint8"}],
+        "type": "function"
+    },
+    {
+        "constant": True,
+        "inputs": [],
+        "name": "symbol",
+        "outputs": [{"name": "", "type": "string"}],
+        "type": "function"
+    },
+    {
+        "constant": True,
+        "inputs": [],
+        "name": "name",
+        "outputs": [{"name": "", "type": "string"}],
+        "type": "function"
+    }
+)
+
+# Uniswap V2 Router ABI (simplified)
+ROUTER_ABI = (
+    {
+        "constant": True,
+        "inputs": [],
+        "name": "factory",
+        "outputs": [{"name": "", "type": "address"}],
+        "type": "function"
+    },
+    {
+        "constant": True,
+        "inputs": [
+            {"name": "amountIn", "type": "uint256"},
+            {"name": "path", "type": "address[]"}
+        ],
+        "name": "getAmountsOut",
+        "outputs": [{"name": "amounts", "type": "uint256[]"}],
+        "type": "function"
+    },
+    {
+        "constant": False,
+        "inputs": [
+            {"name": "amountIn", "type": "uint256"},
+            {"name": "amountOutMin", "type": "uint256"},
+            {"name": "path", "type": "address[]"},
+            {"name": "to", "type": "address"},
+            {"name": "deadline", "type": "uint256"}
+        ],
+        "name": "swapExactTokensForTokens",
+        "outputs": [{"name": "amounts", "type": "uint256[]"}],
+        "type": "function"
+    },
+    {
+        "constant": False,
+        "inputs": [
+            {"name": "amountOut", "type": "uint256"},
+            {"name": "amountInMax", "type": "uint256"},
+            {"name": "path", "type": "address[]"},
+            {"name": "to", "type": "address"},
+            {"name": "deadline", "type": "uint256"}
+        ],
+        "name": "swapTokensForExactTokens",
+        "outputs": [{"name": "amounts", "type": "uint256[]"}],
+        "type": "function"
+    },
+    {
+        "constant": False,
+        "inputs": [
+            {"name": "tokenA", "type": "address"},
+            {"name": "tokenB", "type": "address"},
+            {"name": "amountADesired", "type": "uint256"},
+            {"name": "amountBDesired", "type": "uint256"},
+            {"name": "amountAMin", "type": "uint256"},
+            {"name": "amountBMin", "type": "uint256"},
+            {"name": "to", "type": "address"},
+            {"name": "deadline", "type": "uint256"}
+        ],
+        "name": "addLiquidity",
+        "outputs": [
+            {"name": "amountA", "type": "uint256"},
+            {"name": "amountB", "type": "uint256"},
+            {"name": "liquidity", "type": "uint256"}
+        ],
+        "type": "function"
+    }
+)
+
+# Uniswap V2 Factory ABI (simplified)
+FACTORY_ABI = (
+    {
+        "constant": True,
+        "inputs": [
+            {"name": "tokenA", "type": "address"},
+            {"name": "tokenB", "type": "address"}
+        ],
+        "name": "getPair",
+        "outputs": [{"name": "pair", "type": "address"}],
+        "type": "function"
+    },
+    {
+        "constant": True,
+        "inputs": [],
+        "name": "allPairsLength",
+        "outputs": [{"name": "", "type": "uint256"}],
+        "type": "function"
+    },
+    {
+        "constant": True,
+        "inputs": [{"name": "", "type": "uint256"}],
+        "name": "allPairs",
+        "outputs": [{"name": "pair", "type": "address"}],
+        "type": "function"
+    }
+)
+
+# Uniswap V2 Pair ABI (simplified)
+PAIR_ABI = (
+    {
+        "constant": True,
+        "inputs": [],
+        "name": "getReserves",
+        "outputs": [
+            {"name": "reserve0", "type": "uint112"},
+            {"name": "reserve1", "type": "uint112"},
+            {"name": "blockTimestampLast", "type": "uint32"}
+        ],
+        "type": "function"
+    },
+    {
+        "constant": True,
+        "inputs": [],
+        "name": "token0",
+        "outputs": [{"name": "", "type": "address"}],
+        "type": "function"
+    },
+    {
+        "constant": True,
+        "inputs": [],
+        "name": "token1",
+        "outputs": [{"name": "", "type": "address"}],
+        "type": "function"
+    },
+    {
+        "constant": True,
+        "inputs": [],
+        "name": "totalSupply",
+        "outputs": [{"name": "", "type": "uint256"}],
+        "type": "function"
+    },
+    {
+        "constant": True,
+        "inputs": [{"name": "_owner", "type": "address"}],
+        "name": "balanceOf",
+        "outputs": [{"name": "balance", "type": "uint256"}],
+        "type": "function"
+    }
+)
+
+# Routers with Uniswap V2-style constant-product pools, and their swap fee in basis points
+V2_ROUTER_FEES = {
+    'uniswap_v2_router': 30,
+    'sushiswap_router': 30,
+    'pancakeswap_router': 25,
+    'quickswap_router': 30,
+}
+
+# Preferred quote currencies for market symbols, highest priority first
+QUOTE_CURRENCIES = ('USDC', 'USDT', 'DAI', 'WETH', 'WBTC')
+
+# Bump when the markets snapshot file layout changes
+MARKETS_SNAPSHOT_VERSION = 1
+
+# Common token addresses (mainnet)
+COMMON_TOKENS = {
+    'USDC': '0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48',  # Correct USDC
+    'USDT': '0xdAC17F958D2ee523a2206206994597C13D831ec7',
+    'WBTC': '0x2260FAC5E5542a773Aa44fBCfeDf7C193bc2C599',
+    'WETH': '0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2',
+    'DAI': '0x6B175474E89094C44Da98b954EedeAC495271d0F',
+}
+
+# Per-chain defaults for DEXExchange({'chain': name}): chain id, PoA middleware, routers and tokens
+CHAIN_PRESETS = {
+    'ethereum': {
+        'chainId': 1,
+        'poa': False,
+        'routers': {
+            'uniswap_v2_router': '0x7a250d5630B4cF539739dF2C5dAcb4c659F2488D',
+            'uniswap_v3_router': '0xE592427A0AEce92De3Edee1F18E0157C05861564',
+            'sushiswap_router': '0xd9e1cE17f2641f24aE83637ab66a2cca9C378B9F',
+        },
+        'tokens': dict(COMMON_TOKENS),
+    },
+    'bsc': {
+        'chainId': 56,
+        'poa': True,
+        'routers': {
+            'pancakeswap_router': '0x10ED43C718714eb63d5aA57B78B54704E256024E',
+        },
+        'tokens': {
+            'USDC': '0x8AC76A51CC8a8d4B9ee6aDC0F9c53Ad9a48B5f3C',
+            'USDT': '0x55d398326f99059fF775485246999027B3197955',
+            'BUSD': '0xe9e7CEA3DedcA5984780Bafc599bD69ADd087D56',
+            'WBNB': '0xbb4CdB9CBd36B01bD1cBaEBF2De08d9173bc095c',
+            'WETH': '0x2170Ed0880ac9A755fd29B2688956BD959F933F8',
+            'BTCB': '0x7130d2A12B9BCbFAe4f2634d864A1Ee1Ce3Ead9c',
+        },
+    },
+    'polygon': {
+        'chainId': 137,
+        'poa': True,
+        'routers': {
+            'quickswap_router': '0xa5E0829CaCEd8fFDD4De3c43696c57F7D7A678ff',
+            'sushiswap_router': '0x1b02dA8Cb0d097eB8D57A175b88c7D8b47997506',
+        },
+        'tokens': {
+            'USDC': '0x2791Bca1f2de4661ED88A30C99A7a9449Aa84174',
+            'USDT': '0xc2132D05D31c914a87C6611C10748AEb04B58e8F',
+            'DAI': '0x8f3Cf7ad23Cd3CaDbD9735AFf958023239c6A063',
+            'WMATIC': '0x0d500B1d8E8eF31E21C99d1Db9A6444d3ADf1270',
+            'WETH': '0x7ceB23fD6bC0adD59E62ac25578270cFf1b9f619',
+            'WBTC': '0x1BFD67037B42Cf73acF2047067bd4F2C47D9BfD6',
+        },
+    },
+    'arbitrum': {
+        'chainId': 42161,
+        'poa': False,
+        'routers': {
+            'sushiswap_router': '0x1b02dA8Cb0d097eB8D57A175b88c7D8b47997506',
+        },
+        'tokens': {
+            'USDC': '0xaf88d065e77c8cC2239327C5EDb3A432268e5831',
+            'USDT': '0xFd086bC7CD5C481DCC9C85ebE478A1C0b69FCbb9',
+            'DAI': '0xDA10009cBd5D07dd0CeCc66161FC93D7c9000da1',
+            'WETH': '0x82aF49447D8a07e3bd95BD0d56f35241523fBab1',
+            'WBTC': '0x2f2a2543B76A4166549F7aaB2e75Bef0aefC5B0f',
+        },
+    },
+}
+
+# Multicall3 is deployed at the same address on most EVM chains
+MULTICALL3_ADDRESS = '0xcA11bde05977b3631167028862bE2a173976CA11'
+
+MULTICALL3_ABI = (
+    {
+        "inputs": [
+            {
+                "components": [
+                    {"name": "target", "type": "address"},
+                    {"name": "allowFailure", "type": "bool"},
+                    {"name": "callData", "type": "bytes"}
+                ],
+                "name": "calls",
+                "type": "tuple[]"
+            }
+        ],
+        "name": "aggregate3",
+        "outputs": [
+            {
+                "components": [
+                    {"name": "success", "type": "bool"},
+                    {"name": "returnData", "type": "bytes"}
+                ],
+                "name": "returnData",
+                "type": "tuple[]"
+            }
+        ],
+        "stateMutability": "payable",
+        "type": "function"
+    },
+)
+
+
+# Allowances at or above this are reported as unlimited (close to max uint256)
+UNLIMITED_ALLOWANCE_THRESHOLD = (2**256 - 1) // 2
+
+
+def function_selector(signature: str) -> bytes:
+    """First four bytes of keccak(signature), e.g. 'balanceOf(address)'"""
+    return keccak(signature.encode())[:4]
+
+
+# Selectors for the calls encoded by hand below, computed once at import
+BALANCE_OF_SELECTOR = function_selector('balanceOf(address)')
+ALLOWANCE_SELECTOR = function_selector('allowance(address,address)')
+DECIMALS_SELECTOR = function_selector('decimals()')
+SYMBOL_SELECTOR = function_selector('symbol()')
+NAME_SELECTOR = function_selector('name()')
+TOTAL_SUPPLY_SELECTOR = function_selector('totalSupply()')
+FACTORY_SELECTOR = function_selector('factory()')
+GET_PAIR_SELECTOR = function_selector('getPair(address,address)')
+ALL_PAIRS_LENGTH_SELECTOR = function_selector('allPairsLength()')
+ALL_PAIRS_SELECTOR = function_selector('allPairs(uint256)')
+TOKEN0_SELECTOR = function_selector('token0()')
+TOKEN1_SELECTOR = function_selector('token1()')
+GET_RESERVES_SELECTOR = function_selector('getReserves()')
+GET_BLOCK_NUMBER_SELECTOR = function_selector('getBlockNumber()')
+AGGREGATE3_SELECTOR = function_selector('aggregate3((address,bool,bytes)[])')
+ADD_LIQUIDITY_SELECTOR = function_selector(
+    'addLiquidity(address,address,uint256,uint256,uint256,uint256,address,uint256)'
+)
+
+
+def abi_signature(entry: Dict[str, Any]) -> str:
+    """Canonical signature of an ABI function entry, e.g. 'allowance(address,address)'"""
+    def canonical(param):
+        if param['type'].startswith('tuple'):
+            return '(' + ','.join(canonical(component) for component in param['components']) + ')' + param['type'][5:]
+        return param['type']
+    return f"{entry['name']}({','.join(canonical(param) for param in entry['inputs'])})"
+
+
+# Function names by selector, for labelling contract calls in RPC metrics
+FUNCTION_NAMES = {
+    function_selector(abi_signature(entry)): entry['name']
+    for abi in (ERC20_ABI, ROUTER_ABI, FACTORY_ABI, PAIR_ABI, MULTICALL3_ABI)
+    for entry in abi if entry.get('type') == 'function'
+}
+FUNCTION_NAMES[GET_BLOCK_NUMBER_SELECTOR] = 'getBlockNumber'
+
+
+@lru_cache(maxsize=65536)
+def checksum(address: str) -> str:
+    """Checksummed form of an address, cached"""
+    return eth_utils.to_checksum_address(address)
+
+
+def encode_address(address: str) -> bytes:
+    """ABI word for an address: twelve zero bytes and the 20 address bytes"""
+    if len(address) != 42 or not address.startswith(('0x', '0X')):
+        raise ValueError(f"Invalid address: {address}")
+    return b'\x00' * 12 + bytes.fromhex(address[2:])
+
+
+def encode_call(selector: bytes, *args: Any) -> bytes:
+    """Calldata for a function taking only address (str) and uint256 (int) arguments.
+    
+    Plain byte concatenation, skipping web3's ABI lookup and validation.
+    """
+    words = [encode_address(arg) if isinstance(arg, str) else arg.to_bytes(32, 'big') for arg in args]
+    return selector + b''.join(words)
+
+
+def encode_balance_of(owner: str) -> bytes:
+    """balanceOf(owner) calldata"""
+    return BALANCE_OF_SELECTOR + encode_address(owner)
+
+
+def encode_allowance(owner: str, spender: str) -> bytes:
+    """allowance(owner, spender) calldata"""
+    return ALLOWANCE_SELECTOR + encode_address(owner) + encode_address(spender)
+
+
+def encode_aggregate3(calls: List[tuple]) -> bytes:
+    """aggregate3 calldata for (target, calldata) calls, each allowed to fail on its own"""
+    heads = []
+    tails = []
+    offset = 32 * len(calls)
+    for target, data in calls:
+        data = bytes(HexBytes(data))
+        tail = b''.join([
+            encode_address(target),
+            (1).to_bytes(32, 'big'),
+            (96).to_bytes(32, 'big'),
+            len(data).to_bytes(32, 'big'),
+            data + b'\x00' * (-len(data) % 32)
+        ])
+        heads.append(offset.to_bytes(32, 'big'))
+        tails.append(tail)
+        offset += len(tail)
+    return AGGREGATE3_SELECTOR + (32).to_bytes(32, 'big') + len(calls).to_bytes(32, 'big') + b''.join(heads + tails)
+
+
+def decode_aggregate3(data: bytes) -> List[tuple]:
+    """Decode aggregate3's (bool success, bytes returnData)[] result"""
+    def word(position: int) -> int:
+        if position + 32 > len(data):
+            raise ValueError("Truncated aggregate3 result")
+        return int.from_bytes(data[position:position + 32], 'big')
+    
+    start = word(0)
+    base = start + 32
+    results = []
+    for i in range(word(start)):
+        position = base + word(base + 32 * i)
+        offset = position + word(position + 32)
+        length = word(offset)
+        if offset + 32 + length > len(data):
+            raise ValueError("Truncated aggregate3 result")
+        results.append((word(position) != 0, data[offset + 32:offset + 32 + length]))
+    return results
+
+
+def decode_uint(data: bytes) -> int:
+    """Decode a uint return value"""
+    if len(data) < 32:
+        raise ValueError("Empty return data")
+    return int.from_bytes(data[:32], 'big')
+
+
+def decode_string(data: bytes) -> str:
+    """Decode a string return value, accepting legacy bytes32 tokens (e.g. MKR)"""
+    if not data:
+        raise ValueError("Empty return data")
+    if len(data) == 32:
+        return data.rstrip(b'\x00').decode('utf-8', errors='replace')
+    return eth_abi.decode(['string'], data)[0]
+
+
+def parse_metadata(token_addresses: List[str], results: List[tuple]) -> Dict[str, Any]:
+    """Decode decimals/symbol/name call results (three per token).
+    
+    Tokens whose calls fail map to the exception instead of metadata.
+    """
+    metadata = {}
+    
+    for i, token_address in enumerate(token_addresses):
+        (ok_decimals, raw_decimals), (ok_symbol, raw_symbol), (ok_name, raw_name) = results[i * 3:i * 3 + 3]
+        try:
+            if not (ok_decimals and ok_symbol and ok_name):
+                raise Exception("metadata call reverted")
+            metadata[token_address] = {
+                'symbol': decode_string(raw_symbol),
+                'name': decode_string(raw_name),
+                'decimals': decode_uint(raw_decimals)
+            }
+        except Exception as e:
+            metadata[token_address] = e
+    
+    return metadata
+
+
+class Amount:
+    """Exact token amount: a raw integer plus token decimals, formatted only when needed.
+    
+    Compares, hashes and formats like the number it represents, so it can
+    stand in for the float amounts used before. Arithmetic with another
+    Amount or an int stays exact; float(amount) and arithmetic with floats
+    give floats.
+    """
+    
+    __slots__ = ('raw', 'decimals')
+    
+    def __init__(self, raw: int, decimals: int):
+        self.raw = int(raw)
+        self.decimals = int(decimals)
+    
+    @classmethod
+    def from_value(cls, value: Any, decimals: int) -> 'Amount':
+        """Amount from a human-readable value (int, str, Decimal, float or Amount)"""
+        return cls(to_raw(value, decimals), decimals)
+    
+    def to_decimal(self) -> Decimal:
+        # Built from a string so no context precision or rounding applies
+        return Decimal(f"{self.raw}E-{self.decimals}")
+    
+    def __float__(self) -> float:
+        return self.raw / (10 ** self.decimals)
+    
+    def __bool__(self) -> bool:
+        return self.raw != 0
+    
+    def __str__(self) -> str:
+        text = f"{self.to_decimal():f}"
+        return text.rstrip('0').rstrip('.') if '.' in text else text
+    
+    def __repr__(self) -> str:
+        return f"Amount('{self}', decimals={self.decimals})"
+    
+    def __format__(self, spec: str) -> str:
+        return format(self.to_decimal(), spec) if spec else str(self)
+    
+    def __hash__(self) -> int:
+        return hash(self.to_decimal())
+    
+    def _other(self, other: Any) -> Any:
+        """Exact Decimal for comparable values, None otherwise"""
+        if isinstance(other, Amount):
+            return other.to_decimal()
+        if isinstance(other, (int, Decimal)):
+            return Decimal(other)
+        if isinstance(other, float):
+            return Decimal(other)
+        return None
+    
+    def _compare(self, other: Any, op: Any) -> Any:
+        if isinstance(other, Amount) and other.decimals == self.decimals:
+            return op(self.raw, other.raw)
+        value = self._other(other)
+        if value is None:
+            return NotImplemented
+        return op(self.to_decimal(), value)
+    
+    def __eq__(self, other: Any) -> Any:
+        return self._compare(other, lambda a, b: a == b)
+    
+    def __lt__(self, other: Any) -> Any:
+        return self._compare(other, lambda a, b: a < b)
+    
+    def __le__(self, other: Any) -> Any:
+        return self._compare(other, lambda a, b: a <= b)
+    
+    def __gt__(self, other: Any) -> Any:
+        return self._compare(other, lambda a, b: a > b)
+    
+    def __ge__(self, other: Any) -> Any:
+        return self._compare(other, lambda a, b: a >= b)
+    
+    def __neg__(self) -> 'Amount':
+        return Amount(-self.raw, self.decimals)
+    
+    def __add__(self, other: Any) -> Any:
+        if isinstance(other, Amount):
+            decimals = max(self.decimals, other.decimals)
+            return Amount(self.raw * 10 ** (decimals - self.decimals) + other.raw * 10 ** (decimals - other.decimals), decimals)
+        if isinstance(other, int):
+            return Amount(self.raw + other * 10 ** self.decimals, self.decimals)
+        if isinstance(other, float):
+            return float(self) + other
+        if isinstance(other, Decimal):
+            return self.to_decimal() + other
+        return NotImplemented
+    
+    __radd__ = __add__
+    
+    def __sub__(self, other: Any) -> Any:
+        return self + (-other)
+    
+    def __rsub__(self, other: Any) -> Any:
+        return (-self) + other
+    
+    def __mul__(self, other: Any) -> Any:
+        if isinstance(other, int):
+            return Amount(self.raw * other, self.decimals)
+        if isinstance(other, float):
+            return float(self) * other
+        if isinstance(other, (Decimal, Amount)):
+            return self.to_decimal() * (other.to_decimal() if isinstance(other, Amount) else other)
+        return NotImplemented
+    
+    __rmul__ = __mul__
+    
+    def __truediv__(self, other: Any) -> Any:
+        if isinstance(other, float):
+            return float(self) / other
+        value = self._other(other)
+        if value is None:
+            return NotImplemented
+        return self.to_decimal() / value
+    
+    def __round__(self, ndigits: int = 0) -> Decimal:
+        return round(self.to_decimal(), ndigits)
+    
+    def to_json(self) -> str:
+        """Exact decimal string, the way ccxt reports amounts it must not round"""
+        return str(self)
+
+
+def json_default(value: Any) -> Any:
+    """`default` hook for json.dumps: Amounts and Decimals become exact decimal strings"""
+    if isinstance(value, Amount):
+        return value.to_json()
+    if isinstance(value, Decimal):
+        return f"{value:f}"
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def to_raw(value: Any, decimals: int) -> int:
+    """Raw integer units of a human-readable amount, without float rounding.
+    
+    Floats go through their shortest repr (0.1 -> '0.1'), so
+    to_raw(0.1, 18) == 10**17 exactly.
+    """
+    if isinstance(value, Amount):
+        if value.decimals == decimals:
+            return value.raw
+        value = value.to_decimal()
+    elif isinstance(value, float):
+        value = Decimal(repr(value))
+    elif not isinstance(value, int):
+        value = Decimal(str(value))
+    if isinstance(value, int):
+        return value * 10 ** decimals
+
+    # Shift the decimal digits directly; Decimal arithmetic would round at 28 digits
+    sign, digits, exponent = value.as_tuple()
+    if not isinstance(exponent, int):
+        raise ValueError(f"Invalid amount: {value}")
+    raw = int(''.join(map(str, digits)) or '0')
+    shift = exponent + decimals
+    raw = raw * 10 ** shift if shift >= 0 else raw // 10 ** -shift
+    return -raw if sign else raw
+
+
+def amounts_array(raw_amounts: Any, decimals: Any, exact: bool = True) -> Any:
+    """Vectorized conversion of raw amounts to human-readable values.
+    
+    exact=True returns a NumPy object array of Amount (no rounding).
+    exact=False returns float64; when every raw value fits in int64 the
+    scaling is done with vector operations instead of per-element bigints.
+    `decimals` may be one value or one per amount.
+    """
+    if np is None:
+        raise ImportError("numpy is required for amounts_array")
+    
+    raw_list = list(raw_amounts)
+    decimals_array = np.broadcast_to(np.asarray(decimals, dtype=np.int64), (len(raw_list),))
+    if exact:
+        result = np.empty(len(raw_list), dtype=object)
+        result[:] = [Amount(raw, places) for raw, places in zip(raw_list, decimals_array.tolist())]
+        return result
+    
+    if all(-2**63 <= raw < 2**63 for raw in raw_list):
+        raw_array = np.asarray(raw_list, dtype=np.int64)
+        return raw_array / np.power(10.0, decimals_array)
+    return np.asarray([raw / (10 ** int(places)) for raw, places in zip(raw_list, decimals_array)], dtype=np.float64)
+
+
+def format_position(token_address: str, balance: int, metadata: Dict[str, Any], timestamp: int) -> Dict[str, Any]:
+    """Build a position dict from a raw balance"""
+    decimals = metadata['decimals']
+    
+    return {
+        'symbol': metadata['symbol'],
+        'name': metadata['name'],
+        'address': token_address,
+        'balance': Amount(balance, decimals),
+        'raw_balance': str(balance),
+        'decimals': decimals,
+        'timestamp': timestamp
+    }
+
+
+def format_approval(token_address: str, spender_address: str, allowance: int,
+                    metadata: Dict[str, Any], timestamp: int) -> Dict[str, Any]:
+    """Build an approval dict from a raw allowance"""
+    decimals = metadata['decimals']
+    
+    return {
+        'token': metadata['symbol'],
+        'token_address': token_address,
+        'spender': spender_address,
+        'allowance': Amount(allowance, decimals),
+        'raw_allowance': str(allowance),
+        'decimals': decimals,
+        'is_unlimited': allowance >= UNLIMITED_ALLOWANCE_THRESHOLD,
+        'timestamp': timestamp
+    }
+
+
+def metadata_calls(token_address: str) -> List[tuple]:
+    """Build the decimals/symbol/name calls for a token"""
+    token = checksum(token_address)
+    return [(token, DECIMALS_SELECTOR), (token, SYMBOL_SELECTOR), (token, NAME_SELECTOR)]
+
+
+def split_cached_metadata(cache: Any, chain_id: int, token_addresses: List[str]) -> tuple:
+    """Split tokens into (cached metadata by token, tokens still to fetch without duplicates)"""
+    metadata = {}
+    missing = []
+    
+    for token_address in token_addresses:
+        if token_address in metadata or token_address in missing:
+            continue
+        cached = cache.get(chain_id, token_address)
+        if cached is not None:
+            metadata[token_address] = cached
+        else:
+            missing.append(token_address)
+    
+    return metadata, missing
+
+
+def position_calls(owner: str, token_addresses: List[str], missing: List[str]) -> List[tuple]:
+    """balanceOf calls for every token, then metadata calls for the `missing` ones"""
+    calls = [(checksum(token_address), encode_balance_of(owner)) for token_address in token_addresses]
+    for token_address in missing:
+        calls.extend(metadata_calls(token_address))
+    return calls
+
+
+def parse_positions(token_addresses: List[str], results: List[tuple], metadata: Dict[str, Any],
+                    timestamp: int) -> Dict[str, Any]:
+    """Build positions from balanceOf results (one per token, in order), keyed by token address.
+    
+    Tokens whose balance or metadata calls fail map to the exception instead of a position.
+    """
+    positions = {}
+    
+    for i, token_address in enumerate(token_addresses):
+        ok_balance, raw_balance = results[i]
+        try:
+            token_metadata = metadata[token_address]
+            if isinstance(token_metadata, Exception):
+                raise token_metadata
+            if not ok_balance:
+                raise Exception("balanceOf reverted")
+            positions[token_address] = format_position(
+                token_address, decode_uint(raw_balance), token_metadata, timestamp
+            )
+        except Exception as e:
+            positions[token_address] = e
+    
+    return positions
+
+
+def format_balance(positions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """CCXT-format balance from positions, skipping failed and empty ones"""
+    balance = {}
+    
+    for position in positions:
+        if isinstance(position, Exception) or position['balance'] <= 0:
+            continue
+        balance[position['symbol']] = {
+            'free': position['balance'],
+            'used': 0,
+            'total': position['balance']
+        }
+    
+    return balance
+
+
+class RPCEndpoint:
+    """Health and rate-limit state for one RPC endpoint in an RPCPool.
+    
+    Tracks an EWMA of latency, recent latencies for the p95, an EWMA error
+    rate and a token bucket (`rate_limit` requests per second, 0 for none).
+    After `max_failures` consecutive failures the endpoint is ejected for a
+    cooldown that doubles on each ejection.
+    """
+    
+    def __init__(self, provider: Any, rate_limit: float = 0, burst: Optional[float] = None,
+                 max_failures: int = 3, cooldown: float = 10.0, alpha: float = 0.2):
+        self.provider = provider
+        self.url = provider.endpoint_uri
+        self.rate_limit = rate_limit
+        self.burst = burst or max(rate_limit, 1)
+        self.max_failures = max_failures
+        self.base_cooldown = cooldown
+        self.alpha = alpha
+        self.latency = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.failures = 0
+        self.cooldown = cooldown
+        self.ejected_until = 0.0
+        self.samples = deque(maxlen=200)
+        self._tokens = self.burst
+        self._refilled = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self, count: int = 1) -> float:
+        """Take `count` tokens; returns 0, or the seconds to wait until they are available"""
+        if not self.rate_limit:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate_limit)
+            self._refilled = now
+            if self._tokens >= count or self._tokens >= self.burst:
+                self._tokens -= count
+                return 0.0
+            return (min(count, self.burst) - self._tokens) / self.rate_limit
+    
+    def record(self, latency: Optional[float], error: bool = False):
+        """Update latency and error statistics with one request's outcome"""
+        with self._lock:
+            self.requests += 1
+            self.error_rate += self.alpha * ((1.0 if error else 0.0) - self.error_rate)
+            if latency is not None:
+                self.samples.append(latency)
+                self.latency = latency if self.latency is None else self.latency + self.alpha * (latency - self.latency)
+            if not error:
+                self.failures = 0
+                self.cooldown = self.base_cooldown
+                return
+            self.errors += 1
+            self.failures += 1
+            if self.failures >= self.max_failures:
+                self.ejected_until = time.monotonic() + self.cooldown
+                self.cooldown = min(self.cooldown * 2, 300)
+                self.failures = 0
+    
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.ejected_until
+    
+    def score(self) -> float:
+        """Lower is better; unmeasured endpoints score 0 so they get probed"""
+        if self.latency is None:
+            return 0.0
+        return self.latency * (1 + 5 * self.error_rate)
+    
+    def p95(self) -> Optional[float]:
+        with self._lock:
+            if len(self.samples) < 20:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[int(len(ordered) * 0.95) - 1]
+    
+    def stats(self) -> Dict[str, Any]:
+        p95 = self.p95()
+        return {
+            'url': self.url,
+            'latency_ms': None if self.latency is None else self.latency * 1000,
+            'p95_ms': None if p95 is None else p95 * 1000,
+            'requests': self.requests,
+            'errors': self.errors,
+            'error_rate': self.error_rate,
+            'healthy': self.healthy
+        }
+
+
+def is_rate_limited(error: Any) -> bool:
+    """Whether a JSON-RPC error (dict or message) means the node is throttling us"""
+    if not error:
+        return False
+    message = str(error.get('message', '') if isinstance(error, dict) else error).lower()
+    code = error.get('code') if isinstance(error, dict) else None
+    return code == 429 or any(hint in message for hint in ('rate limit', 'too many requests', 'capacity exceeded'))
+
+
+# Node errors for a request that was too big to run, as opposed to a failed transport
+BATCH_SIZE_ERROR_HINTS = ('out of gas', 'gas limit', 'gas required exceeds', 'too large', 'too big',
+                          'response size', 'size limit', 'size exceeded')
+
+
+def is_batch_size_error(error: Any) -> bool:
+    """Whether a failed batch call was rejected for its gas use or size, so smaller batches may succeed"""
+    if isinstance(error, web3.exceptions.ContractLogicError):
+        # The aggregate itself reverted, e.g. one call used up the gas of the whole batch
+        return True
+    response = getattr(error, 'response', None)
+    if getattr(error, 'status', None) == 413 or getattr(response, 'status_code', None) == 413:
+        return True
+    if is_rate_limited(error.args[0] if getattr(error, 'args', None) else error):
+        return False
+    message = str(error).lower()
+    return any(hint in message for hint in BATCH_SIZE_ERROR_HINTS)
+
+
+class RPCMetrics:
+    """Counters and latency histograms for RPC traffic, shareable between exchanges.
+    
+    Records per JSON-RPC method: requests, request/response bytes, latency
+    histogram and errors by class (`rpc_<code>`, `rate_limited`, or the
+    exception name for transport failures). Contract calls are counted per
+    function, including the calls packed inside aggregate3, along with
+    failed calls and per-operation failures. Read with snapshot() or
+    prometheus(), or serve the text format with start_http_server().
+    """
+    
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    
+    def __init__(self, buckets: Optional[tuple] = None):
+        self.buckets = tuple(buckets or self.LATENCY_BUCKETS)
+        self._lock = threading.Lock()
+        self._server = None
+        self.reset()
+    
+    def reset(self):
+        """Zero all counters"""
+        with self._lock:
+            self.round_trips = 0
+            self.batches = 0
+            self.methods = {}
+            self.functions = {}
+            self.failures = {}
+    
+    def _method(self, method: str) -> Dict[str, Any]:
+        entry = self.methods.get(method)
+        if entry is None:
+            entry = {
+                'requests': 0, 'request_bytes': 0, 'response_bytes': 0, 'errors': {},
+                'latency_sum': 0.0, 'latency_buckets': [0] * (len(self.buckets) + 1)
+            }
+            self.methods[method] = entry
+        return entry
+    
+    def record_round_trip(self, requests: List[tuple], responses: Optional[List[Any]], latency: float,
+                          request_bytes: int = 0, response_bytes: int = 0, error: Optional[str] = None):
+        """Record one provider call carrying (method, params) requests.
+        
+        Bytes are split evenly over the requests of a batch; each request is
+        observed with the latency of the whole call. Pass `error` (an error
+        class) when the call raised instead of returning responses.
+        """
+        bucket = next((i for i, bound in enumerate(self.buckets) if latency <= bound), len(self.buckets))
+        share = len(requests) or 1
+        
+        with self._lock:
+            self.round_trips += 1
+            if len(requests) > 1:
+                self.batches += 1
+            for i, (method, _) in enumerate(requests):
+                entry = self._method(method)
+                entry['requests'] += 1
+                entry['request_bytes'] += request_bytes // share
+                entry['response_bytes'] += response_bytes // share
+                entry['latency_sum'] += latency
+                entry['latency_buckets'][bucket] += 1
+                
+                response_error = error
+                if response_error is None and responses is not None and isinstance(responses[i], dict):
+                    rpc_error = responses[i].get('error')
+                    if rpc_error:
+                        code = rpc_error.get('code') if isinstance(rpc_error, dict) else None
+                        response_error = 'rate_limited' if is_rate_limited(rpc_error) else f"rpc_{code}"
+                if response_error is not None:
+                    entry['errors'][response_error] = entry['errors'].get(response_error, 0) + 1
+    
+    def record_calls(self, selectors: List[Any], successes: Optional[List[bool]] = None):
+        """Count contract calls by function (4-byte selector or calldata), with failures"""
+        with self._lock:
+            for i, selector in enumerate(selectors):
+                selector = bytes(HexBytes(selector[:10] if isinstance(selector, str) else selector[:4]))
+                name = FUNCTION_NAMES.get(selector, '0x' + selector.hex())
+                entry = self.functions.setdefault(name, {'calls': 0, 'failures': 0})
+                entry['calls'] += 1
+                if successes is not None and not successes[i]:
+                    entry['failures'] += 1
+    
+    def record_failure(self, operation: str, error: Any):
+        """Count a failure surfaced by an exchange operation (e.g. one token in fetch_positions)"""
+        key = (operation, type(error).__name__)
+        with self._lock:
+            self.failures[key] = self.failures.get(key, 0) + 1
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """Copy of all counters as plain dicts; latency buckets are cumulative, keyed by upper bound"""
+        with self._lock:
+            methods = {}
+            for method, entry in self.methods.items():
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(self.buckets + (float('inf'),), entry['latency_buckets']):
+                    cumulative += count
+                    buckets[bound] = cumulative
+                methods[method] = {
+                    'requests': entry['requests'],
+                    'request_bytes': entry['request_bytes'],
+                    'response_bytes': entry['response_bytes'],
+                    'errors': dict(entry['errors']),
+                    'latency': {'count': entry['requests'], 'sum': entry['latency_sum'], 'buckets': buckets}
+                }
+            return {
+                'round_trips': self.round_trips,
+                'batches': self.batches,
+                'methods': methods,
+                'functions': {name: dict(entry) for name, entry in self.functions.items()},
+                'failures': {f"{operation}:{error}": count for (operation, error), count in self.failures.items()}
+            }
+    
+    def prometheus(self, prefix: str = 'dex') -> str:
+        """All counters in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+        
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{key}="{label}"' for key, label in labels.items())
+                lines.append(f"{prefix}_{name}{suffix}{{{label_text}}} {value}" if label_text
+                             else f"{prefix}_{name}{suffix} {value}")
+        
+        methods = snapshot['methods']
+        metric('rpc_round_trips_total', 'counter', "Provider calls (single requests or batches)",
+               [('', {}, snapshot['round_trips'])])
+        metric('rpc_batches_total', 'counter', "Provider calls carrying more than one request",
+               [('', {}, snapshot['batches'])])
+        metric('rpc_requests_total', 'counter', "JSON-RPC requests by method",
+               [('', {'method': method}, entry['requests']) for method, entry in methods.items()])
+        metric('rpc_request_bytes_total', 'counter', "Request body bytes by method",
+               [('', {'method': method}, entry['request_bytes']) for method, entry in methods.items()])
+        metric('rpc_response_bytes_total', 'counter', "Response body bytes by method",
+               [('', {'method': method}, entry['response_bytes']) for method, entry in methods.items()])
+        metric('rpc_errors_total', 'counter', "Failed JSON-RPC requests by method and error class",
+               [('', {'method': method, 'error': error}, count)
+                for method, entry in methods.items() for error, count in entry['errors'].items()])
+        
+        samples = []
+        for method, entry in methods.items():
+            for bound, count in entry['latency']['buckets'].items():
+                samples.append(('_bucket', {'method': method, 'le': '+Inf' if bound == float('inf') else bound}, count))
+            samples.append(('_sum', {'method': method}, entry['latency']['sum']))
+            samples.append(('_count', {'method': method}, entry['latency']['count']))
+        metric('rpc_latency_seconds', 'histogram', "JSON-RPC latency by method", samples)
+        
+        functions = snapshot['functions']
+        metric('contract_calls_total', 'counter', "Contract calls by function (including inside aggregate3)",
+               [('', {'function': name}, entry['calls']) for name, entry in functions.items()])
+        metric('contract_call_failures_total', 'counter', "Reverted or empty contract calls by function",
+               [('', {'function': name}, entry['failures']) for name, entry in functions.items()])
+        metric('operation_failures_total', 'counter', "Per-item failures reported by exchange operations",
+               [('', {'operation': key.split(':')[0], 'error': key.split(':')[1]}, count)
+                for key, count in snapshot['failures'].items()])
+        
+        return '\n'.join(lines) + '\n'
+    
+    def start_http_server(self, port: int, address: str = '127.0.0.1') -> Any:
+        """Serve prometheus() on http://address:port/metrics from a daemon thread"""
+        metrics = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+            
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        
+        self._server = ThreadingHTTPServer((address, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server
+    
+    def stop_http_server(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+# Config keys that shape the provider stack (and so the ProviderPool key)
+RPC_CONFIG_KEYS = ('rpcUrl', 'rpcHedgeAfter', 'rpcBatchSize', 'rpcBatchWindow', 'rpcRateLimit',
+                   'rpcMaxFailures', 'rpcCooldown')
+
+
+class ProviderPool:
+    """Web3 clients shared by exchanges with the same RPC settings.
+    
+    A client carries the provider stack: HTTP sessions, endpoint health and
+    rate limits, and the batching window. Exchanges created per wallet or per
+    worker take the pooled client instead of building their own.
+    """
+    
+    def __init__(self):
+        self.clients = {}
+        self._lock = threading.Lock()
+    
+    def get(self, key: Any, connect: Any) -> Any:
+        """Client for `key`, built with connect() the first time"""
+        with self._lock:
+            client = self.clients.get(key)
+            if client is None:
+                client = connect()
+                self.clients[key] = client
+            return client
+    
+    def clear(self):
+        """Drop all pooled clients"""
+        with self._lock:
+            self.clients.clear()
+
+
+# Process-wide pool used with {'providerPool': True}
+PROVIDER_POOL = ProviderPool()
+
+
+@lru_cache(maxsize=256)
+def account_from_key(private_key: Any) -> Any:
+    """LocalAccount for a private key; deriving its address costs an EC multiplication, so it is done once"""
+    return eth_account.Account.from_key(private_key)
+
+
+class BatchResult:
+    """Placeholder for a request queued in a JSONRPCBatch, filled when the batch runs"""
+    
+    def __init__(self, formatter=None):
+        self.formatter = formatter
+        self.done = False
+        self.value = None
+        self.error = None
+    
+    def result(self) -> Any:
+        """Return the value, raising if the request failed or has not run yet"""
+        if not self.done:
+            raise ValueError("Batch has not been executed")
+        if self.error is not None:
+            raise Exception(f"RPC error: {self.error}")
+        return self.value
+
+
+class JSONRPCBatch:
+    """Collects raw JSON-RPC requests and sends them as one batch.
+    
+    Requests skip the web3 middleware stack, so results are formatted by the
+    per-request formatter (e.g. hex quantity -> int).
+    """
+    
+    def __init__(self, provider: Any):
+        self.provider = provider
+        self._requests = []
+        self._results = []
+    
+    def add(self, method: str, params: List[Any], formatter=None) -> BatchResult:
+        """Queue a request, returning its placeholder"""
+        result = BatchResult(formatter)
+        self._requests.append((method, params))
+        self._results.append(result)
+        return result
+    
+    def eth_call(self, to: str, data: Any, block_identifier: Any = 'latest', sender: Optional[str] = None) -> BatchResult:
+        """Queue an eth_call, result as bytes"""
+        return self.add('eth_call', [self._call_object(to, data, sender), self._block(block_identifier)],
+                        lambda value: web3.Web3.to_bytes(hexstr=value))
+    
+    def estimate_gas(self, to: str, data: Any, sender: str, block_identifier: Any = 'latest') -> BatchResult:
+        """Queue eth_estimateGas, result as int"""
+        return self.add('eth_estimateGas', [self._call_object(to, data, sender), self._block(block_identifier)],
+                        lambda value: int(value, 16))
+    
+    def gas_price(self) -> BatchResult:
+        """Queue eth_gasPrice, result as int"""
+        return self.add('eth_gasPrice', [], lambda value: int(value, 16))
+    
+    def get_transaction_count(self, address: str, block_identifier: Any = 'pending') -> BatchResult:
+        """Queue eth_getTransactionCount, result as int"""
+        return self.add('eth_getTransactionCount', [address, block_identifier], lambda value: int(value, 16))
+    
+    def _call_object(self, to: str, data: Any, sender: Optional[str]) -> Dict[str, str]:
+        call = {'to': to, 'data': '0x' + data.hex() if isinstance(data, bytes) else data}
+        if sender is not None:
+            call['from'] = sender
+        return call
+    
+    def _block(self, block_identifier: Any) -> Any:
+        return hex(block_identifier) if isinstance(block_identifier, int) else block_identifier
+    
+    def execute(self) -> List[BatchResult]:
+        """Send all queued requests and fill their placeholders"""
+        requests, results = self._requests, self._results
+        self._requests, self._results = [], []
+        if not requests:
+            return results
+        
+        if hasattr(self.provider, 'make_batch_request'):
+            responses = self.provider.make_batch_request(requests)
+        else:
+            responses = [self.provider.make_request(method, params) for method, params in requests]
+        
+        for result, response in zip(results, responses):
+            result.done = True
+            if 'error' in response:
+                result.error = response['error']
+            else:
+                value = response.get('result')
+                result.value = result.formatter(value) if result.formatter and value is not None else value
+        
+        return results
+
+
+class ContractRegistry:
+    """Contract instances built once per (address, ABI) and reused.
+    
+    web3 parses the ABI and sets up ENS for every contract() call, so
+    building one per call dominated the cost of hot loops. Instances are
+    dropped when the registry is asked for a different Web3 object.
+    """
+    
+    def __init__(self):
+        self.contracts = {}
+        self._w3 = None
+        self._lock = threading.Lock()
+    
+    def get(self, w3: Any, address: str, abi: tuple) -> Any:
+        """Contract for `address` bound to `w3`, creating it on first use"""
+        # ABIs are module-level constants, so their identity is a stable key
+        key = (checksum(address), id(abi))
+        with self._lock:
+            if w3 is not self._w3:
+                self.contracts.clear()
+                self._w3 = w3
+            contract = self.contracts.get(key)
+            if contract is None:
+                contract = w3.eth.contract(address=key[0], abi=abi)
+                self.contracts[key] = contract
+            return contract
+    
+    def clear(self):
+        """Drop all cached contracts"""
+        with self._lock:
+            self.contracts.clear()
+
+
+class TokenMetadataCache:
+    """LRU cache of ERC-20 metadata (decimals, symbol, name) keyed by (chainId, checksum address).
+    
+    Metadata never changes for a deployed token, so entries are never expired.
+    With a `path`, entries are also written to a SQLite file and loaded back
+    into memory when the cache is created.
+    """
+    
+    def __init__(self, max_size: int = 10000, path: Optional[str] = None):
+        self.max_size = max_size
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS token_metadata ("
+                "chain_id INTEGER, address TEXT, symbol TEXT, name TEXT, decimals INTEGER, "
+                "PRIMARY KEY (chain_id, address))"
+            )
+            self._db.commit()
+            self._warm()
+    
+    def _warm(self):
+        """Load persisted entries into memory, newest last"""
+        rows = self._db.execute(
+            "SELECT chain_id, address, symbol, name, decimals FROM token_metadata ORDER BY rowid"
+        ).fetchall()
+        for chain_id, address, symbol, name, decimals in rows[-self.max_size:]:
+            self._entries[(chain_id, address)] = {'symbol': symbol, 'name': name, 'decimals': decimals}
+    
+    def get(self, chain_id: int, address: str) -> Optional[Dict[str, Any]]:
+        """Return cached metadata or None, counting the hit or miss"""
+        key = (chain_id, checksum(address))
+        with self._lock:
+            metadata = self._entries.get(key)
+            if metadata is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return metadata
+    
+    def set(self, chain_id: int, address: str, metadata: Dict[str, Any]):
+        """Store metadata for a token"""
+        self.set_many(chain_id, {address: metadata})
+    
+    def set_many(self, chain_id: int, entries: Dict[str, Dict[str, Any]]):
+        """Store metadata for several tokens in one write"""
+        rows = []
+        with self._lock:
+            for address, metadata in entries.items():
+                key = (chain_id, checksum(address))
+                self._entries[key] = {
+                    'symbol': metadata['symbol'],
+                    'name': metadata['name'],
+                    'decimals': metadata['decimals']
+                }
+                self._entries.move_to_end(key)
+                rows.append((chain_id, key[1], metadata['symbol'], metadata['name'], metadata['decimals']))
+            
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            
+            if self._db is not None and rows:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO token_metadata (chain_id, address, symbol, name, decimals) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    rows
+                )
+                self._db.commit()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and current size"""
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'size': len(self._entries),
+            'max_size': self.max_size
+        }
+    
+    def close(self):
+        """Close the persistent store"""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+# ERC-20 event topics
+TRANSFER_TOPIC = '0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
+APPROVAL_TOPIC = '0x8c5be1e5ebec7d5bd14f71427d1e84f3dd0314c0f7b2291e5b200ac8c7c3b925'
+
+
+# getLogs errors for a block range or result set the provider will not serve
+LOG_RANGE_ERROR_HINTS = ('block range', 'range too', 'range is too', 'range exceeds', 'too many results',
+                         'more than', 'query returned', 'response size', 'too large', 'too many logs')
+
+
+class LogIndexer:
+    """Per-wallet token and spender index built from Transfer/Approval logs.
+    
+    Each sync only scans blocks after the wallet's checkpoint. Block ranges
+    shrink when the provider rejects a range as too large and grow back after
+    successful ranges. Rate limits and timeouts keep the range and retry it
+    after an exponential backoff (`backoff` seconds, doubling, `max_retries`
+    times). The index lives in SQLite (in memory unless `path` is set).
+    """
+    
+    def __init__(self, path: Optional[str] = None, start_block: int = 0, chunk_size: int = 2000,
+                 max_chunk_size: int = 100000, confirmations: int = 0, max_retries: int = 5,
+                 backoff: float = 1.0):
+        self.path = path
+        self.start_block = start_block
+        self.chunk_size = chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.confirmations = confirmations
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path or ':memory:', check_same_thread=False)
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS checkpoints (wallet TEXT PRIMARY KEY, last_block INTEGER);"
+            "CREATE TABLE IF NOT EXISTS wallet_tokens (wallet TEXT, token TEXT, PRIMARY KEY (wallet, token));"
+            "CREATE TABLE IF NOT EXISTS wallet_spenders ("
+            "wallet TEXT, token TEXT, spender TEXT, PRIMARY KEY (wallet, token, spender));"
+        )
+        self._db.commit()
+    
+    def get_checkpoint(self, wallet: str) -> Optional[int]:
+        """Last indexed block for a wallet, or None if never synced"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT last_block FROM checkpoints WHERE wallet = ?", (checksum(wallet),)
+            ).fetchone()
+        return row[0] if row else None
+    
+    def get_tokens(self, wallet: str) -> List[str]:
+        """Tokens the wallet has sent or received"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT token FROM wallet_tokens WHERE wallet = ? ORDER BY rowid", (checksum(wallet),)
+            ).fetchall()
+        return [row[0] for row in rows]
+    
+    def get_spenders(self, wallet: str, token_address: Optional[str] = None) -> List[tuple]:
+        """(token, spender) pairs the wallet has ever approved, optionally for one token"""
+        query = "SELECT token, spender FROM wallet_spenders WHERE wallet = ?"
+        args = [checksum(wallet)]
+        if token_address:
+            query += " AND token = ?"
+            args.append(checksum(token_address))
+        with self._lock:
+            return [tuple(row) for row in self._db.execute(query + " ORDER BY rowid", args).fetchall()]
+    
+    def sync(self, dex: Any, wallet: str, to_block: Optional[int] = None) -> Dict[str, Any]:
+        """Scan new blocks for the wallet's Transfer and Approval logs and update the index"""
+        wallet = checksum(wallet)
+        if to_block is None:
+            to_block = dex.w3.eth.block_number - self.confirmations
+        
+        checkpoint = self.get_checkpoint(wallet)
+        from_block = self.start_block if checkpoint is None else checkpoint + 1
+        topic = '0x' + '0' * 24 + wallet[2:].lower()
+        chunk_size = self.chunk_size
+        ranges = 0
+        logs_seen = 0
+        retries = 0
+        
+        while from_block <= to_block:
+            end_block = min(from_block + chunk_size - 1, to_block)
+            
+            # Sent, received and approvals go out in one JSON-RPC batch
+            with dex.batch() as batch:
+                pending = [
+                    self._get_logs(batch, from_block, end_block, [TRANSFER_TOPIC, topic]),
+                    self._get_logs(batch, from_block, end_block, [TRANSFER_TOPIC, None, topic]),
+                    self._get_logs(batch, from_block, end_block, [APPROVAL_TOPIC, topic])
+                ]
+            
+            errors = [item.error for item in pending if item.error is not None]
+            if errors:
+                if any(self._is_transient_error(error) for error in errors):
+                    # Throttled or slow node: the range is fine, wait and retry it
+                    if retries < self.max_retries:
+                        time.sleep(self.backoff * 2 ** retries)
+                        retries += 1
+                        continue
+                elif chunk_size > 1 and any(self._is_range_error(error) for error in errors):
+                    chunk_size = max(1, chunk_size // 2)
+                    continue
+                raise Exception(f"eth_getLogs failed: {errors[0]}")
+            retries = 0
+            
+            sent, received, approvals = [item.result() for item in pending]
+            self._store(wallet, sent + received, approvals, end_block)
+            logs_seen += len(sent) + len(received) + len(approvals)
+            ranges += 1
+            from_block = end_block + 1
+            chunk_size = min(chunk_size * 2, self.max_chunk_size)
+        
+        # Remember the range size that worked for the next sync
+        self.chunk_size = chunk_size
+        
+        return {'wallet': wallet, 'last_block': self.get_checkpoint(wallet), 'ranges': ranges, 'logs': logs_seen}
+    
+    def _get_logs(self, batch: Any, from_block: int, to_block: int, topics: List[Any]) -> Any:
+        """Queue an eth_getLogs request"""
+        return batch.add('eth_getLogs', [{
+            'fromBlock': hex(from_block),
+            'toBlock': hex(to_block),
+            'topics': topics
+        }])
+    
+    def _is_range_error(self, error: Any) -> bool:
+        """Whether a getLogs error means the block range or result set is too large"""
+        if self._is_transient_error(error):
+            return False
+        message = str(error.get('message', '') if isinstance(error, dict) else error).lower()
+        return any(hint in message for hint in LOG_RANGE_ERROR_HINTS)
+    
+    def _is_transient_error(self, error: Any) -> bool:
+        """Whether a getLogs error is a rate limit or timeout, where retrying the same range later helps"""
+        message = str(error.get('message', '') if isinstance(error, dict) else error).lower()
+        return is_rate_limited(error) or 'timeout' in message or 'timed out' in message
+    
+    def _store(self, wallet: str, transfers: List[Dict], approvals: List[Dict], last_block: int):
+        """Record tokens and spenders from a block range and move the checkpoint"""
+        tokens = {(wallet, checksum(log['address'])) for log in transfers}
+        spenders = {
+            (wallet, checksum(log['address']), checksum('0x' + log['topics'][2][-40:]))
+            for log in approvals if len(log.get('topics', [])) >= 3
+        }
+        
+        with self._lock:
+            self._db.executemany("INSERT OR IGNORE INTO wallet_tokens (wallet, token) VALUES (?, ?)", sorted(tokens))
+            self._db.executemany(
+                "INSERT OR IGNORE INTO wallet_spenders (wallet, token, spender) VALUES (?, ?, ?)", sorted(spenders)
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO checkpoints (wallet, last_block) VALUES (?, ?)", (wallet, last_block)
+            )
+            self._db.commit()
+    
+    def close(self):
+        """Close the index store"""
+        self._db.close()
+
+
+# Uniswap V2 pair Sync(uint112,uint112) event topic
+SYNC_TOPIC = '0x1c411e9a96e071241c2f21f7726b17ae89e3cab4c78be50e062b03a9fffbbad1'
+
+
+def get_amount_out(amount_in: int, reserve_in: int, reserve_out: int, fee_bps: int = 30) -> int:
+    """Constant-product output amount, same integer math as UniswapV2Library.getAmountOut"""
+    if amount_in <= 0 or reserve_in <= 0 or reserve_out <= 0:
+        return 0
+    amount_in_with_fee = amount_in * (10000 - fee_bps)
+    return amount_in_with_fee * reserve_out // (reserve_in * 10000 + amount_in_with_fee)
+
+
+def get_amount_in(amount_out: int, reserve_in: int, reserve_out: int, fee_bps: int = 30) -> int:
+    """Constant-product input amount, same integer math as UniswapV2Library.getAmountIn"""
+    if amount_out <= 0 or reserve_in <= 0 or amount_out >= reserve_out:
+        raise ValueError("Insufficient liquidity")
+    return reserve_in * amount_out * 10000 // ((reserve_out - amount_out) * (10000 - fee_bps)) + 1
+
+
+def get_amounts_out_array(amounts_in: Any, reserves_in: Any, reserves_out: Any,
+                          fee_bps: Any = 30, exact: bool = True) -> Any:
+    """Vectorized get_amount_out over NumPy arrays (broadcasting amounts against pools).
+    
+    exact=True uses object arrays of Python ints and matches the on-chain
+    result exactly; exact=False uses float64 for speed.
+    """
+    if np is None:
+        raise ImportError("numpy is required for vectorized quotes")
+    
+    dtype = object if exact else np.float64
+    amounts_in = np.asarray(amounts_in, dtype=dtype)
+    reserves_in = np.asarray(reserves_in, dtype=dtype)
+    reserves_out = np.asarray(reserves_out, dtype=dtype)
+    fee_bps = np.asarray(fee_bps, dtype=dtype)
+    
+    amount_in_with_fee = amounts_in * (10000 - fee_bps)
+    numerator = amount_in_with_fee * reserves_out
+    denominator = reserves_in * 10000 + amount_in_with_fee
+    valid = (amounts_in > 0) & (reserves_in > 0) & (reserves_out > 0)
+    
+    if exact:
+        safe_denominator = np.where(valid, denominator, 1)
+        return np.where(valid, numerator // safe_denominator, 0)
+    return np.where(valid, np.floor(numerator / np.where(valid, denominator, 1)), 0.0)
+
+
+# Pair counts at which get_liquidity_positions switches to the array path
+LP_VECTOR_THRESHOLD = 256
+
+
+def get_lp_amounts(balance: int, total_supply: int, reserve0: int, reserve1: int) -> tuple:
+    """Underlying (amount0, amount1) for `balance` LP tokens, rounded down like V2 burn()"""
+    if total_supply <= 0:
+        return 0, 0
+    return balance * reserve0 // total_supply, balance * reserve1 // total_supply
+
+
+def get_lp_amounts_array(balances: Any, total_supplies: Any, reserves0: Any, reserves1: Any,
+                         exact: bool = True) -> tuple:
+    """Vectorized get_lp_amounts over NumPy arrays, returning (amounts0, amounts1).
+    
+    exact=True uses object arrays of Python ints and matches burn() exactly;
+    exact=False uses float64 for speed.
+    """
+    if np is None:
+        raise ImportError("numpy is required for vectorized LP valuation")
+    
+    dtype = object if exact else np.float64
+    balances = np.asarray(balances, dtype=dtype)
+    total_supplies = np.asarray(total_supplies, dtype=dtype)
+    reserves0 = np.asarray(reserves0, dtype=dtype)
+    reserves1 = np.asarray(reserves1, dtype=dtype)
+    
+    valid = total_supplies > 0
+    safe_supplies = np.where(valid, total_supplies, 1)
+    if exact:
+        return (np.where(valid, balances * reserves0 // safe_supplies, 0),
+                np.where(valid, balances * reserves1 // safe_supplies, 0))
+    return (np.where(valid, np.floor(balances * reserves0 / safe_supplies), 0.0),
+            np.where(valid, np.floor(balances * reserves1 / safe_supplies), 0.0))
+
+
+# LP tokens locked forever by the first mint() of a V2 pair
+MINIMUM_LIQUIDITY = 1000
+
+
+def get_optimal_amounts(amount_a_desired: int, amount_b_desired: int, reserve_a: int, reserve_b: int) -> tuple:
+    """(amount_a, amount_b) a V2 router deposits for the desired amounts, as in _addLiquidity()"""
+    if reserve_a == 0 and reserve_b == 0:
+        return amount_a_desired, amount_b_desired
+    amount_b_optimal = amount_a_desired * reserve_b // reserve_a
+    if amount_b_optimal <= amount_b_desired:
+        return amount_a_desired, amount_b_optimal
+    return amount_b_desired * reserve_a // reserve_b, amount_b_desired
+
+
+def get_liquidity_minted(amount_a: int, amount_b: int, reserve_a: int, reserve_b: int, total_supply: int) -> int:
+    """LP tokens a V2 pair mints for a deposit, as in mint() (ignoring the protocol fee mint)"""
+    if total_supply == 0:
+        return max(math.isqrt(amount_a * amount_b) - MINIMUM_LIQUIDITY, 0)
+    return min(amount_a * total_supply // reserve_a, amount_b * total_supply // reserve_b)
+
+
+class AMMEngine:
+    """In-process reserves for Uniswap V2-style pairs, used to quote without RPC.
+    
+    Pools are keyed by pair address and indexed by their (sorted) token pair.
+    Reserves are updated from getReserves reads or from Sync logs.
+    """
+    
+    def __init__(self):
+        self.pools = {}
+        self.pairs_by_tokens = {}
+        self.graph = {}  # dex -> token -> neighbor token -> pair address
+        self.last_block = None
+        self._lock = threading.Lock()
+    
+    def add_pool(self, pair_address: str, token0: str, token1: str, reserve0: int, reserve1: int,
+                 dex: Optional[str] = None, fee_bps: int = 30, block: Optional[int] = None):
+        """Add or replace a pool"""
+        pair_address = checksum(pair_address)
+        token0 = checksum(token0)
+        token1 = checksum(token1)
+        key = tuple(sorted((token0, token1)))
+        
+        with self._lock:
+            self.pools[pair_address] = {
+                'pair': pair_address,
+                'token0': token0,
+                'token1': token1,
+                'reserve0': reserve0,
+                'reserve1': reserve1,
+                'dex': dex,
+                'fee_bps': fee_bps,
+                'block': block,
+                'total_supply': None
+            }
+            pairs = self.pairs_by_tokens.setdefault(key, [])
+            if pair_address not in pairs:
+                pairs.append(pair_address)
+            graph = self.graph.setdefault(dex, {})
+            graph.setdefault(token0, {})[token1] = pair_address
+            graph.setdefault(token1, {})[token0] = pair_address
+    
+    def update_reserves(self, pair_address: str, reserve0: int, reserve1: int, block: Optional[int] = None):
+        """Set reserves for a known pool, ignoring updates older than the current state"""
+        pool = self.pools.get(pair_address)
+        if pool is None:
+            return
+        with self._lock:
+            if block is not None and pool['block'] is not None and block < pool['block']:
+                return
+            pool['reserve0'] = reserve0
+            pool['reserve1'] = reserve1
+            if block is not None:
+                pool['block'] = block
+    
+    def set_total_supply(self, pair_address: str, total_supply: int):
+        """Record a known pool's LP token supply, used for expected mint amounts"""
+        pool = self.pools.get(pair_address)
+        if pool is None:
+            return
+        with self._lock:
+            pool['total_supply'] = total_supply
+    
+    def apply_sync_log(self, log: Dict[str, Any]) -> bool:
+        """Apply a Sync(reserve0, reserve1) log; returns True if the pool is tracked"""
+        pair_address = checksum(log['address'])
+        if pair_address not in self.pools:
+            return False
+        
+        data = log['data']
+        data = web3.Web3.to_bytes(hexstr=data) if isinstance(data, str) else bytes(data)
+        block = log.get('blockNumber')
+        if isinstance(block, str):
+            block = int(block, 16)
+        
+        self.update_reserves(pair_address, int.from_bytes(data[:32], 'big'), int.from_bytes(data[32:64], 'big'), block)
+        return True
+    
+    def get_pools(self, token_a: str, token_b: str) -> List[Dict[str, Any]]:
+        """All tracked pools for a token pair"""
+        key = tuple(sorted((checksum(token_a), checksum(token_b))))
+        return [self.pools[pair] for pair in self.pairs_by_tokens.get(key, [])]
+    
+    def get_reserves(self, pool: Dict[str, Any], token_in: str) -> tuple:
+        """(reserve_in, reserve_out) of a pool for a given input token"""
+        if checksum(token_in) == pool['token0']:
+            return pool['reserve0'], pool['reserve1']
+        return pool['reserve1'], pool['reserve0']
+    
+    def quote(self, token_in: str, token_out: str, amount_in: int, pair_address: Optional[str] = None) -> Dict[str, Any]:
+        """Best single-pool output for an exact input, across all tracked pools for the pair"""
+        pools = [self.pools[pair_address]] if pair_address else self.get_pools(token_in, token_out)
+        best = {'amount_out': 0, 'pair': None, 'dex': None}
+        
+        for pool in pools:
+            reserve_in, reserve_out = self.get_reserves(pool, token_in)
+            amount_out = get_amount_out(amount_in, reserve_in, reserve_out, pool['fee_bps'])
+            if amount_out > best['amount_out']:
+                best = {'amount_out': amount_out, 'pair': pool['pair'], 'dex': pool['dex']}
+        
+        return best
+    
+    def quote_path(self, path: List[str], amount_in: int, pair_addresses: Optional[List[str]] = None) -> List[int]:
+        """Amounts along a multi-hop path, like router getAmountsOut"""
+        amounts = [amount_in]
+        
+        for i in range(len(path) - 1):
+            pair_address = pair_addresses[i] if pair_addresses else None
+            amounts.append(self.quote(path[i], path[i + 1], amounts[-1], pair_address)['amount_out'])
+        
+        return amounts
+    
+    def quote_path_in(self, path: List[str], amount_out: int, pair_addresses: List[str]) -> List[int]:
+        """Input amounts along a path for an exact output, like router getAmountsIn"""
+        amounts = [amount_out]
+        
+        for i in range(len(path) - 1, 0, -1):
+            pool = self.pools[pair_addresses[i - 1]]
+            reserve_in, reserve_out = self.get_reserves(pool, path[i - 1])
+            amounts.insert(0, get_amount_in(amounts[0], reserve_in, reserve_out, pool['fee_bps']))
+        
+        return amounts
+    
+    def find_routes(self, token_in: str, token_out: str, amount_in: int, max_hops: int = 3,
+                    connectors: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """All routes up to max_hops within a single DEX, best output first.
+        
+        Intermediate tokens are limited to `connectors` when given, which keeps
+        the search small on large pair graphs.
+        """
+        token_in = checksum(token_in)
+        token_out = checksum(token_out)
+        connectors = set(checksum(token) for token in connectors) if connectors else None
+        routes = []
+        
+        def visit(graph, dex, token, amount, path, pairs):
+            for neighbor, pair_address in graph.get(token, {}).items():
+                if neighbor in path:
+                    continue
+                pool = self.pools[pair_address]
+                reserve_in, reserve_out = self.get_reserves(pool, token)
+                amount_out = get_amount_out(amount, reserve_in, reserve_out, pool['fee_bps'])
+                if amount_out <= 0:
+                    continue
+                if neighbor == token_out:
+                    routes.append({
+                        'dex': dex,
+                        'path': path + [neighbor],
+                        'pairs': pairs + [pair_address],
+                        'amount_in': amount_in,
+                        'amount_out': amount_out
+                    })
+                elif len(pairs) + 1 < max_hops and (connectors is None or neighbor in connectors):
+                    visit(graph, dex, neighbor, amount_out, path + [neighbor], pairs + [pair_address])
+        
+        for dex, graph in self.graph.items():
+            visit(graph, dex, token_in, amount_in, [token_in], [])
+        
+        routes.sort(key=lambda route: route['amount_out'], reverse=True)
+        return routes
+    
+    def find_split_route(self, token_in: str, token_out: str, amount_in: int, max_hops: int = 3,
+                         connectors: Optional[List[str]] = None, parts: int = 10, max_routes: int = 3) -> Dict[str, Any]:
+        """Split an input across up to max_routes pool-disjoint routes to maximize total output.
+        
+        The input is allocated in `parts` equal slices, each slice going to the
+        route with the best marginal output.
+        """
+        chosen = []
+        used_pairs = set()
+        for route in self.find_routes(token_in, token_out, amount_in, max_hops, connectors):
+            if used_pairs.isdisjoint(route['pairs']):
+                chosen.append(route)
+                used_pairs.update(route['pairs'])
+                if len(chosen) == max_routes:
+                    break
+        
+        if not chosen:
+            return {'amount_in': amount_in, 'amount_out': 0, 'routes': []}
+        
+        allocations = [0] * len(chosen)
+        outputs = [0] * len(chosen)
+        step = amount_in // parts
+        
+        for k in range(parts):
+            size = step if k < parts - 1 else amount_in - step * (parts - 1)
+            if size <= 0:
+                continue
+            candidates = [
+                self.quote_path(route['path'], allocations[i] + size, route['pairs'])[-1]
+                for i, route in enumerate(chosen)
+            ]
+            best = max(range(len(chosen)), key=lambda i: candidates[i] - outputs[i])
+            allocations[best] += size
+            outputs[best] = candidates[best]
+        
+        routes = [
+            dict(route, amount_in=allocation, amount_out=output)
+            for route, allocation, output in zip(chosen, allocations, outputs) if allocation > 0
+        ]
+        return {'amount_in': amount_in, 'amount_out': sum(outputs), 'routes': routes}
+    
+    def quote_many(self, token_in: str, token_out: str, amounts_in: List[int], exact: bool = True) -> Any:
+        """Quote many input sizes at once against every pool for the pair.
+        
+        Returns an array of shape (pools, amounts) and the matching pool list.
+        """
+        pools = self.get_pools(token_in, token_out)
+        if not pools:
+            return get_amounts_out_array([[]], [[]], [[]], exact=exact), pools
+        
+        reserves = [self.get_reserves(pool, token_in) for pool in pools]
+        reserves_in = [[reserve_in] for reserve_in, _ in reserves]
+        reserves_out = [[reserve_out] for _, reserve_out in reserves]
+        fees = [[pool['fee_bps']] for pool in pools]
+        
+        return get_amounts_out_array([list(amounts_in)], reserves_in, reserves_out, fees, exact), pools
+
+
+class NonceManager:
+    """Local nonce allocator for one sender account.
+    
+    Allocation only holds a short lock, so it is safe from threads and from
+    coroutines. Nonces of transactions that fail to send are handed out again
+    before new ones, so one failure does not leave a gap that stalls every
+    later transaction. Async callers without a blocking `fetch_nonce` read
+    the pending nonce themselves and pass it to sync() when needs_sync is set.
+    """
+    
+    def __init__(self, fetch_nonce: Any = None):
+        self.fetch_nonce = fetch_nonce
+        self._next = None
+        self._stale = False
+        self._released = []
+        self._in_flight = set()
+        self._lock = threading.Lock()
+    
+    def allocate(self) -> int:
+        """Next nonce to use, reusing released nonces first"""
+        with self._lock:
+            if self._next is None or self._stale:
+                self._apply(self.fetch_nonce())
+            if self._released:
+                nonce = self._released.pop(0)
+            else:
+                nonce = self._next
+                self._next += 1
+            self._in_flight.add(nonce)
+            return nonce
+    
+    def release(self, nonce: int):
+        """Give back a nonce whose transaction was never broadcast"""
+        with self._lock:
+            self._in_flight.discard(nonce)
+            if self._next is not None and nonce == self._next - 1:
+                self._next -= 1
+            elif nonce not in self._released:
+                self._released.append(nonce)
+                self._released.sort()
+    
+    def confirm(self, nonce: int):
+        """Mark a nonce as mined"""
+        with self._lock:
+            self._in_flight.discard(nonce)
+    
+    def expire(self, nonce: int):
+        """Forget a nonce whose transaction was not mined in time; the next allocation re-reads the pending nonce.
+        
+        The transaction may still be in the mempool or may have been dropped,
+        so the node's pending nonce decides whether the nonce is reused.
+        """
+        with self._lock:
+            self._in_flight.discard(nonce)
+            self._stale = True
+    
+    def resync(self):
+        """Drop local state and re-read the pending nonce from the node"""
+        with self._lock:
+            self._apply(self.fetch_nonce())
+    
+    @property
+    def needs_sync(self) -> bool:
+        """Whether the next allocation has to read the pending nonce from the node first"""
+        with self._lock:
+            return self._next is None or self._stale
+    
+    def sync(self, pending_nonce: int):
+        """Apply a pending nonce read by the caller, unless another caller already synced"""
+        with self._lock:
+            if self._next is None or self._stale:
+                self._apply(pending_nonce)
+    
+    def _apply(self, pending_nonce: int):
+        self._next = pending_nonce
+        self._stale = False
+        self._released = [nonce for nonce in self._released if nonce >= self._next]
+    
+    @property
+    def gaps(self) -> List[int]:
+        """Released nonces below the next nonce, which block later transactions until reused"""
+        with self._lock:
+            return list(self._released)
+
+
+class TransactionPipeline:
+    """Signs and submits transactions with local nonces and confirms them in the background.
+    
+    submit() returns right after broadcast with a Future for the receipt, so
+    callers can send many transactions back to back. One poller thread looks
+    up all pending receipts in a single JSON-RPC batch per interval. Async
+    callers can await asyncio.wrap_future(future).
+    """
+    
+    def __init__(self, dex: Any, poll_interval: float = 1.0, timeout: float = 300):
+        self.dex = dex
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.nonces = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._poller = None
+        self._stop = threading.Event()
+    
+    def submit(self, tx: Dict[str, Any]) -> Future:
+        """Assign a nonce, sign and broadcast a transaction.
+        
+        Returns a Future resolving to the receipt, with `tx_hash` and `nonce`
+        attributes set.
+        """
+        nonces = self._nonce_manager()
+        for attempt in range(2):
+            nonce = nonces.allocate()
+            try:
+                signed_tx = self.dex.account.sign_transaction(dict(tx, nonce=nonce))
+                tx_hash = self.dex.w3.eth.send_raw_transaction(signed_tx.rawTransaction)
+                break
+            except Exception as e:
+                nonces.release(nonce)
+                # Another sender used this account: resync once and retry
+                if attempt == 0 and 'nonce too low' in str(e).lower():
+                    nonces.resync()
+                    continue
+                raise
+        
+        return self._track(tx_hash, nonce)
+    
+    def submit_many(self, txs: List[Dict[str, Any]]) -> List[Any]:
+        """Sign transactions with sequential nonces and broadcast them in one JSON-RPC batch.
+        
+        Returns one entry per transaction: a receipt Future, or the Exception
+        raised while signing or sending it. Nonces of failed sends are
+        released for reuse; if the whole batch fails, every nonce is released
+        and the pending nonce is re-read.
+        """
+        if not txs:
+            return []
+        
+        nonces = self._nonce_manager()
+        allocated = [nonces.allocate() for _ in txs]
+        results = [None] * len(txs)
+        
+        sends = {}
+        try:
+            with self.dex.batch() as batch:
+                for i, (tx, nonce) in enumerate(zip(txs, allocated)):
+                    try:
+                        signed_tx = self.dex.account.sign_transaction(dict(tx, nonce=nonce))
+                    except Exception as e:
+                        results[i] = e
+                        continue
+                    sends[i] = batch.add('eth_sendRawTransaction', [web3.Web3.to_hex(signed_tx.rawTransaction)], HexBytes)
+        except Exception as e:
+            # The batch itself failed (transport, timeout, 5xx): some sends may still have reached
+            # the node, so release every nonce and let the node's pending nonce decide
+            for nonce in sorted(allocated, reverse=True):
+                nonces.release(nonce)
+            try:
+                nonces.resync()
+            except Exception:
+                # Node unreachable as well: re-read the pending nonce on the next allocation
+                nonces.expire(allocated[-1])
+            return [result if isinstance(result, Exception) else e for result in results]
+        
+        for i, send in sends.items():
+            if send.error is not None:
+                results[i] = Exception(f"RPC error: {send.error}")
+            else:
+                results[i] = self._track(send.value, allocated[i])
+        
+        # Release highest first so trailing failures roll the counter back
+        failed = [allocated[i] for i, result in enumerate(results) if isinstance(result, Exception)]
+        for nonce in sorted(failed, reverse=True):
+            nonces.release(nonce)
+        if any('nonce too low' in str(result).lower() for result in results if isinstance(result, Exception)):
+            nonces.resync()
+        return results
+    
+    def _nonce_manager(self) -> NonceManager:
+        with self._lock:
+            if self.nonces is None:
+                self.nonces = NonceManager(
+                    lambda: self.dex.w3.eth.get_transaction_count(self.dex.address, 'pending')
+                )
+            return self.nonces
+    
+    def _track(self, tx_hash: Any, nonce: int) -> Future:
+        """Register a broadcast transaction with the receipt poller"""
+        future = Future()
+        future.tx_hash = tx_hash
+        future.nonce = nonce
+        with self._lock:
+            self._pending[tx_hash] = (future, nonce, time.monotonic())
+            if self._poller is None or not self._poller.is_alive():
+                self._stop.clear()
+                self._poller = threading.Thread(target=self._poll_receipts, daemon=True)
+                self._poller.start()
+        return future
+    
+    def pending_count(self) -> int:
+        """Number of transactions waiting for a receipt"""
+        with self._lock:
+            return len(self._pending)
+    
+    def close(self):
+        """Stop the receipt poller; receipts still pending fail with a TimeoutError"""
+        self._stop.set()
+        with self._lock:
+            poller = self._poller
+        if poller is not None and poller is not threading.current_thread():
+            poller.join()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._poller = None
+        for tx_hash, (future, _, _) in pending.items():
+            future.set_exception(TimeoutError(f"Transaction {web3.Web3.to_hex(tx_hash)} still pending when the pipeline closed"))
+    
+    def _poll_receipts(self):
+        """Batch receipt lookups until nothing is pending or close() is called"""
+        while not self._stop.wait(self.poll_interval):
+            with self._lock:
+                pending = dict(self._pending)
+            if not pending:
+                with self._lock:
+                    if not self._pending:
+                        self._poller = None
+                        return
+                continue
+            
+            try:
+                with self.dex.batch() as batch:
+                    lookups = {
+                        tx_hash: batch.add('eth_getTransactionReceipt', [web3.Web3.to_hex(tx_hash)])
+                        for tx_hash in pending
+                    }
+            except Exception:
+                continue
+            
+            now = time.monotonic()
+            for tx_hash, lookup in lookups.items():
+                future, nonce, submitted_at = pending[tx_hash]
+                if lookup.error is None and lookup.value:
+                    self._finish(tx_hash)
+                    self.nonces.confirm(nonce)
+                    future.set_result(web3.datastructures.AttributeDict(web3._utils.method_formatters.receipt_formatter(lookup.value)))
+                elif now - submitted_at > self.timeout:
+                    self._finish(tx_hash)
+                    self.nonces.expire(nonce)
+                    future.set_exception(TimeoutError(f"Transaction {web3.Web3.to_hex(tx_hash)} not mined after {self.timeout}s"))
+    
+    def _finish(self, tx_hash: Any):
+        with self._lock:
+            self._pending.pop(tx_hash, None)
+
+
+def gas_estimate_key(function: Any, token: Any = None) -> tuple:
+    """Memo key for a contract call's gas estimate.
+    
+    Integer arguments only count as zero or non-zero, so swaps of any size
+    share an estimate while approve(spender, 0) and approve(spender, n)
+    (a cheap refund vs. a fresh storage write) do not.
+    """
+    arguments = tuple(
+        argument == 0 if isinstance(argument, int) else tuple(argument) if isinstance(argument, list) else argument
+        for argument in function.args
+    )
+    return function.address, function.selector, token, arguments
+
+
+class FeeOracle:
+    """Serves transaction fees from memory, refreshed from eth_feeHistory in a background thread.
+    
+    Fees per level come from the median priority fee at that level's reward
+    percentile over the last `block_count` blocks; maxFeePerGas leaves room
+    for the base fee to grow by `base_fee_multiplier`. Chains without
+    EIP-1559 fall back to a cached legacy gasPrice. The thread starts on the
+    first get_fees() and exits once no fees were asked for in `idle_timeout`
+    seconds (default 5 refresh intervals), like the receipt poller.
+    """
+    
+    def __init__(self, dex: Any, refresh_interval: float = 12, block_count: int = 20,
+                 percentiles: Optional[Dict[str, float]] = None, base_fee_multiplier: float = 2,
+                 idle_timeout: Optional[float] = None):
+        self.dex = dex
+        self.refresh_interval = refresh_interval
+        self.idle_timeout = idle_timeout if idle_timeout is not None else 5 * refresh_interval
+        self.block_count = block_count
+        self.percentiles = percentiles or {'slow': 10, 'medium': 50, 'fast': 90}
+        self.base_fee_multiplier = base_fee_multiplier
+        self._fees = None
+        self._updated = 0.0
+        self._last_used = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def refresh(self) -> Dict[str, Dict[str, int]]:
+        """Fetch fee history and recompute fees for every level"""
+        levels = list(self.percentiles)
+        try:
+            history = self.dex.w3.eth.fee_history(self.block_count, 'latest', [self.percentiles[level] for level in levels])
+            base_fees = history.get('baseFeePerGas') or []
+        except Exception:
+            base_fees = []
+        
+        if base_fees and base_fees[-1]:
+            # Last entry is the base fee of the next block
+            base_fee = base_fees[-1]
+            rewards = history.get('reward') or []
+            fees = {}
+            for i, level in enumerate(levels):
+                tips = sorted(reward[i] for reward in rewards if len(reward) > i)
+                tip = tips[len(tips) // 2] if tips else 0
+                fees[level] = {
+                    'maxFeePerGas': int(base_fee * self.base_fee_multiplier) + tip,
+                    'maxPriorityFeePerGas': tip
+                }
+        else:
+            gas_price = self.dex.w3.eth.gas_price
+            fees = {level: {'gasPrice': gas_price} for level in levels}
+        
+        with self._lock:
+            self._fees = fees
+            self._updated = time.monotonic()
+        return fees
+    
+    def get_fees(self, level: str = 'medium') -> Dict[str, int]:
+        """Fee fields for a transaction, from memory unless the cache is empty or stale"""
+        if level not in self.percentiles:
+            raise ValueError(f"Unknown fee level: {level}")
+        
+        with self._lock:
+            self._last_used = time.monotonic()
+        self.start()
+        with self._lock:
+            fees = self._fees
+            stale = time.monotonic() - self._updated > 3 * self.refresh_interval
+        if fees is None or stale:
+            fees = self.refresh()
+        return dict(fees[level])
+    
+    def start(self):
+        """Start the background refresh thread if it is not running"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+    
+    def stop(self):
+        """Stop the background refresh thread"""
+        self._stop.set()
+    
+    def _run(self):
+        while not self._stop.wait(self.refresh_interval):
+            with self._lock:
+                if time.monotonic() - self._last_used > self.idle_timeout:
+                    # Idle: exit, the next get_fees() starts a new thread
+                    if self._thread is threading.current_thread():
+                        self._thread = None
+                    return
+            try:
+                self.refresh()
+            except Exception:
+                # Keep serving the last fees; get_fees refreshes inline once they go stale
+                pass
+
+
+class WalletStream:
+    """Keeps positions_cache and approvals_cache live for tracked wallets.
+    
+    Follows new heads and the wallets' Transfer/Approval logs, over a
+    websocket subscription when `ws_url` is set and otherwise by polling
+    log filters in one JSON-RPC batch per interval. Each log is applied as a
+    delta to the cached position or approval, so nothing is rescanned.
+    Callbacks (plain functions or coroutines) get one event per change:
+        
+        {'type': 'head', 'block': 19000001}
+        {'type': 'balance', 'wallet': ..., 'token': ..., 'position': {...}}
+        {'type': 'approval', 'wallet': ..., 'token': ..., 'approval': {...}}
+    """
+    
+    def __init__(self, dex: Any, wallets: Optional[List[str]] = None, poll_interval: float = 2.0,
+                 ws_url: Optional[str] = None):
+        self.dex = dex
+        self.wallets = [checksum(wallet) for wallet in (wallets or [dex.address])]
+        self.poll_interval = poll_interval
+        self.ws_url = ws_url
+        self.head = None
+        self.callbacks = []
+        self.running = False
+        self._seed_block = None
+        self._filters = None
+        self._lock = threading.Lock()
+    
+    def on_change(self, callback: Any):
+        """Register a callback for change events"""
+        self.callbacks.append(callback)
+        return callback
+    
+    def stop(self):
+        """Stop after the current poll or message"""
+        self.running = False
+    
+    async def run(self):
+        """Follow the chain until stop() is called"""
+        self.running = True
+        if self.ws_url:
+            await self._run_websocket()
+        else:
+            await self._run_polling()
+    
+    def seed(self) -> int:
+        """Load positions for every tracked wallet at the current head; returns that block"""
+        with self.dex.at_block() as block:
+            for wallet in self.wallets:
+                tokens = self.dex.get_wallet_tokens(wallet)
+                results = self.dex.get_token_positions(wallet, tokens)
+                self.dex.positions_cache[wallet] = [
+                    position for position in results.values()
+                    if not isinstance(position, Exception) and position['balance'] > 0
+                ]
+        self.head = block
+        return block
+    
+    def log_topics(self) -> List[List[Any]]:
+        """Topic filters covering Transfers from/to and Approvals by the tracked wallets"""
+        wallet_topics = ['0x' + '0' * 24 + wallet[2:].lower() for wallet in self.wallets]
+        return [
+            [[TRANSFER_TOPIC, APPROVAL_TOPIC], wallet_topics],
+            [TRANSFER_TOPIC, None, wallet_topics]
+        ]
+    
+    def apply_head(self, block_number: int) -> List[Dict[str, Any]]:
+        """Record a new head, dropping block-scoped read caches"""
+        if self.head is not None and block_number <= self.head:
+            return []
+        self.head = block_number
+        self.dex.set_head(block_number)
+        return [{'type': 'head', 'block': block_number}]
+    
+    def apply_logs(self, logs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Apply Transfer/Approval logs as deltas to the caches, returning change events"""
+        events = []
+        spent = set()
+        with self._lock:
+            for log in logs:
+                topics = [topic if isinstance(topic, str) else web3.Web3.to_hex(topic) for topic in log.get('topics', [])]
+                if len(topics) < 3:
+                    continue
+                block_number = log.get('blockNumber')
+                if isinstance(block_number, str):
+                    block_number = int(block_number, 16)
+                # Logs already covered by the seed (websocket subscriptions start before it)
+                if block_number is not None and self._seed_block is not None and block_number <= self._seed_block:
+                    continue
+                
+                token = checksum(log['address'])
+                data = log.get('data', '0x')
+                value = int(data if isinstance(data, str) else web3.Web3.to_hex(data), 16) if data not in ('0x', b'') else 0
+                sign = -1 if log.get('removed') else 1
+                source = checksum('0x' + topics[1][-40:])
+                target = checksum('0x' + topics[2][-40:])
+                
+                if topics[0] == APPROVAL_TOPIC:
+                    if source in self.wallets and not log.get('removed'):
+                        events.append(self._set_allowance(source, token, target, value))
+                    continue
+                
+                if topics[0] != TRANSFER_TOPIC:
+                    continue
+                if source in self.wallets:
+                    events.append(self._add_balance(source, token, -sign * value))
+                    spent.add((source, token))
+                if target in self.wallets:
+                    events.append(self._add_balance(target, token, sign * value))
+        
+        # transferFrom lowers allowances without an Approval log: re-read cached spenders of spent tokens
+        for wallet, token in spent:
+            events.extend(self._refresh_allowances(wallet, token))
+        return [event for event in events if event is not None]
+    
+    def _add_balance(self, wallet: str, token: str, delta: int) -> Optional[Dict[str, Any]]:
+        positions = self.dex.positions_cache.setdefault(wallet, [])
+        position = next((item for item in positions if checksum(item['address']) == token), None)
+        balance = int(position['raw_balance']) if position else 0
+        balance = max(balance + delta, 0)
+        
+        metadata = position or self.dex.get_token_metadata(token)
+        updated = format_position(token, balance, metadata, int(time.time()))
+        if position is not None:
+            positions.remove(position)
+        if balance > 0:
+            positions.append(updated)
+        return {'type': 'balance', 'wallet': wallet, 'token': token, 'position': updated}
+    
+    def _set_allowance(self, wallet: str, token: str, spender: str, allowance: int) -> Dict[str, Any]:
+        approvals = self.dex.approvals_cache.setdefault(f"{token}_{wallet}", [])
+        existing = next((item for item in approvals if checksum(item['spender']) == spender), None)
+        
+        approval = format_approval(token, spender, allowance, self.dex.get_token_metadata(token), int(time.time()))
+        names = {checksum(address): name for name, address in self.dex.contracts.items()}
+        approval['spender_name'] = existing.get('spender_name', names.get(spender, spender)) if existing else names.get(spender, spender)
+        if existing is not None:
+            approvals[approvals.index(existing)] = approval
+        else:
+            approvals.append(approval)
+        return {'type': 'approval', 'wallet': wallet, 'token': token, 'approval': approval}
+    
+    def _refresh_allowances(self, wallet: str, token: str) -> List[Dict[str, Any]]:
+        approvals = self.dex.approvals_cache.get(f"{token}_{wallet}")
+        if not approvals:
+            return []
+        
+        results = self.dex.get_token_approvals(wallet, token, [item['spender'] for item in approvals])
+        events = []
+        for item in approvals:
+            current = results.get(item['spender'])
+            if isinstance(current, Exception) or current['raw_allowance'] == item['raw_allowance']:
+                continue
+            with self._lock:
+                events.append(self._set_allowance(wallet, token, checksum(item['spender']),
+                                                  int(current['raw_allowance'])))
+        return events
+    
+    async def _emit(self, events: List[Dict[str, Any]]):
+        for event in events:
+            for callback in self.callbacks:
+                result = callback(event)
+                if asyncio.iscoroutine(result):
+                    await result
+    
+    async def _run_polling(self):
+        """Poll eth_blockNumber and log filter changes in one batch per interval"""
+        loop = asyncio.get_running_loop()
+        self._seed_block = await loop.run_in_executor(None, self.seed)
+        last_block = self._seed_block
+        
+        try:
+            while self.running:
+                polled = await loop.run_in_executor(None, self._poll, last_block)
+                if polled is None:
+                    continue
+                head, logs = polled
+                
+                events = await loop.run_in_executor(None, self.apply_logs, logs)
+                if logs:
+                    last_block = max(last_block, int(logs[-1]['blockNumber'], 16))
+                if head is not None:
+                    events = self.apply_head(head) + events
+                await self._emit(events)
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            self._uninstall_filters()
+    
+    def _poll(self, last_block: int) -> Optional[tuple]:
+        """One batched round of head and filter changes; None if the filters had to be reinstalled.
+        
+        `last_block` is the newest block whose logs were applied, so
+        reinstalled filters resume right after it without repeating logs.
+        """
+        if self._filters is None:
+            self._install_filters(last_block + 1)
+        
+        with self.dex.batch() as batch:
+            head = batch.add('eth_blockNumber', [], lambda value: int(value, 16))
+            changes = [batch.add('eth_getFilterChanges', [filter_id]) for filter_id in self._filters]
+        
+        if any(item.error is not None for item in changes):
+            # The node dropped a filter (expired or restarted): reinstall after the last applied block
+            self._filters = None
+            return None
+        
+        logs = sorted(
+            (log for item in changes for log in item.value or []),
+            key=lambda log: (int(log['blockNumber'], 16), int(log['logIndex'], 16))
+        )
+        return (head.value if head.error is None else None, logs)
+    
+    def _install_filters(self, from_block: int):
+        with self.dex.batch() as batch:
+            pending = [
+                batch.add('eth_newFilter', [{'fromBlock': hex(from_block), 'topics': topics}])
+                for topics in self.log_topics()
+            ]
+        self._filters = [item.result() for item in pending]
+    
+    def _uninstall_filters(self):
+        if self._filters is None:
+            return
+        try:
+            with self.dex.batch() as batch:
+                for filter_id in self._filters:
+                    batch.add('eth_uninstallFilter', [filter_id])
+        except Exception:
+            pass
+        self._filters = None
+    
+    async def _run_websocket(self):
+        """Subscribe to newHeads and wallet logs over a persistent websocket"""
+        from web3 import AsyncWeb3
+        from web3.providers import WebsocketProviderV2
+        
+        loop = asyncio.get_running_loop()
+        async with AsyncWeb3.persistent_websocket(WebsocketProviderV2(self.ws_url)) as w3:
+            head_subscription = await w3.eth.subscribe('newHeads')
+            for topics in self.log_topics():
+                await w3.eth.subscribe('logs', {'topics': topics})
+            # Subscribe first, then seed: logs at or below the seed block are skipped
+            self._seed_block = await loop.run_in_executor(None, self.seed)
+            
+            async for message in w3.ws.process_subscriptions():
+                result = message['result']
+                if message['subscription'] == head_subscription:
+                    number = result['number']
+                    events = self.apply_head(int(number, 16) if isinstance(number, str) else number)
+                else:
+                    events = await loop.run_in_executor(None, self.apply_logs, [result])
+                await self._emit(events)
+                if not self.running:
+                    break
+
+
+class ChainScheduler:
+    """Shared worker pool with a concurrency budget per chain.
+    
+    Tasks over a chain's budget wait in that chain's own queue instead of the
+    pool, so a slow chain never holds more than its budget of workers and the
+    other chains keep making progress.
+    """
+    
+    def __init__(self, budgets: Optional[Dict[str, int]] = None, max_workers: Optional[int] = None,
+                 default_budget: int = 4):
+        self.budgets = dict(budgets or {})
+        self.default_budget = default_budget
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or 32)
+        self._queues = {}
+        self._running = {}
+        self._completed = {}
+        self._lock = threading.Lock()
+    
+    def set_budget(self, chain: str, budget: int):
+        """Change how many tasks a chain may run at once"""
+        with self._lock:
+            self.budgets[chain] = budget
+        self._dispatch(chain)
+    
+    def submit(self, chain: str, fn: Any, *args: Any, **kwargs: Any) -> Future:
+        """Queue fn(*args, **kwargs) under a chain's budget"""
+        future = Future()
+        with self._lock:
+            self._queues.setdefault(chain, deque()).append((future, fn, args, kwargs))
+        self._dispatch(chain)
+        return future
+    
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Budget, running, queued and completed task counts per chain"""
+        with self._lock:
+            return {
+                chain: {
+                    'budget': self.budgets.get(chain, self.default_budget),
+                    'running': self._running.get(chain, 0),
+                    'queued': len(queue),
+                    'completed': self._completed.get(chain, 0)
+                }
+                for chain, queue in self._queues.items()
+            }
+    
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+    
+    def _dispatch(self, chain: str):
+        """Start queued tasks while the chain is under its budget"""
+        while True:
+            with self._lock:
+                queue = self._queues.get(chain)
+                if not queue or self._running.get(chain, 0) >= self.budgets.get(chain, self.default_budget):
+                    return
+                task = queue.popleft()
+                self._running[chain] = self._running.get(chain, 0) + 1
+            self._executor.submit(self._run, chain, *task)
+    
+    def _run(self, chain: str, future: Future, fn: Any, args: tuple, kwargs: Dict[str, Any]):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            with self._lock:
+                self._running[chain] -= 1
+                self._completed[chain] = self._completed.get(chain, 0) + 1
+            self._dispatch(chain)
+
+
+class DEXExchange(Exchange):
+    # Contract ABIs, shared by every instance
+    erc20_abi = ERC20_ABI
+    router_abi = ROUTER_ABI
+    
     def __init__(self, config: Dict[str, Any] = None):
         if config is None:
             config = {}
         
-        super().__init__(config)
+        super().__init__(config)
+        
+        self.id = 'dex'
+        self.name = 'Custom DEX'
+        self.version = '1.0'
+        self.rateLimit = 1000
+        
+        # Chain preset (chain id, PoA flag, routers, tokens); explicit config keys win
+        self.chain = config.get('chain')
+        if self.chain is not None and self.chain not in CHAIN_PRESETS:
+            raise ValueError(f"Unknown chain: {self.chain}")
+        preset = CHAIN_PRESETS.get(self.chain, {})
+        
+        # RPC settings; the Web3 client is only built on first use of self.w3
+        self.rpc_config = {key: config[key] for key in RPC_CONFIG_KEYS if key in config}
+        self.rpc_config.setdefault('rpcUrl', 'https://mainnet.infura.io/v3/YOUR_INFURA_KEY')
+        self.rpc_config['poa'] = config.get('poa', preset.get('poa', False))
+        self._w3 = None
+        self._w3_lock = threading.Lock()
+        
+        # RPC metrics: True, or an RPCMetrics shared with other instances
+        metrics = config.get('metrics')
+        self.metrics = (metrics if isinstance(metrics, RPCMetrics) else RPCMetrics()) if metrics else None
+        
+        # Provider pool: True for the process-wide PROVIDER_POOL, or a ProviderPool shared with other instances
+        provider_pool = config.get('providerPool')
+        self.provider_pool = (provider_pool if isinstance(provider_pool, ProviderPool) else PROVIDER_POOL) if provider_pool else None
+        
+        # Multicall setup (batched reads)
+        self.use_multicall = config.get('useMulticall', True)
+        self.multicall_address = config.get('multicallAddress', MULTICALL3_ADDRESS)
+        self.multicall_chunk_size = config.get('multicallChunkSize', 500)
+        
+        # Wallet setup (the account is derived from the key on first use)
+        self.private_key = config.get('privateKey')
+        self._account = None
+        self._address = None
+        
+        # Common DEX contract addresses
+        self.contracts = dict(config.get('routers') or preset.get('routers') or DEX_CONTRACTS)
+        
+        # Contract instances (the ABIs themselves are class attributes)
+        self.contract_registry = ContractRegistry()
+        
+        # Cache for positions and approvals
+        self.positions_cache = {}
+        self.approvals_cache = {}
+        self.approval_errors = {}
+        
+        # Token metadata cache (decimals/symbol/name never change)
+        self.token_metadata = config.get('tokenCache') or TokenMetadataCache(
+            config.get('tokenCacheSize', 10000),
+            config.get('tokenCachePath')
+        )
+        self._chain_id = config.get('chainId', preset.get('chainId'))
+        
+        # Common token addresses (mainnet unless a chain preset is given)
+        self.common_tokens = dict(config.get('tokens') or preset.get('tokens') or COMMON_TOKENS)
+        
+        # Local AMM engine for V2-style pool quotes
+        self.amm = AMMEngine()
+        self.factories = dict(config.get('factories', {}))
+        self._pool_pairs_checked = set()
+        
+        # Transaction pipeline (local nonces, background receipt polling)
+        self.tx_pipeline = TransactionPipeline(
+            self,
+            poll_interval=config.get('receiptPollInterval', 1.0),
+            timeout=config.get('receiptTimeout', 300)
+        )
+        
+        # Block-pinned reads: cache keyed by (block, to, calldata), dropped on each new head.
+        # at_block() pins per thread/task, so concurrent pins on a shared instance do not mix.
+        self.block_identifier = config.get('blockIdentifier')
+        self._pinned_block = contextvars.ContextVar(f'dex_pinned_block_{id(self)}', default=None)
+        self.call_cache = {}
+        self.call_cache_head = None
+        self._call_cache_lock = threading.Lock()
+        
+        # Live updates (websocket subscriptions, or polled log filters)
+        self.ws_url = config.get('wsUrl')
+        self.stream_poll_interval = config.get('streamPollInterval', 2.0)
+        self._streams = weakref.WeakSet()
+        
+        # Fees and gas limits, served from memory when building transactions
+        self.fee_oracle = FeeOracle(
+            self,
+            refresh_interval=config.get('feeRefreshInterval', 12),
+            block_count=config.get('feeHistoryBlocks', 20),
+            percentiles=config.get('feePercentiles'),
+            base_fee_multiplier=config.get('baseFeeMultiplier', 2),
+            idle_timeout=config.get('feeIdleTimeout')
+        )
+        self.gas_margin = config.get('gasMargin', 1.2)
+        self.gas_estimates = {}
+        self._gas_lock = threading.Lock()
+        
+        # Market discovery snapshot (factory pair lists, reused across restarts)
+        self.markets_snapshot_path = config.get('marketsSnapshotPath')
+        self.markets_snapshot = None
         
-        self.id = 'dex'
-        self.name = 'Custom DEX'
-        self.version = '1.0'
-        self.rateLimit = 1000
+        # Event-log indexer for wallet token/spender discovery (opt-in)
+        self.log_indexer = config.get('logIndexer')
+        if self.log_indexer is None and (config.get('useLogIndexer') or config.get('indexerPath')):
+            self.log_indexer = LogIndexer(
+                config.get('indexerPath'),
+                start_block=config.get('indexerStartBlock', 0),
+                chunk_size=config.get('indexerChunkSize', 2000),
+                confirmations=config.get('indexerConfirmations', 0),
+                max_retries=config.get('indexerMaxRetries', 5),
+                backoff=config.get('indexerBackoff', 1.0)
+            )
+        
+        # Optional OpenTelemetry-style tracer: one span per public method call
+        self.tracer = config.get('tracer')
+        if self.tracer is not None:
+            self._trace_methods()
+
+    # Connection
+    @property
+    def w3(self) -> Any:
+        """Web3 client, built on first use (or taken from provider_pool)"""
+        if self._w3 is None:
+            with self._w3_lock:
+                if self._w3 is None:
+                    if self.provider_pool is not None:
+                        self._w3 = self.provider_pool.get(self._provider_key(), self._connect)
+                    else:
+                        self._w3 = self._connect()
+        return self._w3
+    
+    @w3.setter
+    def w3(self, w3: Any):
+        self._w3 = w3
+    
+    @property
+    def account(self) -> Any:
+        """Local account for privateKey, derived on first use"""
+        if self._account is None and self.private_key:
+            self._account = account_from_key(self.private_key)
+        return self._account
+    
+    @account.setter
+    def account(self, account: Any):
+        self._account = account
+    
+    @property
+    def address(self) -> Optional[str]:
+        """Wallet address: set explicitly, or the address of privateKey"""
+        if self._address is None and self.private_key:
+            self._address = self.account.address
+        return self._address
+    
+    @address.setter
+    def address(self, address: Optional[str]):
+        self._address = address
+    
+    def close(self):
+        """Stop the threads and pools this exchange owns.
+        
+        That is the fee refresher, the receipt poller, wallet streams from
+        subscribe_wallets and the RPCPool hedging threads. A client taken from
+        provider_pool is shared with other exchanges, so it is left open.
+        """
+        self.fee_oracle.stop()
+        self.tx_pipeline.close()
+        for stream in list(self._streams):
+            stream.stop()
+        if self._w3 is not None and self.provider_pool is None:
+            close_provider = getattr(self._w3.provider, 'close', None)
+            if close_provider is not None:
+                close_provider()
+    
+    def _connect(self) -> Any:
+        """Build the provider stack and its Web3 client (a list of endpoints is routed through an RPCPool)"""
+        rpc_url = self.rpc_config['rpcUrl']
+        if isinstance(rpc_url, (list, tuple)) and len(rpc_url) > 1:
+            provider = providers.RPCPool(
+                [self._rpc_endpoint(endpoint, self.rpc_config) for endpoint in rpc_url],
+                hedge_after=self.rpc_config.get('rpcHedgeAfter', 0.5)
+            )
+        else:
+            rpc_url = rpc_url[0] if isinstance(rpc_url, (list, tuple)) else rpc_url
+            provider = self._rpc_endpoint(rpc_url, self.rpc_config).provider
         
-        # Web3 setup
-        rpc_url = config.get('rpcUrl', 'https://mainnet.infura.io/v3/YOUR_INFURA_KEY')
-        self.w3 = Web3(Web3.HTTPProvider(rpc_url))
+        if self.metrics is not None:
+            provider = providers.InstrumentedProvider(provider, self.metrics)
+        w3 = web3.Web3(provider)
         
         # Add middleware for PoA chains if needed
-        if config.get('poa', False):
-            self.w3.middleware_onion.inject(geth_poa_middleware, layer=0)
+        if self.rpc_config['poa']:
+            w3.middleware_onion.inject(web3.middleware.geth_poa_middleware, layer=0)
+        return w3
+    
+    def _provider_key(self) -> tuple:
+        """Pool key: equal RPC settings and the same metrics share one client"""
+        return json.dumps(self.rpc_config, sort_keys=True, default=str), id(self.metrics)
+    
+    def _rpc_endpoint(self, endpoint: Any, config: Dict[str, Any]) -> RPCEndpoint:
+        """Build an endpoint from a URL or a {'url', 'rateLimit', 'burst'} dict"""
+        if isinstance(endpoint, str):
+            endpoint = {'url': endpoint}
+        provider = providers.BatchHTTPProvider(
+            endpoint['url'],
+            batch_size=config.get('rpcBatchSize', 100),
+            batch_window=config.get('rpcBatchWindow', 0.0)
+        )
+        return RPCEndpoint(
+            provider,
+            rate_limit=endpoint.get('rateLimit', config.get('rpcRateLimit', 0)),
+            burst=endpoint.get('burst'),
+            max_failures=config.get('rpcMaxFailures', 3),
+            cooldown=config.get('rpcCooldown', 10.0)
+        )
+
+    # DeFi Positions Management
+    def fetch_positions(self, symbols: Optional[List[str]] = None, params: Dict = None) -> List[Dict[str, Any]]:
+        """Fetch DeFi positions for the connected wallet (params: block_identifier)"""
+        if params is None:
+            params = {}
         
-        # Wallet setup
-        self.private_key = config.get('privateKey')
-        if self.private_key:
-            self.account = self.w3.eth.account.from_key(self.private_key)
-            self.address = self.account.address
+        if not self.address:
+            raise ValueError("Wallet not configured")
+        
+        if params.get('block_identifier') is not None:
+            with self.at_block(params['block_identifier']):
+                return self.fetch_positions(symbols, dict(params, block_identifier=None))
+        
+        try:
+            positions = []
+            tokens_to_check = symbols or self.get_wallet_tokens(self.address)
+            results = self.get_token_positions(self.address, tokens_to_check)
+            
+            for token_address in tokens_to_check:
+                position = results[token_address]
+                if isinstance(position, Exception):
+                    print(f"Error fetching position for {token_address}: {position}")
+                    if self.metrics is not None:
+                        self.metrics.record_failure('fetch_positions', position)
+                    continue
+                if position['balance'] > 0:
+                    positions.append(position)
+            
+            # Cache positions
+            self.positions_cache[self.address] = positions
+            
+            return positions
+        except Exception as e:
+            raise Exception(f"Failed to fetch positions: {str(e)}")
+    
+    def get_token_position(self, address: str, token_address: str) -> Dict[str, Any]:
+        """Get detailed position for a specific token"""
+        position = self.get_token_positions(address, [token_address])[token_address]
+        if isinstance(position, Exception):
+            raise Exception(f"Failed to get token position: {str(position)}")
+        return position
+    
+    def get_token_positions(self, address: str, token_addresses: List[str]) -> Dict[str, Any]:
+        """Get positions for many tokens in batched reads, keyed by token address.
+        
+        Tokens whose calls fail map to the exception instead of a position.
+        """
+        metadata, missing = split_cached_metadata(self.token_metadata, self.get_chain_id(), token_addresses)
+        
+        # Balances and any uncached metadata go out in the same batch
+        results = self.multicall(position_calls(checksum(address), token_addresses, missing))
+        metadata.update(self._store_metadata(missing, results[len(token_addresses):]))
+        return parse_positions(token_addresses, results, metadata, int(time.time()))
+    
+    def get_liquidity_positions(self, address: str, params: Dict = None) -> List[Dict[str, Any]]:
+        """Get V2-style LP positions with their underlying token amounts.
+        
+        Candidate pairs are params['pairs'], else every pair the exchange
+        knows: the markets snapshot, loaded pools and (with a log indexer)
+        tokens the wallet has received. If none are known, pools between
+        common tokens are discovered first. Reads are pinned to one block and
+        batched, so a whole LP book costs a constant number of round trips:
+        LP balances, then totalSupply/getReserves of the pairs held (plus
+        token0/token1/factory for pairs not seen before), then any missing
+        token metadata. Amounts are exact integer math, using the array path
+        above LP_VECTOR_THRESHOLD positions when numpy is available.
+        params: pairs, dexes, block_identifier, vectorized (True/False to force).
+        """
+        if params is None:
+            params = {}
+        
+        try:
+            owner = checksum(address)
+            candidates = self._lp_candidates(owner, params)
+            pairs = list(candidates)
+            
+            with self.at_block(params.get('block_identifier') or self.current_block()) as block:
+                # LP token balances of every candidate
+                held = []
+                for pair, (ok, data) in zip(pairs, self.multicall([(pair, encode_balance_of(owner)) for pair in pairs])):
+                    if ok and len(data) >= 32 and decode_uint(data) > 0:
+                        held.append((pair, decode_uint(data)))
+                if not held:
+                    return []
+                
+                # Supply and reserves of held pairs, plus tokens and factory for pairs not seen before
+                calls = []
+                for pair, _ in held:
+                    calls.extend([(pair, TOTAL_SUPPLY_SELECTOR), (pair, GET_RESERVES_SELECTOR)])
+                    if candidates[pair] is None:
+                        calls.extend([(pair, TOKEN0_SELECTOR), (pair, TOKEN1_SELECTOR), (pair, FACTORY_SELECTOR)])
+                results = iter(self.multicall(calls))
+                
+                factory_names = None
+                rows = []
+                for pair, balance in held:
+                    (ok_supply, supply), (ok_reserves, reserves) = next(results), next(results)
+                    info = candidates[pair]
+                    if info is None:
+                        (ok0, token0), (ok1, token1), (ok_factory, factory) = next(results), next(results), next(results)
+                        if not (ok0 and ok1) or len(token0) < 32 or len(token1) < 32:
+                            # Not a pair (e.g. a plain token from the log indexer)
+                            continue
+                        dex = None
+                        if ok_factory and len(factory) >= 32:
+                            if factory_names is None:
+                                factory_names = {checksum(factory_address): name for name, factory_address in self.get_factories().items()}
+                            dex = factory_names.get(checksum(factory[12:32]))
+                        info = (checksum(token0[12:32]), checksum(token1[12:32]), dex)
+                    if not (ok_supply and ok_reserves) or len(supply) < 32 or len(reserves) < 64:
+                        continue
+                    reserve0, reserve1, _ = eth_abi.decode(['uint112', 'uint112', 'uint32'], reserves)
+                    rows.append((pair, info, balance, decode_uint(supply), reserve0, reserve1))
+                
+                metadata = self.get_tokens_metadata(list(set(token for row in rows for token in row[1][:2])))
+            
+            # Underlying amounts in exact integer math
+            vectorized = params.get('vectorized')
+            if vectorized is None:
+                vectorized = np is not None and len(rows) >= LP_VECTOR_THRESHOLD
+            if vectorized:
+                amounts0, amounts1 = get_lp_amounts_array(*[[row[i] for row in rows] for i in range(2, 6)])
+                amounts = [(int(amount0), int(amount1)) for amount0, amount1 in zip(amounts0, amounts1)]
+            else:
+                amounts = [get_lp_amounts(*row[2:6]) for row in rows]
+            
+            positions = []
+            timestamp = int(time.time())
+            for (pair, (token0, token1, dex), balance, total_supply, reserve0, reserve1), (amount0, amount1) in zip(rows, amounts):
+                if isinstance(block, int):
+                    self.amm.update_reserves(pair, reserve0, reserve1, block)
+                    self.amm.set_total_supply(pair, total_supply)
+                meta0, meta1 = metadata[token0], metadata[token1]
+                if isinstance(meta0, Exception) or isinstance(meta1, Exception):
+                    error = meta0 if isinstance(meta0, Exception) else meta1
+                    print(f"Error fetching LP position for {pair}: {error}")
+                    if self.metrics is not None:
+                        self.metrics.record_failure('get_liquidity_positions', error)
+                    continue
+                positions.append({
+                    'symbol': f"{meta0['symbol']}/{meta1['symbol']}",
+                    'pair': pair,
+                    'dex': dex,
+                    'token0': token0,
+                    'token1': token1,
+                    'balance': Amount(balance, 18),
+                    'raw_balance': str(balance),
+                    'total_supply': str(total_supply),
+                    'share': Decimal(balance) / Decimal(total_supply) if total_supply else Decimal(0),
+                    'amount0': Amount(amount0, meta0['decimals']),
+                    'amount1': Amount(amount1, meta1['decimals']),
+                    'raw_amount0': str(amount0),
+                    'raw_amount1': str(amount1),
+                    'reserve0': str(reserve0),
+                    'reserve1': str(reserve1),
+                    'block': block if isinstance(block, int) else None,
+                    'timestamp': timestamp
+                })
+            
+            return positions
+        except Exception as e:
+            raise Exception(f"Failed to get liquidity positions: {str(e)}")
+    
+    def _lp_candidates(self, owner: str, params: Dict) -> Dict[str, Optional[tuple]]:
+        """Candidate LP pairs: pair address -> (token0, token1, dex), or None if not seen before"""
+        dexes = params.get('dexes')
+        known = {}
+        if self.markets_snapshot:
+            for name, entry in self.markets_snapshot['factories'].items():
+                for item in entry['pairs']:
+                    if item:
+                        known[item[0]] = (item[1], item[2], name)
+        for pair, pool in self.amm.pools.items():
+            known[pair] = (pool['token0'], pool['token1'], pool['dex'])
+        
+        if params.get('pairs'):
+            candidates = {checksum(pair): known.get(checksum(pair)) for pair in params['pairs']}
         else:
-            self.account = None
-            self.address = None
+            if not known and self.log_indexer is None:
+                tokens = list(self.common_tokens.values())
+                pools = self.load_pools([(a, b) for i, a in enumerate(tokens) for b in tokens[i + 1:]], dexes)
+                known = {pool['pair']: (pool['token0'], pool['token1'], pool['dex']) for pool in pools}
+            candidates = dict(known)
+            if self.log_indexer is not None:
+                self.sync_wallet_index(owner)
+                for token in self.log_indexer.get_tokens(owner):
+                    candidates.setdefault(checksum(token), None)
         
-        # Common DEX contract addresses
-        self.contracts = {
-            'uniswap_v2_router': '0x7a250d5630B4cF539739dF2C5dAcb4c659F2488D',
-            'uniswap_v3_router': '0xE592427A0AEce92De3Edee1F18E0157C05861564',
-            'sushiswap_router': '0xd9e1cE17f2641f24aE83637ab66a2cca9C378B9F',
-            'pancakeswap_router': '0x10ED43C718714eb63d5aA57B78B54704E256024E',  # BSC
-        }
+        if dexes:
+            candidates = {pair: info for pair, info in candidates.items() if info is None or info[2] in dexes}
+        return candidates
+    
+    def get_staking_positions(self, address: str) -> List[Dict[str, Any]]:
+        """Get staking positions"""
+        # Implementation for various staking contracts
+        staking_positions = []
         
-        # ERC20 ABI
-        self.erc20_abi = [
-            {
-                "constant": True,
-                "inputs": [{"name": "_owner", "type": "address"}],
-                "name": "balanceOf",
-                "outputs": [{"name": "balance", "type": "uint256"}],
-                "type": "function"
-            },
-            {
-                "constant": True,
-                "inputs": [
-                    {"name": "_owner", "type": "address"},
-                    {"name": "_spender", "type": "address"}
-                ],
-                "name": "allowance",
-                "outputs": [{"name": "", "type": "uint256"}],
-                "type": "function"
-            },
-            {
-                "constant": False,
-                "inputs": [
-                    {"name": "_spender", "type": "address"},
-                    {"name": "_value", "type": "uint256"}
-                ],
-                "name": "approve",
-                "outputs": [{"name": "", "type": "bool"}],
-                "type": "function"
-            },
-            {
-                "constant": True,
-                "inputs": [],
-                "name": "decimals",
-                "outputs": [{"name": "", "type": "uint8"}],
-                "type": "function"
-            },
-            {
-                "constant": True,
-                "inputs": [],
-                "name": "symbol",
-                "outputs": [{"name": "", "type": "string"}],
-                "type": "function"
-            },
-            {
-                "constant": True,
-                "inputs": [],
-                "name": "name",
-                "outputs": [{"name": "", "type": "string"}],
-                "type": "function"
+        return staking_positions
+
+    # Token Approvals Management
+    def fetch_approvals(self, token_address: str, spender_address: Optional[str] = None,
+                        params: Dict = None) -> List[Dict[str, Any]]:
+        """Fetch token approvals for DEX routers (params: block_identifier)"""
+        if params is None:
+            params = {}
+        
+        if not self.address:
+            raise ValueError("Wallet not configured")
+        
+        if params.get('block_identifier') is not None:
+            with self.at_block(params['block_identifier']):
+                return self.fetch_approvals(token_address, spender_address, dict(params, block_identifier=None))
+        
+        try:
+            approvals = []
+            errors = {}
+            
+            if spender_address:
+                # Check specific spender
+                approval = self.get_token_approval(self.address, token_address, spender_address)
+                approvals.append(approval)
+            else:
+                # Check all common DEX routers (plus indexed spenders) in one batch
+                spenders = dict(self.contracts)
+                if self.log_indexer is not None:
+                    self.sync_wallet_index(self.address)
+                    known = set(checksum(address) for address in spenders.values())
+                    for _, spender in self.log_indexer.get_spenders(self.address, token_address):
+                        if spender not in known:
+                            spenders[spender] = spender
+                
+                results = self.get_token_approvals(self.address, token_address, list(spenders.values()))
+                for name, router_address in spenders.items():
+                    approval = results[router_address]
+                    if isinstance(approval, Exception):
+                        errors[name] = str(approval)
+                        if self.metrics is not None:
+                            self.metrics.record_failure('fetch_approvals', approval)
+                        continue
+                    approval['spender_name'] = name
+                    approvals.append(approval)
+            
+            # Cache approvals; spenders that failed are kept in approval_errors
+            cache_key = f"{token_address}_{self.address}"
+            self.approvals_cache[cache_key] = approvals
+            self.approval_errors[cache_key] = errors
+            
+            return approvals
+        except Exception as e:
+            raise Exception(f"Failed to fetch approvals: {str(e)}")
+    
+    def get_token_approval(self, owner_address: str, token_address: str, spender_address: str) -> Dict[str, Any]:
+        """Get specific token approval amount"""
+        approval = self.get_token_approvals(owner_address, token_address, [spender_address])[spender_address]
+        if isinstance(approval, Exception):
+            raise Exception(f"Failed to get token approval: {str(approval)}")
+        return approval
+    
+    def get_token_approvals(self, owner_address: str, token_address: str, spender_addresses: List[str]) -> Dict[str, Any]:
+        """Get allowances of one token for many spenders in one batch, keyed by spender.
+        
+        Spenders whose calls fail map to the exception instead of an approval.
+        """
+        token = checksum(token_address)
+        owner = checksum(owner_address)
+        calls = [(token, encode_allowance(owner, checksum(spender))) for spender in spender_addresses]
+        
+        approvals = {}
+        try:
+            metadata = self.get_token_metadata(token_address)
+            results = self.multicall(calls)
+        except Exception as e:
+            return {spender: e for spender in spender_addresses}
+        
+        timestamp = int(time.time())
+        for spender, (ok, raw_allowance) in zip(spender_addresses, results):
+            try:
+                if not ok:
+                    raise Exception("allowance reverted")
+                approvals[spender] = format_approval(
+                    token_address, spender, decode_uint(raw_allowance), metadata, timestamp
+                )
+            except Exception as e:
+                approvals[spender] = e
+        
+        return approvals
+    
+    def fetch_approval_matrix(self, tokens: Optional[List[str]] = None, spenders: Optional[List[str]] = None,
+                              owners: Optional[List[str]] = None, params: Dict = None) -> Any:
+        """Fetch the owner x token x spender allowance grid in batched calls.
+        
+        Defaults to the connected wallet, common_tokens and all DEX routers.
+        Returns a columnar dict of lists (one row per cell), or a NumPy
+        structured array with params={'format': 'numpy'}. Pass
+        params={'nonzero': True} to keep only cells with a non-zero allowance,
+        and params={'workers': n} to send multicall chunks from n threads.
+        """
+        if params is None:
+            params = {}
+        
+        workers = params.get('workers', 8)
+        tokens = tokens or list(self.common_tokens.values())
+        spenders = spenders or list(self.contracts.values())
+        owners = owners or ([self.address] if self.address else [])
+        if not owners:
+            raise ValueError("Wallet not configured")
+        
+        try:
+            metadata = self.get_tokens_metadata(tokens, workers=workers)
+            owners_checksum = [checksum(owner) for owner in owners]
+            spenders_checksum = [checksum(spender) for spender in spenders]
+            tokens_checksum = [checksum(token_address) for token_address in tokens]
+            
+            # Row order: owner, then token, then spender
+            calls = []
+            for owner in owners_checksum:
+                for token in tokens_checksum:
+                    for spender in spenders_checksum:
+                        calls.append((token, encode_allowance(owner, spender)))
+            
+            results = self.multicall(calls, workers=workers)
+            nonzero = params.get('nonzero', False)
+            columns = {
+                'owner': [], 'token': [], 'spender': [], 'symbol': [], 'decimals': [],
+                'raw_allowance': [], 'allowance': [], 'is_unlimited': [], 'ok': []
             }
+            
+            i = 0
+            for owner in owners:
+                for token_address in tokens:
+                    token_metadata = metadata[token_address]
+                    known = not isinstance(token_metadata, Exception)
+                    for spender in spenders:
+                        ok, raw = results[i]
+                        i += 1
+                        allowance = decode_uint(raw) if ok and len(raw) >= 32 else 0
+                        ok = ok and len(raw) >= 32 and known
+                        if nonzero and allowance == 0:
+                            continue
+                        decimals = token_metadata['decimals'] if known else 0
+                        columns['owner'].append(owner)
+                        columns['token'].append(token_address)
+                        columns['spender'].append(spender)
+                        columns['symbol'].append(token_metadata['symbol'] if known else '')
+                        columns['decimals'].append(decimals)
+                        columns['raw_allowance'].append(allowance)
+                        columns['allowance'].append(Amount(allowance, decimals))
+                        columns['is_unlimited'].append(allowance >= UNLIMITED_ALLOWANCE_THRESHOLD)
+                        columns['ok'].append(ok)
+            
+            if params.get('format') == 'numpy':
+                return self._approval_matrix_array(columns)
+            return columns
+        except Exception as e:
+            raise Exception(f"Failed to fetch approval matrix: {str(e)}")
+    
+    def _approval_matrix_array(self, columns: Dict[str, List[Any]]) -> Any:
+        """Pack approval matrix columns into a NumPy structured array"""
+        if np is None:
+            raise ImportError("numpy is required for format='numpy'")
+        
+        # Symbols are arbitrary token strings, so the field is as wide as the longest one
+        symbol_width = max((len(symbol) for symbol in columns['symbol']), default=1) or 1
+        dtype = [
+            ('owner', 'U42'), ('token', 'U42'), ('spender', 'U42'), ('symbol', f'U{symbol_width}'), ('decimals', 'u1'),
+            ('raw_allowance', 'O'), ('allowance', 'f8'), ('is_unlimited', '?'), ('ok', '?')
         ]
+        array = np.empty(len(columns['owner']), dtype=dtype)
+        for name, _ in dtype:
+            if name != 'allowance':
+                array[name] = columns[name]
+        array['allowance'] = amounts_array(columns['raw_allowance'], columns['decimals'], exact=False)
+        return array
+    
+    def approve_token(self, token_address: str, spender_address: str, amount: Optional[float] = None,
+                      params: Dict = None) -> Dict[str, Any]:
+        """Approve token for spending.
         
-        # Uniswap V2 Router ABI (simplified)
-        self.router_abi = [
-            {
-                "constant": True,
-                "inputs": [
-                    {"name": "amountIn", "type": "uint256"},
-                    {"name": "path", "type": "address[]"}
-                ],
-                "name": "getAmountsOut",
-                "outputs": [{"name": "amounts", "type": "uint256[]"}],
-                "type": "function"
-            },
-            {
-                "constant": False,
-                "inputs": [
-                    {"name": "amountIn", "type": "uint256"},
-                    {"name": "amountOutMin", "type": "uint256"},
-                    {"name": "path", "type": "address[]"},
-                    {"name": "to", "type": "address"},
-                    {"name": "deadline", "type": "uint256"}
-                ],
-                "name": "swapExactTokensForTokens",
-                "outputs": [{"name": "amounts", "type": "uint256[]"}],
-                "type": "function"
-            },
-            {
-                "constant": False,
-                "inputs": [
-                    {"name": "tokenA", "type": "address"},
-                    {"name": "tokenB", "type": "address"},
-                    {"name": "amountADesired", "type": "uint256"},
-                    {"name": "amountBDesired", "type": "uint256"},
-                    {"name": "amountAMin", "type": "uint256"},
-                    {"name": "amountBMin", "type": "uint256"},
-                    {"name": "to", "type": "address"},
-                    {"name": "deadline", "type": "uint256"}
-                ],
-                "name": "addLiquidity",
-                "outputs": [
-                    {"name": "amountA", "type": "uint256"},
-                    {"name": "amountB", "type": "uint256"},
-                    {"name": "liquidity", "type": "uint256"}
-                ],
-                "type": "function"
+        With params={'wait': False} this returns right after broadcast;
+        'receipt' is then a Future and 'success'/'gas_used' are None.
+        """
+        if params is None:
+            params = {}
+        
+        if not self.account:
+            raise ValueError("Private key not configured")
+        
+        try:
+            contract = self.contract(token_address)
+            
+            # Get token decimals
+            metadata = self.get_token_metadata(token_address)
+            decimals = metadata['decimals']
+            symbol = metadata['symbol']
+            
+            # Set approval amount
+            if amount is None:
+                # Unlimited approval
+                approval_amount = 2**256 - 1
+                amount_str = "unlimited"
+            else:
+                approval_amount = to_raw(amount, decimals)
+                amount_str = str(amount)
+            
+            # Build transaction
+            function = contract.functions.approve(
+                checksum(spender_address),
+                approval_amount
+            )
+            tx = function.build_transaction(self._transaction_params(function, contract.address, 100000, params))
+            
+            # Sign and send transaction
+            pending = self.tx_pipeline.submit(tx)
+            
+            result = {
+                'success': None,
+                'tx_hash': pending.tx_hash.hex(),
+                'amount': amount_str,
+                'token': symbol,
+                'spender': spender_address,
+                'gas_used': None
             }
+            if not params.get('wait', True):
+                result['receipt'] = pending
+                return result
+            
+            # Wait for confirmation
+            receipt = pending.result()
+            result.update({'success': receipt['status'] == 1, 'gas_used': receipt['gasUsed']})
+            return result
+        except Exception as e:
+            raise Exception(f"Failed to approve token: {str(e)}")
+    
+    def revoke_approval(self, token_address: str, spender_address: str, params: Dict = None) -> Dict[str, Any]:
+        """Revoke token approval"""
+        return self.approve_token(token_address, spender_address, 0, params)
+    
+    def bulk_approve(self, targets: List[tuple], params: Dict = None) -> List[Dict[str, Any]]:
+        """Set many allowances at once from (token, spender, amount) targets.
+        
+        Current allowances are read in one batched call and targets that
+        already match are skipped. The rest are signed with sequential nonces
+        and broadcast together, so they confirm in about one block. An amount
+        of None means unlimited and 0 revokes. Returns one report per target,
+        in order. With params={'wait': False}, 'receipt' holds a Future.
+        """
+        if params is None:
+            params = {}
+        
+        if not self.account:
+            raise ValueError("Private key not configured")
+        
+        try:
+            targets = [tuple(target) + (None,) * (3 - len(target)) for target in targets]
+            metadata = self.get_tokens_metadata(list(dict.fromkeys(token for token, _, _ in targets)))
+            
+            # Diff against current allowances
+            calls = []
+            for token_address, spender_address, _ in targets:
+                calls.append((checksum(token_address), encode_allowance(self.address, checksum(spender_address))))
+            current = self.multicall(calls)
+            
+            reports = []
+            txs = []
+            for (token_address, spender_address, amount), (ok, raw) in zip(targets, current):
+                token_metadata = metadata[token_address]
+                report = {
+                    'token': token_address,
+                    'spender': spender_address,
+                    'amount': "unlimited" if amount is None else str(amount),
+                    'status': None,
+                    'tx_hash': None,
+                    'success': None,
+                    'gas_used': None,
+                    'error': None
+                }
+                reports.append(report)
+                if isinstance(token_metadata, Exception):
+                    report.update({'status': 'failed', 'error': str(token_metadata)})
+                    continue
+                report['symbol'] = token_metadata['symbol']
+                
+                allowance = decode_uint(raw) if ok and len(raw) >= 32 else None
+                if amount is None:
+                    target_amount = 2**256 - 1
+                    done = allowance is not None and allowance >= UNLIMITED_ALLOWANCE_THRESHOLD
+                else:
+                    target_amount = to_raw(amount, token_metadata['decimals'])
+                    done = allowance == target_amount
+                report['current'] = None if allowance is None else Amount(allowance, token_metadata['decimals'])
+                if done:
+                    report['status'] = 'skipped'
+                    continue
+                
+                contract = self.contract(token_address)
+                function = contract.functions.approve(checksum(spender_address), target_amount)
+                txs.append((report, function.build_transaction(
+                    self._transaction_params(function, contract.address, 100000, params)
+                )))
+            
+            # Broadcast everything, then wait for all receipts together
+            submitted = self.tx_pipeline.submit_many([tx for _, tx in txs]) if txs else []
+            for (report, _), pending in zip(txs, submitted):
+                if isinstance(pending, Exception):
+                    report.update({'status': 'failed', 'error': str(pending)})
+                else:
+                    report.update({'status': 'submitted', 'tx_hash': pending.tx_hash.hex(), 'receipt': pending})
+            
+            if params.get('wait', True):
+                for report in reports:
+                    if report['status'] != 'submitted':
+                        continue
+                    try:
+                        receipt = report.pop('receipt').result()
+                        report.update({
+                            'status': 'confirmed',
+                            'success': receipt['status'] == 1,
+                            'gas_used': receipt['gasUsed']
+                        })
+                    except Exception as e:
+                        report.update({'status': 'failed', 'error': str(e)})
+            
+            return reports
+        except Exception as e:
+            raise Exception(f"Failed to bulk approve: {str(e)}")
+    
+    def bulk_revoke(self, targets: List[tuple], params: Dict = None) -> List[Dict[str, Any]]:
+        """Revoke many (token, spender) approvals at once, skipping ones already at zero"""
+        return self.bulk_approve([(token, spender, 0) for token, spender in targets], params)
+
+    # Token Metadata
+    def get_chain_id(self) -> int:
+        """Get the chain id, fetched once per instance"""
+        if self._chain_id is None:
+            self._chain_id = self.w3.eth.chain_id
+        return self._chain_id
+    
+    def get_token_metadata(self, token_address: str) -> Dict[str, Any]:
+        """Get cached decimals, symbol and name for a token"""
+        metadata = self.get_tokens_metadata([token_address])[token_address]
+        if isinstance(metadata, Exception):
+            raise Exception(f"Failed to get token metadata: {str(metadata)}")
+        return metadata
+    
+    def get_tokens_metadata(self, token_addresses: List[str], workers: Optional[int] = None) -> Dict[str, Any]:
+        """Get metadata for many tokens, fetching only cache misses in one batch.
+        
+        Tokens whose calls fail map to the exception instead of metadata.
+        """
+        metadata, missing = split_cached_metadata(self.token_metadata, self.get_chain_id(), token_addresses)
+        
+        if missing:
+            calls = [call for token_address in missing for call in metadata_calls(token_address)]
+            metadata.update(self._store_metadata(missing, self.multicall(calls, workers=workers)))
+        
+        return metadata
+    
+    def preload_token_metadata(self, token_addresses: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Warm the metadata cache, defaulting to common_tokens"""
+        return self.get_tokens_metadata(token_addresses or list(self.common_tokens.values()))
+    
+    def _store_metadata(self, token_addresses: List[str], results: List[tuple]) -> Dict[str, Any]:
+        """Decode metadata call results (three per token) and cache the successful ones"""
+        metadata = parse_metadata(token_addresses, results)
+        fetched = {token: meta for token, meta in metadata.items() if not isinstance(meta, Exception)}
+        
+        if fetched:
+            self.token_metadata.set_many(self.get_chain_id(), fetched)
+        
+        return metadata
+
+    # Multicall Batching
+    def multicall(self, calls: List[tuple], chunk_size: Optional[int] = None,
+                  workers: Optional[int] = None, block_identifier: Any = None) -> List[tuple]:
+        """Execute (target, calldata) read calls in Multicall3 aggregate3 batches.
+        
+        Returns one (success, return_data) tuple per call. Each call may fail on
+        its own without affecting the rest of the batch. With workers > 1,
+        chunks are sent from a thread pool. Calls run at `block_identifier`,
+        or the block pinned by at_block(); successful results at a numbered
+        block are cached, so only uncached calls are sent.
+        """
+        if block_identifier is None:
+            block_identifier = self.current_block()
+        if not isinstance(block_identifier, int):
+            return self._dispatch_calls(calls, chunk_size, workers, block_identifier)
+        
+        keys = [
+            (block_identifier, target.lower(), data if isinstance(data, str) else '0x' + bytes(data).hex())
+            for target, data in calls
         ]
+        with self._call_cache_lock:
+            results = [self.call_cache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if not missing:
+            return results
         
-        # Cache for positions and approvals
-        self.positions_cache = {}
-        self.approvals_cache = {}
+        fetched = self._dispatch_calls([calls[i] for i in missing], chunk_size, workers, block_identifier)
+        with self._call_cache_lock:
+            for i, result in zip(missing, fetched):
+                results[i] = result
+                # Failures may be transient (timeouts), so only successes are kept
+                if result[0]:
+                    self.call_cache[keys[i]] = result
+        return results
+    
+    def _dispatch_calls(self, calls: List[tuple], chunk_size: Optional[int], workers: Optional[int],
+                        block_identifier: Any) -> List[tuple]:
+        """Split calls into chunks and run them, optionally from a thread pool"""
+        chunk_size = chunk_size or self.multicall_chunk_size
+        chunks = [calls[start:start + chunk_size] for start in range(0, len(calls), chunk_size)]
+        results = []
+        
+        if (workers or 1) > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for chunk_results in executor.map(lambda chunk: self._multicall_chunk(chunk, block_identifier), chunks):
+                    results.extend(chunk_results)
+            return results
+        
+        for chunk in chunks:
+            results.extend(self._multicall_chunk(chunk, block_identifier))
+        
+        return results
+    
+    def _multicall_chunk(self, calls: List[tuple], block_identifier: Any = None) -> List[tuple]:
+        """Run one aggregate3 batch, splitting it if the whole batch fails"""
+        block_identifier = block_identifier if block_identifier is not None else 'latest'
+        if not self.use_multicall:
+            return self._batch_calls(calls, block_identifier)
+        
+        try:
+            result = self.w3.eth.call(
+                {'to': checksum(self.multicall_address), 'data': encode_aggregate3(calls)},
+                block_identifier
+            )
+            if not result:
+                raise web3.exceptions.BadFunctionCallOutput("Multicall3 returned no data")
+            results = decode_aggregate3(bytes(result))
+            if self.metrics is not None:
+                self.metrics.record_calls([data for _, data in calls], [success and len(data) > 0 for success, data in results])
+            return results
+        except web3.exceptions.BadFunctionCallOutput:
+            # No Multicall3 deployed on this chain, fall back to JSON-RPC batches
+            self.use_multicall = False
+            return self._batch_calls(calls, block_identifier)
+        except Exception as e:
+            # Gas limit or response size: halve and retry. Transport errors would only repeat, so raise them
+            if not is_batch_size_error(e):
+                raise
+            if len(calls) == 1:
+                return [self._single_call(*calls[0], block_identifier)]
+            middle = len(calls) // 2
+            return self._multicall_chunk(calls[:middle], block_identifier) + self._multicall_chunk(calls[middle:], block_identifier)
+    
+    def _single_call(self, target: str, data: Any, block_identifier: Any = 'latest') -> tuple:
+        """Run a single eth_call, returning (success, return_data)"""
+        try:
+            result = self.w3.eth.call({'to': checksum(target), 'data': data}, block_identifier)
+            return (True, bytes(result))
+        except Exception:
+            return (False, b'')
+    
+    def _batch_calls(self, calls: List[tuple], block_identifier: Any = 'latest') -> List[tuple]:
+        """Run (target, calldata) calls as one JSON-RPC batch, returning (success, return_data)"""
+        with self.batch() as batch:
+            pending = [batch.eth_call(checksum(target), data, block_identifier) for target, data in calls]
+        
+        results = []
+        for item in pending:
+            try:
+                results.append((True, item.result()))
+            except Exception:
+                results.append((False, b''))
+        return results
+    
+    @contextmanager
+    def batch(self):
+        """Collect raw JSON-RPC requests and send them in one POST on exit.
+            
+            with dex.batch() as batch:
+                gas_price = batch.gas_price()
+                nonce = batch.get_transaction_count(dex.address)
+            gas_price.result(), nonce.result()
+        """
+        batch = JSONRPCBatch(self.w3.provider)
+        yield batch
+        batch.execute()
+
+    # Block Snapshots
+    @contextmanager
+    def at_block(self, block_identifier: Any = None):
+        """Pin every read inside the block to one block (default: the current head).
+            
+            with dex.at_block() as block:
+                positions = dex.fetch_positions()
+                approvals = dex.fetch_approvals(dex.common_tokens['USDC'])
+        
+        Reads at a numbered block are cached, so repeating them is free until
+        a new head arrives. The pin only applies to the calling thread or
+        asyncio task, so other threads sharing the instance are not affected.
+        """
+        if block_identifier is None or block_identifier == 'latest':
+            block_identifier = self.w3.eth.block_number
+        if isinstance(block_identifier, int):
+            self.set_head(block_identifier)
+        
+        token = self._pinned_block.set(block_identifier)
+        try:
+            yield block_identifier
+        finally:
+            self._pinned_block.reset(token)
+    
+    def current_block(self) -> Any:
+        """Block pinned by at_block() in this thread or task, else the blockIdentifier default"""
+        pinned = self._pinned_block.get()
+        return pinned if pinned is not None else self.block_identifier
+    
+    def set_head(self, block_number: int) -> bool:
+        """Record the chain head, dropping the call cache if it is newer than the last one seen"""
+        with self._call_cache_lock:
+            if self.call_cache_head is not None and block_number <= self.call_cache_head:
+                return False
+            self.call_cache.clear()
+            self.call_cache_head = block_number
+            return True
+
+    # Live Updates
+    def subscribe_wallets(self, wallets: Optional[List[str]] = None, callback: Any = None,
+                          params: Dict = None) -> WalletStream:
+        """Create a WalletStream that keeps positions_cache and approvals_cache live.
+            
+            stream = dex.subscribe_wallets(callback=on_change)
+            task = asyncio.create_task(stream.run())
+        
+        Uses the `wsUrl` websocket when configured, otherwise polls log filters
+        every `streamPollInterval` seconds (params: wsUrl, pollInterval).
+        """
+        if params is None:
+            params = {}
+        
+        if not wallets and not self.address:
+            raise ValueError("Wallet not configured")
+        
+        stream = WalletStream(
+            self,
+            wallets,
+            poll_interval=params.get('pollInterval', self.stream_poll_interval),
+            ws_url=params.get('wsUrl', self.ws_url)
+        )
+        if callback is not None:
+            stream.on_change(callback)
+        self._streams.add(stream)
+        return stream
+
+    # Gas and Fees
+    def estimate_gas(self, function: Any, token: Any = None, default: Optional[int] = None) -> int:
+        """Gas limit for a contract call, memoized per (contract, selector, token, arguments) with gasMargin applied.
+        
+        See gas_estimate_key. If estimation fails (e.g. the call would revert
+        before an approval is mined), `default` is returned without being
+        memoized.
+        """
+        key = gas_estimate_key(function, token)
+        with self._gas_lock:
+            if key in self.gas_estimates:
+                return self.gas_estimates[key]
+        
+        try:
+            gas = int(function.estimate_gas({'from': self.address}) * self.gas_margin)
+        except Exception:
+            if default is None:
+                raise
+            return default
+        
+        with self._gas_lock:
+            self.gas_estimates[key] = gas
+        return gas
+    
+    def _transaction_params(self, function: Any, token: Any, default_gas: int, params: Dict = None) -> Dict[str, Any]:
+        """Fields for build_transaction that need no fee RPCs (params: gas, feeLevel)"""
+        if params is None:
+            params = {}
+        
+        tx = {
+            'from': self.address,
+            'gas': params.get('gas') or self.estimate_gas(function, token, default_gas),
+            'chainId': self.get_chain_id()
+        }
+        tx.update(self.fee_oracle.get_fees(params.get('feeLevel', 'medium')))
+        return tx
+
+    # Instrumentation
+    def _trace_methods(self):
+        """Wrap every public method defined on this class (and subclasses) in a tracer span"""
+        names = set()
+        for cls in type(self).__mro__:
+            if issubclass(cls, DEXExchange):
+                names.update(name for name, member in vars(cls).items() if callable(member) and not name.startswith('_'))
         
-        # Common token addresses (mainnet)
-        self.common_tokens = {
-    'USDC': '0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48',  # Correct USDC
-    'USDT': '0xdAC17F958D2ee523a2206206994597C13D831ec7',
-    'WBTC': '0x2260FAC5E5542a773Aa44fBCfeDf7C193bc2C599',
-    'WETH': '0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2',
-    'DAI': '0x6B175474E89094C44Da98b954EedeAC495271d0F',
-}
+        # Context managers and the contract() accessor are not worth a span
+        for name in names - {'batch', 'at_block', 'contract'}:
+            setattr(self, name, self._traced(name, getattr(self, name)))
+    
+    def _traced(self, name: str, method: Any) -> Any:
+        """`method` run inside tracer.start_as_current_span('<Class>.<name>')"""
+        span_name = f"{type(self).__name__}.{name}"
+        
+        @wraps(method)
+        def traced(*args, **kwargs):
+            with self.tracer.start_as_current_span(span_name, attributes={'dex.method': name}):
+                return method(*args, **kwargs)
+        return traced
 
-    # DeFi Positions Management
-    def fetch_positions(self, symbols: Optional[List[str]] = None) -> List[Dict[str, Any]]:
-        """Fetch DeFi positions for the connected wallet"""
-        if not self.address:
+    # Utility Functions
+    def contract(self, address: str, abi: Optional[tuple] = None) -> Any:
+        """Cached contract instance for an address (ERC20 ABI by default)"""
+        return self.contract_registry.get(self.w3, address, abi or self.erc20_abi)
+    
+    def get_wallet_tokens(self, address: str) -> List[str]:
+        """Get list of tokens in wallet (common tokens plus any found by the log indexer)"""
+        tokens = list(self.common_tokens.values())
+        
+        if self.log_indexer is not None:
+            self.sync_wallet_index(address)
+            known = set(checksum(token) for token in tokens)
+            tokens.extend(token for token in self.log_indexer.get_tokens(address) if token not in known)
+        
+        return tokens
+    
+    def sync_wallet_index(self, address: Optional[str] = None, to_block: Optional[int] = None) -> Dict[str, Any]:
+        """Index Transfer/Approval logs for a wallet up to to_block (default: latest)"""
+        if self.log_indexer is None:
+            raise ValueError("Log indexer not configured")
+        
+        address = address or self.address
+        if not address:
             raise ValueError("Wallet not configured")
         
         try:
-            positions = []
-            tokens_to_check = symbols or list(self.common_tokens.values())
-            
-            for token_address in tokens_to_check:
-                try:
-                    position = self.get_token_position(self.address, token_address)
-                    if position['balance'] > 0:
-                        positions.append(position)
-                except Exception as e:
-                    print(f"Error fetching position for {token_address}: {e}")
-                    continue
-            
-            # Cache positions
-            self.positions_cache[self.address] = positions
-            
-            return positions
+            return self.log_indexer.sync(self, address, to_block)
         except Exception as e:
-            raise Exception(f"Failed to fetch positions: {str(e)}")
+            raise Exception(f"Failed to sync wallet index: {str(e)}")
     
-    def get_token_position(self, address: str, token_address: str) -> Dict[str, Any]:
-        """Get detailed position for a specific token"""
-        contract = self.w3.eth.contract(
-            address=Web3.to_checksum_address(token_address),
-            abi=self.erc20_abi
-        )
+    def get_token_price(self, token_address: str, quote_token: Optional[str] = None) -> float:
+        """Get token price in quote_token (default USDC) from local pool reserves.
+        
+        Pools are loaded on first use; direct pools are tried first, then routes
+        through WETH. Returns 0.0 if no pool is found.
+        """
+        quote_token = quote_token or self.common_tokens['USDC']
+        if checksum(token_address) == checksum(quote_token):
+            return 1.0
         
         try:
-            # Get token info
-            balance = contract.functions.balanceOf(Web3.to_checksum_address(address)).call()
-            decimals = contract.functions.decimals().call()
-            symbol = contract.functions.symbol().call()
-            name = contract.functions.name().call()
+            weth = self.common_tokens['WETH']
+            metadata = self.get_tokens_metadata([token_address, quote_token])
+            amount_in = 10 ** metadata[token_address]['decimals']
+            quote_decimals = metadata[quote_token]['decimals']
             
-            # Format balance
-            formatted_balance = balance / (10 ** decimals)
+            paths = [[token_address, quote_token]]
+            if checksum(weth) not in (checksum(token_address),
+                                                      checksum(quote_token)):
+                paths.append([token_address, weth, quote_token])
             
-            return {
-                'symbol': symbol,
-                'name': name,
-                'address': token_address,
-                'balance': formatted_balance,
-                'raw_balance': str(balance),
-                'decimals': decimals,
-                'timestamp': int(time.time())
-            }
+            missing = [
+                (path[i], path[i + 1]) for path in paths for i in range(len(path) - 1)
+                if not self.amm.get_pools(path[i], path[i + 1])
+            ]
+            if missing:
+                self.load_pools(missing)
+            
+            for path in paths:
+                amount_out = self.amm.quote_path(path, amount_in)[-1]
+                if amount_out > 0:
+                    return amount_out / (10 ** quote_decimals)
+            return 0.0
         except Exception as e:
-            raise Exception(f"Failed to get token position: {str(e)}")
+            raise Exception(f"Failed to get token price: {str(e)}")
+
+    # Local AMM Pools
+    def get_factories(self) -> Dict[str, str]:
+        """Factory address for each V2-style router, read once via factory()"""
+        routers = [name for name in self.contracts if name in V2_ROUTER_FEES and name not in self.factories]
+        
+        if routers:
+            calls = [(checksum(self.contracts[name]), FACTORY_SELECTOR) for name in routers]
+            for name, (ok, data) in zip(routers, self.multicall(calls)):
+                # Routers not deployed on this chain return no data
+                if ok and len(data) >= 32:
+                    self.factories[name] = checksum(data[12:32])
+        
+        return {name: self.factories[name] for name in self.contracts if name in self.factories}
     
-    def get_liquidity_positions(self, address: str) -> List[Dict[str, Any]]:
-        """Get liquidity provider positions"""
-        # This would involve checking LP token balances
-        # Implementation depends on specific DEX protocols
-        lp_positions = []
+    def load_pools(self, token_pairs: List[tuple], dexes: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Discover and load pools for (token_a, token_b) pairs on every V2-style DEX.
         
-        # Example: Check Uniswap V2 LP tokens
-        # You would need to implement pair discovery and LP token checking
+        Costs two batched round trips: getPair on all factories, then
+        token0/token1/getReserves on all pairs found.
+        """
+        factories = self.get_factories()
+        if dexes:
+            factories = {name: address for name, address in factories.items() if name in dexes}
         
-        return lp_positions
+        lookups = []
+        calls = []
+        for name, factory_address in factories.items():
+            for token_a, token_b in token_pairs:
+                lookups.append(name)
+                calls.append((factory_address, encode_call(GET_PAIR_SELECTOR, token_a, token_b)))
+        
+        pairs = []
+        for name, (ok, data) in zip(lookups, self.multicall(calls)):
+            if ok and len(data) >= 32 and int.from_bytes(data, 'big') != 0:
+                pair_address = checksum(data[12:32])
+                if pair_address not in [pair for pair, _ in pairs]:
+                    pairs.append((pair_address, name))
+        
+        return self._load_pair_states(pairs)
     
-    def get_staking_positions(self, address: str) -> List[Dict[str, Any]]:
-        """Get staking positions"""
-        # Implementation for various staking contracts
-        staking_positions = []
+    def refresh_pools(self, pair_addresses: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Re-read reserves for tracked pools (default: all) in one batch"""
+        pair_addresses = pair_addresses or list(self.amm.pools.keys())
+        pairs = [(pair, self.amm.pools[pair]['dex']) for pair in pair_addresses if pair in self.amm.pools]
+        return self._load_pair_states(pairs)
+    
+    def sync_pools(self, from_block: Optional[int] = None, to_block: Optional[int] = None) -> int:
+        """Apply Sync logs for tracked pools since the last sync; returns the number applied"""
+        if not self.amm.pools:
+            return 0
         
-        return staking_positions
+        to_block = self.w3.eth.block_number if to_block is None else to_block
+        if from_block is None:
+            from_block = to_block if self.amm.last_block is None else self.amm.last_block + 1
+        if from_block > to_block:
+            return 0
+        
+        logs = self.w3.eth.get_logs({
+            'fromBlock': from_block,
+            'toBlock': to_block,
+            'address': list(self.amm.pools.keys()),
+            'topics': [SYNC_TOPIC]
+        })
+        applied = sum(1 for log in logs if self.amm.apply_sync_log(log))
+        self.amm.last_block = to_block
+        return applied
+    
+    def quote(self, token_in: str, token_out: str, amount_in: int) -> Dict[str, Any]:
+        """Quote an exact raw input amount across all loaded pools for the pair (no RPC)"""
+        return self.amm.quote(token_in, token_out, amount_in)
+    
+    def _load_pair_states(self, pairs: List[tuple]) -> List[Dict[str, Any]]:
+        """Read token0/token1/getReserves for (pair, dex) entries and store them in the AMM engine"""
+        calls = []
+        for pair_address, _ in pairs:
+            calls.append((pair_address, TOKEN0_SELECTOR))
+            calls.append((pair_address, TOKEN1_SELECTOR))
+            calls.append((pair_address, GET_RESERVES_SELECTOR))
+        
+        # Multicall3 getBlockNumber() tags the reads with the block they came from
+        calls.append((checksum(self.multicall_address), GET_BLOCK_NUMBER_SELECTOR))
+        
+        results = self.multicall(calls)
+        ok_block, raw_block = results[-1]
+        block = decode_uint(raw_block) if ok_block and self.use_multicall and len(raw_block) >= 32 else None
+        if block is not None and self.amm.last_block is None:
+            self.amm.last_block = block
+        pools = []
+        
+        for i, (pair_address, dex) in enumerate(pairs):
+            (ok0, token0), (ok1, token1), (ok_reserves, reserves) = results[i * 3:i * 3 + 3]
+            if not (ok0 and ok1 and ok_reserves) or len(reserves) < 64:
+                continue
+            reserve0, reserve1, _ = eth_abi.decode(['uint112', 'uint112', 'uint32'], reserves)
+            self.amm.add_pool(
+                pair_address,
+                checksum(token0[12:32]),
+                checksum(token1[12:32]),
+                reserve0,
+                reserve1,
+                dex=dex,
+                fee_bps=V2_ROUTER_FEES.get(dex, 30),
+                block=block
+            )
+            pools.append(self.amm.pools[checksum(pair_address)])
+        
+        return pools
 
-    # Token Approvals Management
-    def fetch_approvals(self, token_address: str, spender_address: Optional[str] = None) -> List[Dict[str, Any]]:
-        """Fetch token approvals for DEX routers"""
-        if not self.address:
-            raise ValueError("Wallet not configured")
+    # CCXT Override Methods
+    def load_markets(self, reload: bool = False, params: Dict = None) -> Dict:
+        """Load markets from V2-style factory pairs.
+        
+        With marketsSnapshotPath, pair lists are saved to a versioned snapshot.
+        Later loads (reload=False) start from it and only fetch pairs created
+        since. reload=True rediscovers every pair.
+        params: update (fetch new pairs, default True), workers (parallel
+        batches, default 8), dexes (router names to include).
+        """
+        if params is None:
+            params = {}
+        
+        if self.markets and not reload:
+            return self.markets
         
         try:
-            approvals = []
-            
-            if spender_address:
-                # Check specific spender
-                approval = self.get_token_approval(self.address, token_address, spender_address)
-                approvals.append(approval)
-            else:
-                # Check all common DEX routers
-                for name, router_address in self.contracts.items():
-                    try:
-                        approval = self.get_token_approval(self.address, token_address, router_address)
-                        approval['spender_name'] = name
-                        approvals.append(approval)
-                    except Exception as e:
-                        print(f"Error checking approval for {name}: {e}")
-                        continue
-            
-            # Cache approvals
-            cache_key = f"{token_address}_{self.address}"
-            self.approvals_cache[cache_key] = approvals
+            snapshot = None if reload else (self.markets_snapshot or self._read_markets_snapshot())
+            if snapshot is None or params.get('update', True):
+                snapshot = self._discover_pairs(snapshot, params)
+                self._write_markets_snapshot(snapshot)
+            self.markets_snapshot = snapshot
             
-            return approvals
+            return self.set_markets(self._build_markets(snapshot))
         except Exception as e:
-            raise Exception(f"Failed to fetch approvals: {str(e)}")
+            raise Exception(f"Failed to load markets: {str(e)}")
     
-    def get_token_approval(self, owner_address: str, token_address: str, spender_address: str) -> Dict[str, Any]:
-        """Get specific token approval amount"""
-        contract = self.w3.eth.contract(
-            address=Web3.to_checksum_address(token_address),
-            abi=self.erc20_abi
-        )
+    def _discover_pairs(self, snapshot: Optional[Dict[str, Any]], params: Dict) -> Dict[str, Any]:
+        """Enumerate factory allPairs beyond what the snapshot already has"""
+        workers = params.get('workers', 8)
+        factories = self.get_factories()
+        if params.get('dexes'):
+            factories = {name: address for name, address in factories.items() if name in params['dexes']}
         
-        try:
-            allowance = contract.functions.allowance(
-                Web3.to_checksum_address(owner_address),
-                Web3.to_checksum_address(spender_address)
-            ).call()
-            
-            decimals = contract.functions.decimals().call()
-            symbol = contract.functions.symbol().call()
-            
-            # Check if unlimited approval
-            max_uint256 = 2**256 - 1
-            is_unlimited = allowance >= max_uint256 // 2  # Close to max uint256
-            
-            return {
-                'token': symbol,
-                'token_address': token_address,
-                'spender': spender_address,
-                'allowance': allowance / (10 ** decimals),
-                'raw_allowance': str(allowance),
-                'decimals': decimals,
-                'is_unlimited': is_unlimited,
-                'timestamp': int(time.time())
-            }
-        except Exception as e:
-            raise Exception(f"Failed to get token approval: {str(e)}")
+        snapshot = snapshot or {
+            'version': MARKETS_SNAPSHOT_VERSION,
+            'chain_id': self.get_chain_id(),
+            'block': None,
+            'factories': {},
+            'tokens': {}
+        }
+        # Pair counts for every factory, plus the block they were read at
+        names = list(factories.keys())
+        calls = [(factories[name], ALL_PAIRS_LENGTH_SELECTOR) for name in names]
+        calls.append((checksum(self.multicall_address), GET_BLOCK_NUMBER_SELECTOR))
+        results = self.multicall(calls)
+        
+        new_pairs = []
+        for name, (ok, data) in zip(names, results):
+            entry = snapshot['factories'].setdefault(name, {'factory': factories[name], 'pairs': []})
+            if entry['factory'] != factories[name]:
+                entry.update({'factory': factories[name], 'pairs': []})
+            if not ok or len(data) < 32:
+                continue
+            for index in range(len(entry['pairs']), decode_uint(data)):
+                new_pairs.append((name, index))
+        
+        ok_block, raw_block = results[-1]
+        if ok_block and len(raw_block) >= 32:
+            snapshot['block'] = decode_uint(raw_block)
+        
+        if not new_pairs:
+            return snapshot
+        
+        # Pair addresses by index, then token0/token1 for each new pair
+        calls = [(factories[name], encode_call(ALL_PAIRS_SELECTOR, index)) for name, index in new_pairs]
+        addresses = [
+            checksum(data[12:32]) if ok and len(data) >= 32 else None
+            for ok, data in self.multicall(calls, workers=workers)
+        ]
+        calls = []
+        for pair_address in addresses:
+            target = pair_address or self.multicall_address
+            calls.append((target, TOKEN0_SELECTOR))
+            calls.append((target, TOKEN1_SELECTOR))
+        results = self.multicall(calls, workers=workers)
+        
+        new_tokens = []
+        for i, ((name, index), pair_address) in enumerate(zip(new_pairs, addresses)):
+            (ok0, token0), (ok1, token1) = results[i * 2:i * 2 + 2]
+            if pair_address is None or not (ok0 and ok1 and len(token0) >= 32 and len(token1) >= 32):
+                # Keep the index aligned with allPairs so the next delta starts at the right place
+                snapshot['factories'][name]['pairs'].append(None)
+                continue
+            token0 = checksum(token0[12:32])
+            token1 = checksum(token1[12:32])
+            snapshot['factories'][name]['pairs'].append([pair_address, token0, token1])
+            for token in (token0, token1):
+                if token not in snapshot['tokens'] and token not in new_tokens:
+                    new_tokens.append(token)
+        
+        metadata = self.get_tokens_metadata(new_tokens, workers=workers)
+        for token in new_tokens:
+            if not isinstance(metadata[token], Exception):
+                snapshot['tokens'][token] = [metadata[token]['symbol'], metadata[token]['decimals']]
+        
+        return snapshot
+    
+    def _build_markets(self, snapshot: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        """ccxt market structures from a snapshot, one market per token pair across venues"""
+        codes = {}
+        taken = {}
+        for code, address in self.common_tokens.items():
+            codes[checksum(address)] = code
+            taken[code] = checksum(address)
+        
+        def currency_code(token):
+            if token not in codes:
+                symbol = snapshot['tokens'][token][0] or token
+                # Different tokens can share a symbol; later ones get an address suffix
+                code = symbol if taken.get(symbol, token) == token else f"{symbol}-{token[2:8]}"
+                codes[token] = code
+                taken.setdefault(code, token)
+            return codes[token]
+        
+        markets = {}
+        for name, entry in snapshot['factories'].items():
+            fee = V2_ROUTER_FEES.get(name, 30) / 10000
+            for pair in entry['pairs']:
+                if pair is None:
+                    continue
+                pair_address, token0, token1 = pair
+                if token0 not in snapshot['tokens'] or token1 not in snapshot['tokens']:
+                    continue
+                base_id, quote_id = token0, token1
+                code0, code1 = currency_code(token0), currency_code(token1)
+                rank0 = QUOTE_CURRENCIES.index(code0) if code0 in QUOTE_CURRENCIES else len(QUOTE_CURRENCIES)
+                rank1 = QUOTE_CURRENCIES.index(code1) if code1 in QUOTE_CURRENCIES else len(QUOTE_CURRENCIES)
+                if rank0 < rank1:
+                    base_id, quote_id = token1, token0
+                base, quote = codes[base_id], codes[quote_id]
+                symbol = f"{base}/{quote}"
+                
+                if symbol in markets:
+                    markets[symbol]['info']['pairs'].append({'dex': name, 'pair': pair_address, 'fee': fee})
+                    continue
+                
+                markets[symbol] = {
+                    'id': pair_address,
+                    'symbol': symbol,
+                    'base': base,
+                    'quote': quote,
+                    'baseId': base_id,
+                    'quoteId': quote_id,
+                    'active': True,
+                    'type': 'spot',
+                    'spot': True,
+                    'margin': False,
+                    'swap': False,
+                    'future': False,
+                    'option': False,
+                    'contract': False,
+                    'taker': fee,
+                    'maker': fee,
+                    'precision': {
+                        'amount': snapshot['tokens'][base_id][1],
+                        'price': snapshot['tokens'][quote_id][1]
+                    },
+                    'limits': {
+                        'amount': {'min': None, 'max': None},
+                        'price': {'min': None, 'max': None},
+                        'cost': {'min': None, 'max': None}
+                    },
+                    'info': {'pairs': [{'dex': name, 'pair': pair_address, 'fee': fee}]}
+                }
+        
+        return markets
+    
+    def _read_markets_snapshot(self) -> Optional[Dict[str, Any]]:
+        """Load the snapshot if it exists and matches this version and chain"""
+        if not self.markets_snapshot_path or not os.path.exists(self.markets_snapshot_path):
+            return None
+        
+        with open(self.markets_snapshot_path) as f:
+            snapshot = json.load(f)
+        if snapshot.get('version') != MARKETS_SNAPSHOT_VERSION or snapshot.get('chain_id') != self.get_chain_id():
+            return None
+        
+        # Factory addresses are known from the snapshot, no need to ask the routers again
+        for name, entry in snapshot['factories'].items():
+            self.factories.setdefault(name, entry['factory'])
+        return snapshot
+    
+    def _write_markets_snapshot(self, snapshot: Dict[str, Any]):
+        """Atomically write the snapshot file"""
+        if not self.markets_snapshot_path:
+            return
+        
+        temp_path = self.markets_snapshot_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+        os.replace(temp_path, self.markets_snapshot_path)
+    
+    def fetch_balance(self, params: Dict = None) -> Dict[str, Any]:
+        """Fetch wallet balance in CCXT format (params: block_identifier)"""
+        if params is None:
+            params = {}
+        
+        return format_balance(self.fetch_positions(params=params))
+
+    # DEX Trading Functions
+    def find_route(self, token_in: str, token_out: str, amount_in: int, params: Dict = None) -> Dict[str, Any]:
+        """Best route for an exact raw input amount, from local reserves.
+        
+        params: maxHops (default 3), split (split across venues, default True),
+        parts (split granularity, default 10), maxRoutes (default 3).
+        """
+        if params is None:
+            params = {}
+        
+        connectors = list(self.common_tokens.values())
+        self._ensure_route_pools(token_in, token_out, connectors)
+        max_hops = params.get('maxHops', 3)
+        
+        if params.get('split', True):
+            return self.amm.find_split_route(
+                token_in, token_out, amount_in, max_hops, connectors,
+                params.get('parts', 10), params.get('maxRoutes', 3)
+            )
+        
+        routes = self.amm.find_routes(token_in, token_out, amount_in, max_hops, connectors)
+        return {'amount_in': amount_in, 'amount_out': routes[0]['amount_out'] if routes else 0, 'routes': routes[:1]}
+    
+    def _ensure_route_pools(self, token_in: str, token_out: str, connectors: List[str]):
+        """Load pools between the two tokens and the connector tokens, once per token pair"""
+        tokens = []
+        for token in [token_in, token_out] + connectors:
+            token = checksum(token)
+            if token not in tokens:
+                tokens.append(token)
+        
+        missing = []
+        for i, token_a in enumerate(tokens):
+            for token_b in tokens[i + 1:]:
+                key = tuple(sorted((token_a, token_b)))
+                if key not in self._pool_pairs_checked:
+                    missing.append(key)
+        
+        if missing:
+            self.load_pools(missing)
+            self._pool_pairs_checked.update(missing)
     
-    def approve_token(self, token_address: str, spender_address: str, amount: Optional[float] = None) -> Dict[str, Any]:
-        """Approve token for spending"""
+    def _resolve_token(self, code: str) -> str:
+        """Token address for a currency code (loaded markets or common_tokens) or an address"""
+        if web3.Web3.is_address(code):
+            return checksum(code)
+        if code in self.common_tokens:
+            return checksum(self.common_tokens[code])
+        currency = (self.currencies or {}).get(code)
+        if currency and currency.get('id'):
+            return checksum(currency['id'])
+        raise ValueError(f"Unknown token: {code}")
+    
+    def create_order(self, symbol: str, type: str, side: str, amount: float, 
+                    price: Optional[float] = None, params: Dict = None) -> Dict[str, Any]:
+        """Create order on DEX as router swaps along the best route.
+        
+        Sells are exact-input swaps and may be split across venues; buys are
+        exact-output swaps on the best single route. Limit orders use `price`
+        as the worst acceptable price instead of the slippage tolerance.
+        params: slippage (percent, default 0.5), deadline (seconds, default
+        1200), plus find_route params.
+        """
+        if params is None:
+            params = {}
+        
         if not self.account:
             raise ValueError("Private key not configured")
+        if type not in ('market', 'limit'):
+            raise ValueError(f"Unsupported order type: {type}")
+        if type == 'limit' and price is None:
+            raise ValueError("Limit orders require a price")
         
         try:
-            contract = self.w3.eth.contract(
-                address=Web3.to_checksum_address(token_address),
-                abi=self.erc20_abi
-            )
-            
-            # Get token decimals
-            decimals = contract.functions.decimals().call()
-            symbol = contract.functions.symbol().call()
+            base_code, quote_code = symbol.split('/')
+            base, quote = self._resolve_token(base_code), self._resolve_token(quote_code)
+            metadata = self.get_tokens_metadata([base, quote])
+            for token in (base, quote):
+                if isinstance(metadata[token], Exception):
+                    raise metadata[token]
+            base_decimals = metadata[base]['decimals']
+            quote_decimals = metadata[quote]['decimals']
+            amount_raw = to_raw(amount, base_decimals)
+            slippage = Decimal(str(params.get('slippage', 0.5))) / 100
+            deadline = int(time.time()) + params.get('deadline', 1200)
             
-            # Set approval amount
-            if amount is None:
-                # Unlimited approval
-                approval_amount = 2**256 - 1
-                amount_str = "unlimited"
+            if side == 'sell':
+                route = self.find_route(base, quote, amount_raw, params)
+            elif side == 'buy':
+                route = self._find_buy_route(quote, base, amount_raw, params)
             else:
-                approval_amount = int(amount * (10 ** decimals))
-                amount_str = str(amount)
+                raise ValueError(f"Unsupported side: {side}")
+            if not route['routes']:
+                raise Exception(f"No route found for {symbol}")
             
-            # Build transaction
-            tx = contract.functions.approve(
-                Web3.to_checksum_address(spender_address),
-                approval_amount
-            ).build_transaction({
-                'from': self.address,
-                'gas': 100000,
-                'gasPrice': self.w3.eth.gas_price,
-                'nonce': self.w3.eth.get_transaction_count(self.address)
-            })
+            # Re-read reserves of the pools used before committing to amounts
+            if params.get('refresh', True):
+                self.refresh_pools([pair for leg in route['routes'] for pair in leg['pairs']])
+                route = self._requote_route(route, side)
             
-            # Sign and send transaction
-            signed_tx = self.account.sign_transaction(tx)
-            tx_hash = self.w3.eth.send_raw_transaction(signed_tx.rawTransaction)
+            legs = []
             
-            # Wait for confirmation
-            receipt = self.w3.eth.wait_for_transaction_receipt(tx_hash)
+            for leg in route['routes']:
+                router_contract = self.contract(self.contracts[leg['dex']], self.router_abi)
+                if side == 'sell':
+                    if type == 'limit':
+                        min_out = int(Decimal(leg['amount_in']) * Decimal(str(price))
+                                      * (10 ** quote_decimals) / (10 ** base_decimals))
+                    else:
+                        min_out = int(Decimal(leg['amount_out']) * (1 - slippage))
+                    function = router_contract.functions.swapExactTokensForTokens(
+                        leg['amount_in'], min_out, leg['path'], self.address, deadline
+                    )
+                else:
+                    if type == 'limit':
+                        max_in = int(Decimal(leg['amount_out']) * Decimal(str(price))
+                                     * (10 ** quote_decimals) / (10 ** base_decimals))
+                    else:
+                        max_in = int(Decimal(leg['amount_in']) * (1 + slippage))
+                    function = router_contract.functions.swapTokensForExactTokens(
+                        leg['amount_out'], max_in, leg['path'], self.address, deadline
+                    )
+                
+                tx = function.build_transaction(self._transaction_params(
+                    function, tuple(leg['path']), 150000 + 100000 * (len(leg['path']) - 1), params
+                ))
+                legs.append((leg, self.tx_pipeline.submit(tx)))
             
-            return {
-                'success': receipt['status'] == 1,
-                'tx_hash': tx_hash.hex(),
-                'amount': amount_str,
-                'token': symbol,
-                'spender': spender_address,
-                'gas_used': receipt['gasUsed']
-            }
+            # All legs are in flight, wait for them together
+            receipts = [(leg, pending.tx_hash, pending.result()) for leg, pending in legs]
+            return self._format_swap_order(symbol, type, side, amount, price, receipts, base_decimals, quote_decimals)
         except Exception as e:
-            raise Exception(f"Failed to approve token: {str(e)}")
-    
-    def revoke_approval(self, token_address: str, spender_address: str) -> Dict[str, Any]:
-        """Revoke token approval"""
-        return self.approve_token(token_address, spender_address, 0)
-
-    # Utility Functions
-    def get_wallet_tokens(self, address: str) -> List[str]:
-        """Get list of tokens in wallet (simplified)"""
-        # In practice, you'd scan blockchain for token transfers
-        return list(self.common_tokens.values())
+            raise Exception(f"Failed to create order: {str(e)}")
     
-    def get_token_price(self, token_address: str) -> float:
-        """Get token price (would integrate with price oracles)"""
-        # Implementation would query DEX for prices or use price oracles
-        return 0.0
-
-    # CCXT Override Methods
-    def load_markets(self, reload: bool = False, params: Dict = None) -> Dict:
-        """Load available markets from DEX"""
-        if params is None:
-            params = {}
+    def _find_buy_route(self, token_in: str, token_out: str, amount_out: int, params: Dict) -> Dict[str, Any]:
+        """Cheapest single route for an exact raw output amount"""
+        connectors = list(self.common_tokens.values())
+        self._ensure_route_pools(token_in, token_out, connectors)
+        
+        # Enumerate paths from the reverse direction, then price them for the exact output
+        best = None
+        for route in self.amm.find_routes(token_out, token_in, amount_out, params.get('maxHops', 3), connectors):
+            path, pairs = route['path'][::-1], route['pairs'][::-1]
+            try:
+                amounts = self.amm.quote_path_in(path, amount_out, pairs)
+            except ValueError:
+                continue
+            if best is None or amounts[0] < best['amount_in']:
+                best = {'dex': route['dex'], 'path': path, 'pairs': pairs,
+                        'amount_in': amounts[0], 'amount_out': amount_out}
         
-        # Implementation would discover trading pairs from DEX
-        self.markets = {}
-        return self.markets
+        if best is None:
+            return {'amount_in': 0, 'amount_out': amount_out, 'routes': []}
+        return {'amount_in': best['amount_in'], 'amount_out': amount_out, 'routes': [best]}
     
-    def fetch_balance(self, params: Dict = None) -> Dict[str, Any]:
-        """Fetch wallet balance in CCXT format"""
-        if params is None:
-            params = {}
+    def _requote_route(self, route: Dict[str, Any], side: str) -> Dict[str, Any]:
+        """Recompute leg amounts against current reserves, keeping the legs and allocation"""
+        legs = []
+        for leg in route['routes']:
+            if side == 'sell':
+                amount_out = self.amm.quote_path(leg['path'], leg['amount_in'], leg['pairs'])[-1]
+                legs.append(dict(leg, amount_out=amount_out))
+            else:
+                amount_in = self.amm.quote_path_in(leg['path'], leg['amount_out'], leg['pairs'])[0]
+                legs.append(dict(leg, amount_in=amount_in))
+        return dict(
+            route,
+            routes=legs,
+            amount_in=sum(leg['amount_in'] for leg in legs),
+            amount_out=sum(leg['amount_out'] for leg in legs)
+        )
+    
+    def _format_swap_order(self, symbol: str, type: str, side: str, amount: float, price: Optional[float],
+                           receipts: List[tuple], base_decimals: int, quote_decimals: int) -> Dict[str, Any]:
+        """Build a ccxt order structure from executed swap legs"""
+        timestamp = self.milliseconds()
+        filled_base = 0
+        cost_quote = 0
+        
+        for leg, _, receipt in receipts:
+            if receipt['status'] != 1:
+                continue
+            if side == 'sell':
+                filled_base += leg['amount_in']
+                cost_quote += leg['amount_out']
+            else:
+                filled_base += leg['amount_out']
+                cost_quote += leg['amount_in']
         
-        positions = self.fetch_positions()
-        balance = {}
+        filled = Amount(filled_base, base_decimals)
+        cost = Amount(cost_quote, quote_decimals)
         
-        for position in positions:
-            balance[position['symbol']] = {
-                'free': position['balance'],
-                'used': 0,
-                'total': position['balance']
+        return {
+            'id': receipts[0][1].hex(),
+            'clientOrderId': None,
+            'timestamp': timestamp,
+            'datetime': self.iso8601(timestamp),
+            'lastTradeTimestamp': timestamp if filled else None,
+            'symbol': symbol,
+            'type': type,
+            'side': side,
+            'price': price,
+            'average': float(cost / filled) if filled else None,
+            'amount': amount,
+            'filled': filled,
+            'remaining': Amount(max(to_raw(amount, base_decimals) - filled_base, 0), base_decimals),
+            'cost': cost,
+            'status': 'closed' if filled else 'canceled',
+            'fee': None,
+            'trades': [],
+            'info': {
+                'legs': [
+                    {
+                        'dex': leg['dex'],
+                        'path': leg['path'],
+                        'amount_in': str(leg['amount_in']),
+                        'amount_out': str(leg['amount_out']),
+                        'tx_hash': tx_hash.hex(),
+                        'success': receipt['status'] == 1,
+                        'gas_used': receipt['gasUsed']
+                    }
+                    for leg, tx_hash, receipt in receipts
+                ]
             }
+        }
+    
+    def plan_add_liquidity(self, token_a: str, token_b: str, amount_a: float, amount_b: float,
+                           params: Dict = None) -> Dict[str, Any]:
+        """Plan one deposit without sending it (see plan_add_liquidity_many)"""
+        return self.plan_add_liquidity_many([(token_a, token_b, amount_a, amount_b)], params)[0]
+    
+    def plan_add_liquidity_many(self, deposits: List[tuple], params: Dict = None) -> List[Dict[str, Any]]:
+        """Plan (token_a, token_b, amount_a, amount_b) deposits at one block, without sending them.
         
-        return balance
-
-    # DEX Trading Functions
-    def create_order(self, symbol: str, type: str, side: str, amount: float, 
-                    price: Optional[float] = None, params: Dict = None) -> Dict[str, Any]:
-        """Create order on DEX"""
+        Deposit ratio, minimum amounts and expected LP tokens are computed
+        from cached pool reserves the way the router computes them. Allowances
+        come from approvals_cache when it covers the deposit. Otherwise they
+        are read in one JSON-RPC batch, together with each pair's totalSupply
+        and an eth_call and eth_estimateGas of addLiquidity at the pinned
+        block. Each deposit is simulated on its own, so deposits that together
+        spend more than a balance still pass one by one.
+        
+        params: dex (default uniswap_v2_router), slippage (percent, default
+        0.5), deadline (seconds, default 1200), block_identifier, simulate
+        (default True; False plans from cached state and skips the batch).
+        """
         if params is None:
             params = {}
         
-        # Implementation for DEX swaps
-        raise NotImplementedError("DEX trading implementation needed")
+        if not self.address:
+            raise ValueError("Wallet not configured")
+        
+        dex = params.get('dex', 'uniswap_v2_router')
+        if dex not in V2_ROUTER_FEES or dex not in self.contracts:
+            raise ValueError(f"Unsupported DEX for liquidity: {dex}")
+        
+        try:
+            deposits = [(checksum(token_a), checksum(token_b), amount_a, amount_b)
+                        for token_a, token_b, amount_a, amount_b in deposits]
+            tokens = list(dict.fromkeys(token for deposit in deposits for token in deposit[:2]))
+            metadata = self.get_tokens_metadata(tokens)
+            for token in tokens:
+                if isinstance(metadata[token], Exception):
+                    raise metadata[token]
+            
+            # Pools of pairs not looked up yet are loaded together
+            missing = [key for key in dict.fromkeys(tuple(sorted(deposit[:2])) for deposit in deposits)
+                       if key not in self._pool_pairs_checked]
+            if missing:
+                self.load_pools(missing)
+                self._pool_pairs_checked.update(missing)
+            
+            slippage = Decimal(str(params.get('slippage', 0.5))) / 100
+            deadline = int(time.time()) + params.get('deadline', 1200)
+            plans = [self._plan_deposit(dex, deposit, metadata, slippage, deadline) for deposit in deposits]
+            if not params.get('simulate', True):
+                return plans
+            
+            with self.at_block(params.get('block_identifier') or self.current_block()) as block:
+                with self.batch() as batch:
+                    checks = [self._queue_deposit_checks(batch, plan, block) for plan in plans]
+            
+            for plan, check in zip(plans, checks):
+                self._apply_deposit_checks(plan, check, metadata, block)
+            return plans
+        except Exception as e:
+            raise Exception(f"Failed to plan liquidity: {str(e)}")
+    
+    def _plan_deposit(self, dex: str, deposit: tuple, metadata: Dict[str, Any], slippage: Decimal,
+                      deadline: int) -> Dict[str, Any]:
+        """Router amounts, minimums and cached allowances for one deposit"""
+        token_a, token_b, amount_a, amount_b = deposit
+        decimals_a = metadata[token_a]['decimals']
+        decimals_b = metadata[token_b]['decimals']
+        desired_a = to_raw(amount_a, decimals_a)
+        desired_b = to_raw(amount_b, decimals_b)
+        
+        # No pool yet means the router creates the pair and takes the desired amounts
+        pool = next((pool for pool in self.amm.get_pools(token_a, token_b) if pool['dex'] == dex), None)
+        reserve_a, reserve_b = self.amm.get_reserves(pool, token_a) if pool else (0, 0)
+        optimal_a, optimal_b = get_optimal_amounts(desired_a, desired_b, reserve_a, reserve_b)
+        min_a = int(Decimal(optimal_a) * (1 - slippage))
+        min_b = int(Decimal(optimal_b) * (1 - slippage))
+        
+        router = checksum(self.contracts[dex])
+        calldata = encode_call(ADD_LIQUIDITY_SELECTOR, token_a, token_b, desired_a, desired_b, min_a, min_b,
+                               checksum(self.address), deadline)
+        
+        approvals = []
+        for token, desired, decimals in ((token_a, desired_a, decimals_a), (token_b, desired_b, decimals_b)):
+            allowance = self._cached_allowance(token, router)
+            approvals.append({
+                'token': token,
+                'symbol': metadata[token]['symbol'],
+                'spender': router,
+                'required': Amount(desired, decimals),
+                'allowance': Amount(allowance, decimals) if allowance is not None else None,
+                'sufficient': allowance >= desired if allowance is not None else None,
+                'source': 'cache' if allowance is not None else None
+            })
+        
+        plan = {
+            'symbol': f"{metadata[token_a]['symbol']}/{metadata[token_b]['symbol']}",
+            'dex': dex,
+            'router': router,
+            'pair': pool['pair'] if pool else None,
+            'token_a': token_a,
+            'token_b': token_b,
+            'amount_a_desired': Amount(desired_a, decimals_a),
+            'amount_b_desired': Amount(desired_b, decimals_b),
+            'amount_a': Amount(optimal_a, decimals_a),
+            'amount_b': Amount(optimal_b, decimals_b),
+            'amount_a_min': Amount(min_a, decimals_a),
+            'amount_b_min': Amount(min_b, decimals_b),
+            'reserve_a': str(reserve_a),
+            'reserve_b': str(reserve_b),
+            'total_supply': None,
+            'expected_liquidity': None,
+            'share': None,
+            'approvals': approvals,
+            'simulation': None,
+            'calldata': '0x' + calldata.hex(),
+            'deadline': deadline,
+            'block': None,
+            'ready': None,
+            'error': None
+        }
+        total_supply = pool.get('total_supply') if pool else 0
+        if total_supply is not None:
+            self._set_expected_liquidity(plan, total_supply)
+        return plan
+    
+    def _set_expected_liquidity(self, plan: Dict[str, Any], total_supply: int):
+        reserve_a, reserve_b = int(plan['reserve_a']), int(plan['reserve_b'])
+        if not (reserve_a and reserve_b):
+            total_supply = 0
+        liquidity = get_liquidity_minted(plan['amount_a'].raw, plan['amount_b'].raw, reserve_a, reserve_b, total_supply)
+        plan['total_supply'] = str(total_supply)
+        plan['expected_liquidity'] = Amount(liquidity, 18)
+        # A new pair also mints MINIMUM_LIQUIDITY to the zero address
+        plan['share'] = Decimal(liquidity) / Decimal((total_supply or MINIMUM_LIQUIDITY) + liquidity) if liquidity else Decimal(0)
+    
+    def _cached_allowance(self, token_address: str, spender_address: str) -> Optional[int]:
+        """Allowance from approvals_cache, or None if it was never fetched"""
+        for key in (f"{token_address}_{self.address}", f"{token_address.lower()}_{self.address}"):
+            for approval in self.approvals_cache.get(key) or []:
+                if checksum(approval['spender']) == spender_address:
+                    return int(approval['raw_allowance'])
+        return None
+    
+    def _queue_deposit_checks(self, batch: JSONRPCBatch, plan: Dict[str, Any], block: Any) -> Dict[str, Any]:
+        """Queue the reads and the simulation one plan still needs"""
+        owner = checksum(self.address)
+        check = {'allowances': {}}
+        for approval in plan['approvals']:
+            # A cached allowance that covers the deposit is trusted; the simulation catches the rest
+            if not approval['sufficient']:
+                check['allowances'][approval['token']] = batch.eth_call(
+                    approval['token'], encode_allowance(owner, plan['router']), block
+                )
+        if plan['pair'] is not None:
+            check['total_supply'] = batch.eth_call(plan['pair'], TOTAL_SUPPLY_SELECTOR, block)
+        check['call'] = batch.eth_call(plan['router'], plan['calldata'], block, owner)
+        check['gas'] = batch.estimate_gas(plan['router'], plan['calldata'], owner, block)
+        return check
+    
+    def _apply_deposit_checks(self, plan: Dict[str, Any], check: Dict[str, Any], metadata: Dict[str, Any],
+                              block: Any):
+        """Fill allowances, expected liquidity and the simulation result, then decide readiness"""
+        plan['block'] = block
+        
+        for approval in plan['approvals']:
+            pending = check['allowances'].get(approval['token'])
+            if pending is None:
+                continue
+            try:
+                allowance = decode_uint(pending.result())
+            except Exception:
+                continue
+            approval.update({
+                'allowance': Amount(allowance, approval['required'].decimals),
+                'sufficient': allowance >= approval['required'].raw,
+                'source': 'rpc'
+            })
+        
+        if 'total_supply' in check:
+            try:
+                total_supply = decode_uint(check['total_supply'].result())
+                self.amm.set_total_supply(plan['pair'], total_supply)
+                self._set_expected_liquidity(plan, total_supply)
+            except Exception:
+                pass
+        
+        decimals_a = metadata[plan['token_a']]['decimals']
+        decimals_b = metadata[plan['token_b']]['decimals']
+        simulation = {'success': False, 'amount_a': None, 'amount_b': None, 'liquidity': None, 'gas': None, 'error': None}
+        call = check['call']
+        if call.error is not None:
+            simulation['error'] = call.error.get('message', str(call.error)) if isinstance(call.error, dict) else str(call.error)
+        elif call.value is None or len(call.value) < 96:
+            simulation['error'] = "Empty return data"
+        else:
+            simulation.update({
+                'success': True,
+                'amount_a': Amount(int.from_bytes(call.value[:32], 'big'), decimals_a),
+                'amount_b': Amount(int.from_bytes(call.value[32:64], 'big'), decimals_b),
+                'liquidity': Amount(int.from_bytes(call.value[64:96], 'big'), 18)
+            })
+            if check['gas'].error is None:
+                simulation['gas'] = check['gas'].value
+        plan['simulation'] = simulation
+        
+        missing = [approval['symbol'] for approval in plan['approvals'] if approval['sufficient'] is False]
+        if missing:
+            plan['error'] = f"Insufficient allowance for {', '.join(missing)} (approve {plan['router']})"
+        elif not simulation['success']:
+            plan['error'] = f"Simulation failed: {simulation['error']}"
+        plan['ready'] = plan['error'] is None
     
-    def add_liquidity(self, token_a: str, token_b: str, amount_a: float, 
+    def add_liquidity(self, token_a: str, token_b: str, amount_a: float,
                      amount_b: float, params: Dict = None) -> Dict[str, Any]:
-        """Add liquidity to DEX pool"""
+        """Add liquidity to DEX pool.
+        
+        The deposit is planned first (see plan_add_liquidity_many): amounts
+        follow the pool ratio, minimums apply slippage to those amounts, and
+        the call is simulated at a pinned block. Nothing is sent if an
+        allowance is missing or the simulation reverts. Pass a plan from
+        plan_add_liquidity as params['plan'] to skip planning again.
+        """
         if params is None:
             params = {}
         
@@ -409,71 +4430,184 @@ class DEXExchange(ccxt.Exchange):
             raise ValueError("Private key not configured")
         
         try:
-            router_contract = self.w3.eth.contract(
-                address=Web3.to_checksum_address(self.contracts['uniswap_v2_router']),
-                abi=self.router_abi
-            )
-            
-            # Get token contracts for decimals
-            token_a_contract = self.w3.eth.contract(
-                address=Web3.to_checksum_address(token_a),
-                abi=self.erc20_abi
-            )
-            token_b_contract = self.w3.eth.contract(
-                address=Web3.to_checksum_address(token_b),
-                abi=self.erc20_abi
-            )
-            
-            decimals_a = token_a_contract.functions.decimals().call()
-            decimals_b = token_b_contract.functions.decimals().call()
-            
-            # Convert amounts to wei
-            amount_a_wei = int(amount_a * (10 ** decimals_a))
-            amount_b_wei = int(amount_b * (10 ** decimals_b))
+            plan = params.get('plan') or self.plan_add_liquidity(token_a, token_b, amount_a, amount_b, params)
+            if plan['error'] is not None:
+                raise Exception(plan['error'])
             
-            # Calculate minimum amounts (with slippage)
-            slippage = params.get('slippage', 0.5) / 100  # 0.5% default
-            amount_a_min = int(amount_a_wei * (1 - slippage))
-            amount_b_min = int(amount_b_wei * (1 - slippage))
-            
-            # Set deadline
-            deadline = int(time.time()) + params.get('deadline', 1200)  # 20 minutes
+            # The simulation's estimate replaces a separate eth_estimateGas
+            gas = params.get('gas')
+            simulation = plan['simulation']
+            if gas is None and simulation is not None and simulation['gas'] is not None:
+                gas = int(simulation['gas'] * self.gas_margin)
             
             # Build transaction
-            tx = router_contract.functions.addLiquidity(
-                Web3.to_checksum_address(token_a),
-                Web3.to_checksum_address(token_b),
-                amount_a_wei,
-                amount_b_wei,
-                amount_a_min,
-                amount_b_min,
-                Web3.to_checksum_address(self.address),
-                deadline
-            ).build_transaction({
-                'from': self.address,
-                'gas': 300000,
-                'gasPrice': self.w3.eth.gas_price,
-                'nonce': self.w3.eth.get_transaction_count(self.address)
-            })
+            router_contract = self.contract(plan['router'], self.router_abi)
+            function = router_contract.functions.addLiquidity(
+                plan['token_a'],
+                plan['token_b'],
+                plan['amount_a_desired'].raw,
+                plan['amount_b_desired'].raw,
+                plan['amount_a_min'].raw,
+                plan['amount_b_min'].raw,
+                checksum(self.address),
+                plan['deadline']
+            )
+            tx = function.build_transaction(self._transaction_params(
+                function, (plan['token_a'], plan['token_b']), 300000, dict(params, gas=gas)
+            ))
             
             # Sign and send
-            signed_tx = self.account.sign_transaction(tx)
-            tx_hash = self.w3.eth.send_raw_transaction(signed_tx.rawTransaction)
-            receipt = self.w3.eth.wait_for_transaction_receipt(tx_hash)
+            pending = self.tx_pipeline.submit(tx)
             
-            return {
-                'success': receipt['status'] == 1,
-                'tx_hash': tx_hash.hex(),
+            result = {
+                'success': None,
+                'tx_hash': pending.tx_hash.hex(),
                 'token_a': token_a,
                 'token_b': token_b,
-                'amount_a': amount_a,
-                'amount_b': amount_b,
-                'gas_used': receipt['gasUsed']
+                'amount_a': plan['amount_a'],
+                'amount_b': plan['amount_b'],
+                'expected_liquidity': plan['expected_liquidity'],
+                'gas_used': None,
+                'plan': plan
             }
+            if not params.get('wait', True):
+                result['receipt'] = pending
+                return result
+            
+            receipt = pending.result()
+            result.update({'success': receipt['status'] == 1, 'gas_used': receipt['gasUsed']})
+            return result
         except Exception as e:
             raise Exception(f"Failed to add liquidity: {str(e)}")
 
 
+class MultiChainDEX:
+    """One DEXExchange per chain, fanned out through a shared ChainScheduler.
+    
+    `chains` maps a chain name to that chain's config (at least `rpcUrl`).
+    Names found in CHAIN_PRESETS also get that chain's id, PoA middleware,
+    routers and tokens. `config` holds settings shared by every chain, such
+    as `privateKey`, `metrics` or `tokenCache`. Each chain runs at most its
+    `concurrency` tasks at once (default `chainConcurrency`, 4).
+    """
+    
+    def __init__(self, chains: Dict[str, Dict[str, Any]], config: Dict[str, Any] = None):
+        if config is None:
+            config = {}
+        
+        shared = {key: value for key, value in config.items()
+                  if key not in ('chainConcurrency', 'maxWorkers', 'scheduler')}
+        self.scheduler = config.get('scheduler') or ChainScheduler(
+            max_workers=config.get('maxWorkers'),
+            default_budget=config.get('chainConcurrency', 4)
+        )
+        
+        self.exchanges = {}
+        for name, chain_config in chains.items():
+            chain_config = dict(shared, **chain_config)
+            budget = chain_config.pop('concurrency', None)
+            if budget is not None:
+                self.scheduler.set_budget(name, budget)
+            if name in CHAIN_PRESETS:
+                chain_config.setdefault('chain', name)
+            self.exchanges[name] = DEXExchange(chain_config)
+    
+    def __getitem__(self, chain: str) -> DEXExchange:
+        return self.exchanges[chain]
+
+    # Fan-out
+    def submit(self, chain: str, method: str, *args: Any, **kwargs: Any) -> Future:
+        """Run a DEXExchange method on one chain through the shared scheduler"""
+        return self.scheduler.submit(chain, getattr(self.exchanges[chain], method), *args, **kwargs)
+    
+    def run(self, method: str, *args: Any, chains: Optional[List[str]] = None, **kwargs: Any) -> Dict[str, Any]:
+        """Run a method on every chain concurrently; a failed chain maps to its exception"""
+        futures = {chain: self.submit(chain, method, *args, **kwargs) for chain in (chains or self.exchanges)}
+        return self._gather(futures)
+    
+    def _gather(self, futures: Dict[Any, Future]) -> Dict[Any, Any]:
+        results = {}
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                results[key] = e
+        return results
+    
+    def _record_failure(self, chain: str, operation: str, error: Any):
+        metrics = self.exchanges[chain].metrics
+        if metrics is not None:
+            metrics.record_failure(operation, error)
+
+    # DeFi Positions Management
+    def fetch_positions(self, symbols: Optional[Dict[str, List[str]]] = None,
+                        params: Dict = None) -> Dict[str, List[Dict[str, Any]]]:
+        """Positions keyed by chain (symbols: token addresses per chain, default wallet tokens)"""
+        symbols = symbols or {}
+        futures = {
+            chain: self.submit(chain, 'fetch_positions', symbols.get(chain), params)
+            for chain in self.exchanges
+        }
+        
+        positions = {}
+        for chain, result in self._gather(futures).items():
+            if isinstance(result, Exception):
+                print(f"Error fetching positions on {chain}: {result}")
+                self._record_failure(chain, 'fetch_positions', result)
+                continue
+            positions[chain] = result
+        return positions
+    
+    def fetch_balance(self, params: Dict = None) -> Dict[str, Any]:
+        """CCXT-format balance summed across chains, with each chain's balance under 'info'"""
+        balance = {'info': {}}
+        
+        for chain, result in self.run('fetch_balance', params).items():
+            if isinstance(result, Exception):
+                print(f"Error fetching balance on {chain}: {result}")
+                self._record_failure(chain, 'fetch_balance', result)
+                continue
+            balance['info'][chain] = result
+            for code, entry in result.items():
+                # Amounts with different decimals (e.g. USDC on BSC) add exactly
+                merged = balance.setdefault(code, {'free': 0, 'used': 0, 'total': 0})
+                for key in ('free', 'used', 'total'):
+                    merged[key] = merged[key] + entry[key]
+        
+        return balance
+
+    # Token Approvals Management
+    def fetch_approvals(self, tokens: Optional[Dict[str, List[str]]] = None, spender_address: Optional[str] = None,
+                        params: Dict = None) -> Dict[str, Dict[str, List[Dict[str, Any]]]]:
+        """Approvals keyed by chain and token (tokens: addresses per chain, default common tokens)"""
+        futures = {}
+        for chain, dex in self.exchanges.items():
+            if tokens is None:
+                token_addresses = list(dex.common_tokens.values())
+            else:
+                token_addresses = tokens.get(chain, [])
+            for token_address in token_addresses:
+                futures[(chain, token_address)] = self.submit(
+                    chain, 'fetch_approvals', token_address, spender_address, params
+                )
+        
+        approvals = {}
+        for (chain, token_address), result in self._gather(futures).items():
+            if isinstance(result, Exception):
+                print(f"Error fetching approvals for {token_address} on {chain}: {result}")
+                self._record_failure(chain, 'fetch_approvals', result)
+                continue
+            approvals.setdefault(chain, {})[token_address] = result
+        return approvals
+
+    # Utility Functions
+    def close(self):
+        """Stop background fee refreshes and the shared scheduler"""
+        for dex in self.exchanges.values():
+            dex.close()
+        self.scheduler.shutdown()
+
+
 # Usage Example
 if __name__ == "__main__":
     # Initialize DEX
@@ -505,6 +4639,6 @@ if __name__ == "__main__":
                 dex.contracts['uniswap_v2_router']
             )
             print(f"\nApproval result: {approval_result}")
-            
+    
     except Exception as e:
         print(f"Error: {e}")
\ No newline at end of file
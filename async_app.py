@@ -0,0 +1,595 @@
+import ccxt.async_support as ccxt_async
+import asyncio
+import aiohttp
+from web3 import AsyncWeb3
+from web3.providers import AsyncHTTPProvider
+from web3.middleware import async_geth_poa_middleware
+from web3.exceptions import BadFunctionCallOutput
+from typing import Dict, List, Optional, Any
+import time
+
+from app import (
+    CHAIN_PRESETS,
+    COMMON_TOKENS,
+    DEX_CONTRACTS,
+    ERC20_ABI,
+    MULTICALL3_ADDRESS,
+    NonceManager,
+    ROUTER_ABI,
+    ContractRegistry,
+    DEXExchange,
+    TokenMetadataCache,
+    account_from_key,
+    checksum,
+    decode_aggregate3,
+    decode_uint,
+    encode_aggregate3,
+    encode_allowance,
+    format_approval,
+    format_balance,
+    gas_estimate_key,
+    is_batch_size_error,
+    metadata_calls,
+    parse_metadata,
+    parse_positions,
+    position_calls,
+    split_cached_metadata,
+    to_raw,
+)
+
+
+class AsyncDEXExchange(ccxt_async.Exchange):
+    """asyncio variant of DEXExchange built on AsyncWeb3.
+    
+    Exposes the same methods as DEXExchange as coroutines. All RPC traffic goes
+    through one keep-alive aiohttp session per endpoint and is bounded by a
+    semaphore, so many wallets can be scanned concurrently from one process.
+    Pass the same `rpcSemaphore` and `tokenCache` to several instances to share
+    the concurrency budget and metadata between them. Markets, prices and
+    swaps reuse DEXExchange's pool math and routing, run in a worker thread.
+    """
+
+    # Contract ABIs, shared by every instance
+    erc20_abi = ERC20_ABI
+    router_abi = ROUTER_ABI
+    
+    def __init__(self, config: Dict[str, Any] = None):
+        if config is None:
+            config = {}
+        
+        super().__init__(config)
+        
+        self.id = 'dex'
+        self.name = 'Custom DEX'
+        self.version = '1.0'
+        self.rateLimit = 1000
+        
+        # Chain preset (chain id, PoA, routers, tokens); explicit config keys override it
+        self.chain = config.get('chain')
+        if self.chain is not None and self.chain not in CHAIN_PRESETS:
+            raise ValueError(f"Unknown chain: {self.chain}")
+        preset = CHAIN_PRESETS.get(self.chain, {})
+        
+        # AsyncWeb3 setup (the aiohttp session is attached on first use)
+        self.rpc_url = config.get('rpcUrl', 'https://mainnet.infura.io/v3/YOUR_INFURA_KEY')
+        if isinstance(self.rpc_url, (list, tuple)):
+            # Endpoint pools are only routed by the sync client; use the first endpoint
+            self.rpc_url = self.rpc_url[0]['url'] if isinstance(self.rpc_url[0], dict) else self.rpc_url[0]
+        self.w3 = AsyncWeb3(AsyncHTTPProvider(self.rpc_url))
+        self.rpc_session = config.get('rpcSession')
+        self.own_rpc_session = self.rpc_session is None
+        self.rpc_pool_size = config.get('rpcPoolSize', 100)
+        self._session_ready = False
+        
+        # Add middleware for PoA chains if needed
+        if config.get('poa', preset.get('poa', False)):
+            self.w3.middleware_onion.inject(async_geth_poa_middleware, layer=0)
+        
+        # Bounded concurrency for RPC requests
+        self.rpc_semaphore = config.get('rpcSemaphore') or asyncio.Semaphore(config.get('maxConcurrency', 16))
+        
+        # Multicall setup (batched reads)
+        self.use_multicall = config.get('useMulticall', True)
+        self.multicall_address = config.get('multicallAddress', MULTICALL3_ADDRESS)
+        self.multicall_chunk_size = config.get('multicallChunkSize', 500)
+        
+        # Wallet setup
+        self.private_key = config.get('privateKey')
+        if self.private_key:
+            self.account = account_from_key(self.private_key)
+            self.address = self.account.address
+        else:
+            self.account = None
+            self.address = None
+        
+        # Local nonces, so concurrent transactions from one wallet do not collide
+        self.nonces = NonceManager()
+        
+        # Gas limits, memoized like DEXExchange.estimate_gas (fees come from the sync exchange's FeeOracle)
+        self.gas_margin = config.get('gasMargin', 1.2)
+        self.gas_estimates = {}
+        
+        # Common DEX contract addresses
+        self.contracts = dict(config.get('routers') or preset.get('routers') or DEX_CONTRACTS)
+        
+        # Contract instances (the ABIs themselves are class attributes)
+        self.contract_registry = ContractRegistry()
+        
+        # Cache for positions and approvals
+        self.positions_cache = {}
+        self.approvals_cache = {}
+        self.approval_errors = {}
+        
+        # Token metadata cache (decimals/symbol/name never change)
+        self.token_metadata = config.get('tokenCache') or TokenMetadataCache(
+            config.get('tokenCacheSize', 10000),
+            config.get('tokenCachePath')
+        )
+        self._chain_id = config.get('chainId', preset.get('chainId'))
+        
+        # Common token addresses (mainnet unless a chain preset is given)
+        self.common_tokens = dict(config.get('tokens') or preset.get('tokens') or COMMON_TOKENS)
+        
+        # Sync exchange for AMM pools, markets and routing, created on first use
+        self._sync_config = dict(config, tokenCache=self.token_metadata)
+        self._sync_dex = None
+    
+    async def _ensure_session(self):
+        """Attach a pooled keep-alive aiohttp session to the provider"""
+        if self._session_ready:
+            return
+        if self.rpc_session is None:
+            self.rpc_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.rpc_pool_size, keepalive_timeout=60)
+            )
+        await self.w3.provider.cache_async_session(self.rpc_session)
+        self._session_ready = True
+    
+    async def _rpc(self, coro_factory):
+        """Run one RPC coroutine under the concurrency semaphore"""
+        await self._ensure_session()
+        async with self.rpc_semaphore:
+            return await coro_factory()
+    
+    async def close(self):
+        """Close the RPC session (if owned), the sync exchange and the ccxt session"""
+        if self._sync_dex is not None:
+            self._sync_dex.close()
+        if self.rpc_session is not None and self.own_rpc_session:
+            await self.rpc_session.close()
+            self.rpc_session = None
+            self._session_ready = False
+        await super().close()
+
+    # DeFi Positions Management
+    async def fetch_positions(self, symbols: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Fetch DeFi positions for the connected wallet"""
+        if not self.address:
+            raise ValueError("Wallet not configured")
+        
+        try:
+            positions = []
+            tokens_to_check = symbols or list(self.common_tokens.values())
+            results = await self.get_token_positions(self.address, tokens_to_check)
+            
+            for token_address in tokens_to_check:
+                position = results[token_address]
+                if isinstance(position, Exception):
+                    print(f"Error fetching position for {token_address}: {position}")
+                    continue
+                if position['balance'] > 0:
+                    positions.append(position)
+            
+            # Cache positions
+            self.positions_cache[self.address] = positions
+            
+            return positions
+        except Exception as e:
+            raise Exception(f"Failed to fetch positions: {str(e)}")
+    
+    async def get_token_position(self, address: str, token_address: str) -> Dict[str, Any]:
+        """Get detailed position for a specific token"""
+        position = (await self.get_token_positions(address, [token_address]))[token_address]
+        if isinstance(position, Exception):
+            raise Exception(f"Failed to get token position: {str(position)}")
+        return position
+    
+    async def get_token_positions(self, address: str, token_addresses: List[str]) -> Dict[str, Any]:
+        """Get positions for many tokens in batched reads, keyed by token address.
+        
+        Tokens whose calls fail map to the exception instead of a position.
+        """
+        metadata, missing = split_cached_metadata(self.token_metadata, await self.get_chain_id(), token_addresses)
+        
+        # Balances and any uncached metadata go out in the same batch
+        results = await self.multicall(position_calls(checksum(address), token_addresses, missing))
+        metadata.update(await self._store_metadata(missing, results[len(token_addresses):]))
+        return parse_positions(token_addresses, results, metadata, int(time.time()))
+
+    # Token Approvals Management
+    async def fetch_approvals(self, token_address: str, spender_address: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Fetch token approvals for DEX routers"""
+        if not self.address:
+            raise ValueError("Wallet not configured")
+        
+        try:
+            approvals = []
+            errors = {}
+            
+            if spender_address:
+                # Check specific spender
+                approval = await self.get_token_approval(self.address, token_address, spender_address)
+                approvals.append(approval)
+            else:
+                # Check all common DEX routers in one batch
+                results = await self.get_token_approvals(self.address, token_address, list(self.contracts.values()))
+                for name, router_address in self.contracts.items():
+                    approval = results[router_address]
+                    if isinstance(approval, Exception):
+                        errors[name] = str(approval)
+                        continue
+                    approval['spender_name'] = name
+                    approvals.append(approval)
+            
+            # Cache approvals; spenders that failed are kept in approval_errors
+            cache_key = f"{token_address}_{self.address}"
+            self.approvals_cache[cache_key] = approvals
+            self.approval_errors[cache_key] = errors
+            
+            return approvals
+        except Exception as e:
+            raise Exception(f"Failed to fetch approvals: {str(e)}")
+    
+    async def get_token_approval(self, owner_address: str, token_address: str, spender_address: str) -> Dict[str, Any]:
+        """Get specific token approval amount"""
+        approval = (await self.get_token_approvals(owner_address, token_address, [spender_address]))[spender_address]
+        if isinstance(approval, Exception):
+            raise Exception(f"Failed to get token approval: {str(approval)}")
+        return approval
+    
+    async def get_token_approvals(self, owner_address: str, token_address: str,
+                                  spender_addresses: List[str]) -> Dict[str, Any]:
+        """Get allowances of one token for many spenders in one batch, keyed by spender.
+        
+        Spenders whose calls fail map to the exception instead of an approval.
+        """
+        token = checksum(token_address)
+        owner = checksum(owner_address)
+        calls = [(token, encode_allowance(owner, checksum(spender))) for spender in spender_addresses]
+        
+        approvals = {}
+        try:
+            metadata, results = await asyncio.gather(
+                self.get_token_metadata(token_address),
+                self.multicall(calls)
+            )
+        except Exception as e:
+            return {spender: e for spender in spender_addresses}
+        
+        timestamp = int(time.time())
+        for spender, (ok, raw_allowance) in zip(spender_addresses, results):
+            try:
+                if not ok:
+                    raise Exception("allowance reverted")
+                approvals[spender] = format_approval(
+                    token_address, spender, decode_uint(raw_allowance), metadata, timestamp
+                )
+            except Exception as e:
+                approvals[spender] = e
+        
+        return approvals
+    
+    async def approve_token(self, token_address: str, spender_address: str, amount: Optional[float] = None,
+                            params: Dict = None) -> Dict[str, Any]:
+        """Approve token for spending (params: gas, feeLevel)"""
+        if not self.account:
+            raise ValueError("Private key not configured")
+        
+        try:
+            contract = self.contract(token_address)
+            
+            # Get token decimals
+            metadata = await self.get_token_metadata(token_address)
+            decimals = metadata['decimals']
+            symbol = metadata['symbol']
+            
+            # Set approval amount
+            if amount is None:
+                # Unlimited approval
+                approval_amount = 2**256 - 1
+                amount_str = "unlimited"
+            else:
+                approval_amount = to_raw(amount, decimals)
+                amount_str = str(amount)
+            
+            function = contract.functions.approve(checksum(spender_address), approval_amount)
+            tx_hash, receipt = await self._send_transaction(function, contract.address, 100000, params)
+            
+            return {
+                'success': receipt['status'] == 1,
+                'tx_hash': tx_hash.hex(),
+                'amount': amount_str,
+                'token': symbol,
+                'spender': spender_address,
+                'gas_used': receipt['gasUsed']
+            }
+        except Exception as e:
+            raise Exception(f"Failed to approve token: {str(e)}")
+    
+    async def revoke_approval(self, token_address: str, spender_address: str, params: Dict = None) -> Dict[str, Any]:
+        """Revoke token approval"""
+        return await self.approve_token(token_address, spender_address, 0, params)
+
+    # Transactions
+    async def _allocate_nonce(self) -> int:
+        """Next local nonce, reading the pending nonce from the node when the manager needs it"""
+        if self.nonces.needs_sync:
+            pending = await self._rpc(lambda: self.w3.eth.get_transaction_count(self.address, 'pending'))
+            self.nonces.sync(pending)
+        return self.nonces.allocate()
+    
+    async def estimate_gas(self, function: Any, token: Any = None, default: Optional[int] = None) -> int:
+        """Gas limit for a contract call, memoized per gas_estimate_key with gasMargin applied.
+        
+        If estimation fails, `default` is returned without being memoized.
+        """
+        key = gas_estimate_key(function, token)
+        if key in self.gas_estimates:
+            return self.gas_estimates[key]
+        
+        try:
+            gas = int(await self._rpc(lambda: function.estimate_gas({'from': self.address})) * self.gas_margin)
+        except Exception:
+            if default is None:
+                raise
+            return default
+        
+        self.gas_estimates[key] = gas
+        return gas
+    
+    async def _send_transaction(self, function: Any, token: Any, default_gas: int, params: Dict = None) -> tuple:
+        """Build, sign and send a contract call with a local nonce; returns (tx_hash, receipt).
+        
+        Fees come from the sync exchange's FeeOracle (EIP-1559, or a cached
+        gasPrice), so no fee RPC is made per transaction. params: gas, feeLevel.
+        """
+        if params is None:
+            params = {}
+        
+        gas = params.get('gas') or await self.estimate_gas(function, token, default_gas)
+        fees = await asyncio.to_thread(self._get_sync_dex().fee_oracle.get_fees, params.get('feeLevel', 'medium'))
+        chain_id = await self.get_chain_id()
+        fields = {'from': self.address, 'gas': gas, 'chainId': chain_id}
+        fields.update(fees)
+        nonce = await self._allocate_nonce()
+        try:
+            tx = await self._rpc(lambda: function.build_transaction(dict(fields, nonce=nonce)))
+            signed_tx = self.account.sign_transaction(tx)
+            tx_hash = await self._rpc(lambda: self.w3.eth.send_raw_transaction(signed_tx.rawTransaction))
+        except Exception as e:
+            self.nonces.release(nonce)
+            if 'nonce too low' in str(e).lower():
+                # Another sender used this account: re-read the pending nonce next time
+                self.nonces.expire(nonce)
+            raise
+        
+        # Wait for confirmation (outside the semaphore, it polls)
+        try:
+            receipt = await self.w3.eth.wait_for_transaction_receipt(tx_hash)
+        except Exception:
+            self.nonces.expire(nonce)
+            raise
+        self.nonces.confirm(nonce)
+        return tx_hash, receipt
+
+    # Token Metadata
+    async def get_chain_id(self) -> int:
+        """Get the chain id, fetched once per instance"""
+        if self._chain_id is None:
+            self._chain_id = await self._rpc(lambda: self.w3.eth.chain_id)
+        return self._chain_id
+    
+    async def get_token_metadata(self, token_address: str) -> Dict[str, Any]:
+        """Get cached decimals, symbol and name for a token"""
+        metadata = (await self.get_tokens_metadata([token_address]))[token_address]
+        if isinstance(metadata, Exception):
+            raise Exception(f"Failed to get token metadata: {str(metadata)}")
+        return metadata
+    
+    async def get_tokens_metadata(self, token_addresses: List[str]) -> Dict[str, Any]:
+        """Get metadata for many tokens, fetching only cache misses in one batch"""
+        metadata, missing = split_cached_metadata(self.token_metadata, await self.get_chain_id(), token_addresses)
+        
+        if missing:
+            calls = [call for token_address in missing for call in metadata_calls(token_address)]
+            metadata.update(await self._store_metadata(missing, await self.multicall(calls)))
+        
+        return metadata
+    
+    async def preload_token_metadata(self, token_addresses: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Warm the metadata cache, defaulting to common_tokens"""
+        return await self.get_tokens_metadata(token_addresses or list(self.common_tokens.values()))
+    
+    async def _store_metadata(self, token_addresses: List[str], results: List[tuple]) -> Dict[str, Any]:
+        """Decode metadata call results (three per token) and cache the successful ones"""
+        metadata = parse_metadata(token_addresses, results)
+        fetched = {token: meta for token, meta in metadata.items() if not isinstance(meta, Exception)}
+        
+        if fetched:
+            self.token_metadata.set_many(await self.get_chain_id(), fetched)
+        
+        return metadata
+
+    # Multicall Batching
+    async def multicall(self, calls: List[tuple], chunk_size: Optional[int] = None) -> List[tuple]:
+        """Execute (target, calldata) read calls in Multicall3 aggregate3 batches.
+        
+        Chunks are sent concurrently; returns one (success, return_data) tuple per call.
+        """
+        chunk_size = chunk_size or self.multicall_chunk_size
+        chunks = await asyncio.gather(*[
+            self._multicall_chunk(calls[start:start + chunk_size])
+            for start in range(0, len(calls), chunk_size)
+        ])
+        return [result for chunk in chunks for result in chunk]
+    
+    async def _multicall_chunk(self, calls: List[tuple]) -> List[tuple]:
+        """Run one aggregate3 batch, splitting it if the whole batch fails"""
+        if not self.use_multicall:
+            return list(await asyncio.gather(*[self._single_call(target, data) for target, data in calls]))
+        
+        call = {'to': checksum(self.multicall_address), 'data': encode_aggregate3(calls)}
+        
+        try:
+            result = await self._rpc(lambda: self.w3.eth.call(call))
+            if not result:
+                raise BadFunctionCallOutput("Multicall3 returned no data")
+            return decode_aggregate3(bytes(result))
+        except BadFunctionCallOutput:
+            # No Multicall3 deployed on this chain, fall back to single calls
+            self.use_multicall = False
+            return list(await asyncio.gather(*[self._single_call(target, data) for target, data in calls]))
+        except Exception as e:
+            # Gas limit or response size: halve and retry. Transport errors would only repeat, so raise them
+            if not is_batch_size_error(e):
+                raise
+            if len(calls) == 1:
+                return [await self._single_call(*calls[0])]
+            middle = len(calls) // 2
+            first, second = await asyncio.gather(
+                self._multicall_chunk(calls[:middle]),
+                self._multicall_chunk(calls[middle:])
+            )
+            return first + second
+    
+    async def _single_call(self, target: str, data: Any) -> tuple:
+        """Run a single eth_call, returning (success, return_data)"""
+        try:
+            result = await self._rpc(lambda: self.w3.eth.call({'to': checksum(target), 'data': data}))
+            return (True, bytes(result))
+        except Exception:
+            return (False, b'')
+
+    # Utility Functions
+    def contract(self, address: str, abi: Optional[List[Dict[str, Any]]] = None) -> Any:
+        """Cached contract instance for an address (ERC20 ABI by default)"""
+        return self.contract_registry.get(self.w3, address, abi or self.erc20_abi)
+    
+    async def get_wallet_tokens(self, address: str) -> List[str]:
+        """Get list of tokens in wallet (simplified)"""
+        return list(self.common_tokens.values())
+    
+    async def get_token_price(self, token_address: str, quote_token: Optional[str] = None) -> float:
+        """Get token price in quote_token (default USDC) from local pool reserves (see DEXExchange.get_token_price)"""
+        return await asyncio.to_thread(self._get_sync_dex().get_token_price, token_address, quote_token)
+    
+    def _get_sync_dex(self) -> DEXExchange:
+        """DEXExchange on the same config, sharing the token cache and this wallet's nonces"""
+        if self._sync_dex is None:
+            dex = DEXExchange(self._sync_config)
+            dex.tx_pipeline.nonces = self.nonces
+            self.nonces.fetch_nonce = lambda: dex.w3.eth.get_transaction_count(dex.address, 'pending')
+            self._sync_dex = dex
+        return self._sync_dex
+
+    # CCXT Override Methods
+    async def load_markets(self, reload: bool = False, params: Dict = None) -> Dict:
+        """Load markets from V2-style factory pairs (see DEXExchange.load_markets)"""
+        if self.markets and not reload:
+            return self.markets
+        
+        dex = self._get_sync_dex()
+        await asyncio.to_thread(dex.load_markets, reload, params)
+        return self.set_markets(dex.markets, dex.currencies)
+    
+    async def fetch_balance(self, params: Dict = None) -> Dict[str, Any]:
+        """Fetch wallet balance in CCXT format"""
+        if params is None:
+            params = {}
+        
+        return format_balance(await self.fetch_positions())
+    
+    async def fetch_balances(self, addresses: List[str], symbols: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+        """Fetch CCXT-format balances for many wallets concurrently, keyed by address"""
+        tokens_to_check = symbols or list(self.common_tokens.values())
+        results = await asyncio.gather(
+            *[self.get_token_positions(address, tokens_to_check) for address in addresses],
+            return_exceptions=True
+        )
+        balances = {}
+        
+        for address, positions in zip(addresses, results):
+            if isinstance(positions, Exception):
+                print(f"Error fetching balance for {address}: {positions}")
+                continue
+            balances[address] = format_balance(list(positions.values()))
+        
+        return balances
+
+    # DEX Trading Functions
+    async def create_order(self, symbol: str, type: str, side: str, amount: float,
+                           price: Optional[float] = None, params: Dict = None) -> Dict[str, Any]:
+        """Create order on DEX as router swaps along the best route (see DEXExchange.create_order)"""
+        if not self.account:
+            raise ValueError("Private key not configured")
+        return await asyncio.to_thread(self._get_sync_dex().create_order, symbol, type, side, amount, price, params)
+    
+    async def plan_add_liquidity(self, token_a: str, token_b: str, amount_a: float, amount_b: float,
+                                 params: Dict = None) -> Dict[str, Any]:
+        """Plan one deposit without sending it (see DEXExchange.plan_add_liquidity_many)"""
+        return await asyncio.to_thread(self._get_sync_dex().plan_add_liquidity, token_a, token_b, amount_a, amount_b, params)
+    
+    async def add_liquidity(self, token_a: str, token_b: str, amount_a: float,
+                            amount_b: float, params: Dict = None) -> Dict[str, Any]:
+        """Add liquidity to DEX pool.
+        
+        The deposit is planned and simulated first, as in DEXExchange.add_liquidity:
+        amounts follow the pool ratio and nothing is sent if an allowance is
+        missing or the simulation reverts. Pass a plan as params['plan'] to
+        skip planning again.
+        """
+        if params is None:
+            params = {}
+        
+        if not self.account:
+            raise ValueError("Private key not configured")
+        
+        try:
+            plan = params.get('plan') or await self.plan_add_liquidity(token_a, token_b, amount_a, amount_b, params)
+            if plan['error'] is not None:
+                raise Exception(plan['error'])
+            
+            # The simulation's estimate replaces a separate eth_estimateGas
+            gas = params.get('gas')
+            simulation = plan['simulation']
+            if gas is None and simulation is not None and simulation['gas'] is not None:
+                gas = int(simulation['gas'] * self.gas_margin)
+            
+            router_contract = self.contract(plan['router'], self.router_abi)
+            function = router_contract.functions.addLiquidity(
+                plan['token_a'],
+                plan['token_b'],
+                plan['amount_a_desired'].raw,
+                plan['amount_b_desired'].raw,
+                plan['amount_a_min'].raw,
+                plan['amount_b_min'].raw,
+                checksum(self.address),
+                plan['deadline']
+            )
+            tx_hash, receipt = await self._send_transaction(
+                function, (plan['token_a'], plan['token_b']), 300000, dict(params, gas=gas)
+            )
+            
+            return {
+                'success': receipt['status'] == 1,
+                'tx_hash': tx_hash.hex(),
+                'token_a': token_a,
+                'token_b': token_b,
+                'amount_a': plan['amount_a'],
+                'amount_b': plan['amount_b'],
+                'expected_liquidity': plan['expected_liquidity'],
+                'gas_used': receipt['gasUsed'],
+                'plan': plan
+            }
+        except Exception as e:
+            raise Exception(f"Failed to add liquidity: {str(e)}")
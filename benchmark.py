@@ -0,0 +1,738 @@
+"""Offline benchmarks for DEXExchange.
+
+Runs the exchange against an in-process JSON-RPC stub node serving ERC-20
+tokens, V2 factories/pairs and Multicall3, with configurable injected
+latency. Reports round trips, wall time, p50/p99 and client CPU per call
+for each operation at several wallet and token counts, and can compare the
+run against a stored baseline.
+
+    python benchmark.py
+    python benchmark.py --wallets 1,10 --tokens 10,100 --latency 0.02
+    python benchmark.py --save-baseline benchmark_baseline.json
+    python benchmark.py --baseline benchmark_baseline.json   # exit 1 on regression
+    python benchmark.py --startup 200   # import time, per-instance construction cost and memory
+"""
+
+import argparse
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Any
+
+import rlp
+from eth_abi import decode as abi_decode, encode as abi_encode
+from eth_account import Account
+from web3 import Web3
+
+from app import (
+    ADD_LIQUIDITY_SELECTOR,
+    ALL_PAIRS_LENGTH_SELECTOR,
+    ALL_PAIRS_SELECTOR,
+    ALLOWANCE_SELECTOR,
+    AGGREGATE3_SELECTOR,
+    BALANCE_OF_SELECTOR,
+    COMMON_TOKENS,
+    DECIMALS_SELECTOR,
+    DEX_CONTRACTS,
+    FACTORY_SELECTOR,
+    GET_BLOCK_NUMBER_SELECTOR,
+    GET_PAIR_SELECTOR,
+    GET_RESERVES_SELECTOR,
+    MULTICALL3_ADDRESS,
+    NAME_SELECTOR,
+    SYMBOL_SELECTOR,
+    TOKEN0_SELECTOR,
+    TOKEN1_SELECTOR,
+    TOTAL_SUPPLY_SELECTOR,
+    V2_ROUTER_FEES,
+    DEXExchange,
+    ProviderPool,
+)
+
+
+# Well-known test key (never holds funds); the benchmark wallet signs with it
+BENCHMARK_KEY = '0x' + '42' * 32
+
+OPERATIONS = ('fetch_positions', 'fetch_balance', 'fetch_approvals', 'get_liquidity_positions', 'add_liquidity',
+              'load_pools', 'quote')
+
+# Metrics checked against a baseline, with the absolute change ignored as noise.
+# Round trips are deterministic, so they get no relative tolerance.
+BASELINE_METRICS = {'round_trips': 0.5, 'p50_ms': 1.0, 'cpu_ms': 0.5}
+
+
+def stub_address(label: str) -> str:
+    """Deterministic checksummed address for a stub contract or wallet"""
+    return Web3.to_checksum_address(Web3.keccak(text=label)[-20:])
+
+
+class RPCError(Exception):
+    """JSON-RPC error returned by the stub node"""
+    
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+
+
+class StubChain:
+    """Minimal chain state answering the JSON-RPC calls DEXExchange makes.
+    
+    Contracts are plain dicts keyed by lowercase address: ERC-20 tokens,
+    V2 routers (factory(), addLiquidity() as a read-only simulation), factories (getPair/allPairs) and pairs
+    (token0/token1/getReserves), plus Multicall3. Transactions are accepted,
+    mined immediately and given a successful receipt.
+    """
+    
+    def __init__(self, chain_id: int = 1, block: int = 19000000):
+        self.chain_id = chain_id
+        self.block = block
+        self.tokens = {}
+        self.routers = {}
+        self.factories = {}
+        self.pairs = {}
+        self.nonces = {}
+        self.receipts = {}
+        self._lock = threading.Lock()
+
+    # Deployment
+    def add_token(self, address: str, symbol: str, decimals: int) -> str:
+        self.tokens[address.lower()] = {
+            'symbol': symbol, 'name': f"{symbol} Token", 'decimals': decimals,
+            'supply': 0, 'balances': {}, 'allowances': {}
+        }
+        return address
+    
+    def set_balance(self, token: str, owner: str, amount: int):
+        entry = self.tokens[token.lower()]
+        entry['supply'] += amount - entry['balances'].get(owner.lower(), 0)
+        entry['balances'][owner.lower()] = amount
+    
+    def set_allowance(self, token: str, owner: str, spender: str, amount: int):
+        self.tokens[token.lower()]['allowances'][(owner.lower(), spender.lower())] = amount
+    
+    def add_router(self, router: str, factory: str):
+        self.routers[router.lower()] = Web3.to_checksum_address(factory)
+        self.factories.setdefault(factory.lower(), {'pairs': [], 'lookup': {}})
+    
+    def add_pair(self, factory: str, pair: str, token_a: str, token_b: str, reserve_a: int, reserve_b: int) -> str:
+        token0, token1 = sorted((token_a.lower(), token_b.lower()))
+        reserve0, reserve1 = (reserve_a, reserve_b) if token_a.lower() == token0 else (reserve_b, reserve_a)
+        entry = self.factories[factory.lower()]
+        entry['pairs'].append(Web3.to_checksum_address(pair))
+        entry['lookup'][(token0, token1)] = Web3.to_checksum_address(pair)
+        self.pairs[pair.lower()] = {
+            'token0': Web3.to_checksum_address(token0), 'token1': Web3.to_checksum_address(token1),
+            'reserve0': reserve0, 'reserve1': reserve1, 'factory': Web3.to_checksum_address(factory),
+            'supply': 10 ** 18, 'balances': {}
+        }
+        return pair
+    
+    def set_lp_balance(self, pair: str, owner: str, amount: int):
+        entry = self.pairs[pair.lower()]
+        entry['supply'] += amount - entry['balances'].get(owner.lower(), 0)
+        entry['balances'][owner.lower()] = amount
+
+    # Execution
+    def call(self, to: str, data: bytes, sender: Optional[str] = None) -> bytes:
+        """Execute a read call, raising RPCError on revert"""
+        to = to.lower()
+        selector, args = data[:4], data[4:]
+        
+        if to == MULTICALL3_ADDRESS.lower():
+            if selector == AGGREGATE3_SELECTOR:
+                results = []
+                for target, allow_failure, calldata in abi_decode(['(address,bool,bytes)[]'], args)[0]:
+                    try:
+                        results.append((True, self.call(target, calldata)))
+                    except RPCError:
+                        if not allow_failure:
+                            raise
+                        results.append((False, b''))
+                return abi_encode(['(bool,bytes)[]'], [results])
+            if selector == GET_BLOCK_NUMBER_SELECTOR:
+                return abi_encode(['uint256'], [self.block])
+        
+        if to in self.tokens:
+            token = self.tokens[to]
+            if selector == BALANCE_OF_SELECTOR:
+                owner = abi_decode(['address'], args)[0]
+                return abi_encode(['uint256'], [token['balances'].get(owner.lower(), 0)])
+            if selector == ALLOWANCE_SELECTOR:
+                owner, spender = abi_decode(['address', 'address'], args)
+                return abi_encode(['uint256'], [token['allowances'].get((owner.lower(), spender.lower()), 0)])
+            if selector == DECIMALS_SELECTOR:
+                return abi_encode(['uint8'], [token['decimals']])
+            if selector == SYMBOL_SELECTOR:
+                return abi_encode(['string'], [token['symbol']])
+            if selector == NAME_SELECTOR:
+                return abi_encode(['string'], [token['name']])
+            if selector == TOTAL_SUPPLY_SELECTOR:
+                return abi_encode(['uint256'], [token['supply']])
+        
+        if to in self.routers and selector == FACTORY_SELECTOR:
+            return abi_encode(['address'], [self.routers[to]])
+        if to in self.routers and selector == ADD_LIQUIDITY_SELECTOR:
+            return self.add_liquidity(to, sender, *abi_decode(
+                ['address', 'address', 'uint256', 'uint256', 'uint256', 'uint256', 'address', 'uint256'], args
+            ))
+        
+        if to in self.factories:
+            factory = self.factories[to]
+            if selector == GET_PAIR_SELECTOR:
+                token_a, token_b = abi_decode(['address', 'address'], args)
+                key = tuple(sorted((token_a.lower(), token_b.lower())))
+                return abi_encode(['address'], [factory['lookup'].get(key, '0x' + '00' * 20)])
+            if selector == ALL_PAIRS_LENGTH_SELECTOR:
+                return abi_encode(['uint256'], [len(factory['pairs'])])
+            if selector == ALL_PAIRS_SELECTOR:
+                index = abi_decode(['uint256'], args)[0]
+                if index < len(factory['pairs']):
+                    return abi_encode(['address'], [factory['pairs'][index]])
+        
+        if to in self.pairs:
+            pair = self.pairs[to]
+            if selector == TOKEN0_SELECTOR:
+                return abi_encode(['address'], [pair['token0']])
+            if selector == TOKEN1_SELECTOR:
+                return abi_encode(['address'], [pair['token1']])
+            if selector == GET_RESERVES_SELECTOR:
+                return abi_encode(['uint112', 'uint112', 'uint32'], [pair['reserve0'], pair['reserve1'], 0])
+            if selector == TOTAL_SUPPLY_SELECTOR:
+                return abi_encode(['uint256'], [pair['supply']])
+            if selector == BALANCE_OF_SELECTOR:
+                owner = abi_decode(['address'], args)[0]
+                return abi_encode(['uint256'], [pair['balances'].get(owner.lower(), 0)])
+            if selector == FACTORY_SELECTOR:
+                return abi_encode(['address'], [pair['factory']])
+        
+        if to in self.tokens or to in self.routers or to in self.factories or to in self.pairs:
+            raise RPCError(3, "execution reverted")
+        # No code at the address
+        return b''
+    
+    def add_liquidity(self, router: str, sender: Optional[str], token_a: str, token_b: str, desired_a: int,
+                      desired_b: int, min_a: int, min_b: int, to: str, deadline: int) -> bytes:
+        """Router addLiquidity() result without changing state, reverting like the real router"""
+        factory = self.factories[self.routers[router].lower()]
+        pair = factory['lookup'].get(tuple(sorted((token_a.lower(), token_b.lower()))))
+        if pair is None:
+            raise RPCError(3, "execution reverted: pair not deployed")
+        pair = self.pairs[pair.lower()]
+        
+        flipped = token_a.lower() != pair['token0'].lower()
+        reserve_a, reserve_b = (pair['reserve1'], pair['reserve0']) if flipped else (pair['reserve0'], pair['reserve1'])
+        amount_b = desired_a * reserve_b // reserve_a
+        if amount_b <= desired_b:
+            amount_a = desired_a
+            if amount_b < min_b:
+                raise RPCError(3, "execution reverted: UniswapV2Router: INSUFFICIENT_B_AMOUNT")
+        else:
+            amount_a, amount_b = desired_b * reserve_a // reserve_b, desired_b
+            if amount_a < min_a:
+                raise RPCError(3, "execution reverted: UniswapV2Router: INSUFFICIENT_A_AMOUNT")
+        
+        owner = (sender or '0x' + '00' * 20).lower()
+        for token, amount in ((token_a, amount_a), (token_b, amount_b)):
+            entry = self.tokens[token.lower()]
+            if entry['allowances'].get((owner, router), 0) < amount or entry['balances'].get(owner, 0) < amount:
+                raise RPCError(3, "execution reverted: TransferHelper: TRANSFER_FROM_FAILED")
+        
+        liquidity = min(amount_a * pair['supply'] // reserve_a, amount_b * pair['supply'] // reserve_b)
+        return abi_encode(['uint256', 'uint256', 'uint256'], [amount_a, amount_b, liquidity])
+    
+    def send_raw_transaction(self, raw: str) -> str:
+        """Accept a signed transaction and mine it immediately"""
+        data = bytes.fromhex(raw[2:])
+        # Typed (EIP-2718) transactions carry the nonce second, after chainId
+        fields = rlp.decode(data[1:]) if data[0] < 0x7f else rlp.decode(data)
+        nonce = int.from_bytes(fields[1] if data[0] < 0x7f else fields[0], 'big')
+        sender = Account.recover_transaction(raw)
+        tx_hash = Web3.to_hex(Web3.keccak(data))
+        
+        with self._lock:
+            expected = self.nonces.get(sender, 0)
+            if nonce < expected:
+                raise RPCError(-32000, "nonce too low")
+            self.nonces[sender] = max(expected, nonce + 1)
+            self.receipts[tx_hash] = {
+                'transactionHash': tx_hash,
+                'transactionIndex': '0x0',
+                'blockHash': '0x' + '00' * 32,
+                'blockNumber': hex(self.block),
+                'from': sender,
+                'to': None,
+                'cumulativeGasUsed': hex(150000),
+                'gasUsed': hex(150000),
+                'effectiveGasPrice': hex(10 ** 9),
+                'contractAddress': None,
+                'logs': [],
+                'logsBloom': '0x' + '00' * 256,
+                'status': '0x1',
+                'type': '0x2'
+            }
+        return tx_hash
+    
+    def request(self, method: str, params: List[Any]) -> Any:
+        """Result for one JSON-RPC request, raising RPCError for errors"""
+        if method == 'eth_chainId':
+            return hex(self.chain_id)
+        if method == 'net_version':
+            return str(self.chain_id)
+        if method == 'eth_blockNumber':
+            return hex(self.block)
+        if method == 'eth_call':
+            return '0x' + self.call(params[0]['to'], bytes.fromhex(params[0].get('data', '0x')[2:]),
+                                    params[0].get('from')).hex()
+        if method == 'eth_estimateGas':
+            data = bytes.fromhex(params[0].get('data', '0x')[2:])
+            if data[:4] == ADD_LIQUIDITY_SELECTOR:
+                # Reverts like the node would, so failed deposits get no estimate
+                self.call(params[0]['to'], data, params[0].get('from'))
+            return hex(150000)
+        if method == 'eth_gasPrice':
+            return hex(10 ** 9)
+        if method == 'eth_maxPriorityFeePerGas':
+            return hex(10 ** 8)
+        if method == 'eth_feeHistory':
+            count = int(params[0], 16) if isinstance(params[0], str) else params[0]
+            return {
+                'oldestBlock': hex(self.block - count + 1),
+                'baseFeePerGas': [hex(10 ** 9)] * (count + 1),
+                'gasUsedRatio': [0.5] * count,
+                'reward': [[hex(10 ** 8)] * len(params[2])] * count
+            }
+        if method == 'eth_getTransactionCount':
+            return hex(self.nonces.get(Web3.to_checksum_address(params[0]), 0))
+        if method == 'eth_sendRawTransaction':
+            return self.send_raw_transaction(params[0])
+        if method == 'eth_getTransactionReceipt':
+            return self.receipts.get(params[0])
+        raise RPCError(-32601, f"Method not found: {method}")
+
+
+class StubNode:
+    """HTTP JSON-RPC server for a StubChain on a local port.
+    
+    Every POST (single request or batch) is delayed by `latency` seconds,
+    plus exponential jitter with mean `latency * jitter`. Counts round trips,
+    requests per method and the CPU spent serving them, so that the
+    benchmark can report client CPU separately.
+    """
+    
+    def __init__(self, chain: StubChain, latency: float = 0.0, jitter: float = 0.0, seed: int = 0):
+        self.chain = chain
+        self.latency = latency
+        self.jitter = jitter
+        self.round_trips = 0
+        self.requests = 0
+        self.methods = {}
+        self.cpu = 0.0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+    
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+    
+    def start(self) -> 'StubNode':
+        node = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out in separate writes; don't let Nagle hold the body back
+            disable_nagle_algorithm = True
+            
+            def log_message(self, *args):
+                pass
+            
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                response = node.handle(body)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+        
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+    
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+    
+    def handle(self, body: bytes) -> bytes:
+        """Answer one POST body (single request or batch)"""
+        started = time.thread_time()
+        payload = json.loads(body)
+        requests = payload if isinstance(payload, list) else [payload]
+        
+        responses = []
+        for request in requests:
+            try:
+                result = self.chain.request(request['method'], request.get('params', []))
+                responses.append({'jsonrpc': '2.0', 'id': request.get('id'), 'result': result})
+            except RPCError as e:
+                responses.append({'jsonrpc': '2.0', 'id': request.get('id'), 'error': {'code': e.code, 'message': str(e)}})
+        response = json.dumps(responses if isinstance(payload, list) else responses[0]).encode()
+        
+        with self._lock:
+            self.round_trips += 1
+            self.requests += len(requests)
+            for request in requests:
+                self.methods[request['method']] = self.methods.get(request['method'], 0) + 1
+            self.cpu += time.thread_time() - started
+            delay = self.latency
+            if self.jitter and self.latency:
+                delay += self._random.expovariate(1 / (self.latency * self.jitter))
+        
+        if delay:
+            time.sleep(delay)
+        return response
+    
+    def counters(self) -> tuple:
+        """(round_trips, requests, cpu_seconds) served so far"""
+        with self._lock:
+            return self.round_trips, self.requests, self.cpu
+
+
+def build_chain(token_count: int, wallet_count: int) -> tuple:
+    """Deploy benchmark tokens, wallets and token/WETH pairs on every V2 router.
+    
+    Returns (chain, tokens, wallets); wallets[0] is the signing wallet.
+    Two out of three tokens have a balance, every token has one router
+    allowance and every wallet holds LP tokens in a quarter of the pairs, so
+    positions, approvals and LP positions are never all empty. The signing
+    wallet also holds WETH and has approved the Uniswap V2 router for WETH
+    and every token it holds, so its deposits simulate successfully.
+    """
+    chain = StubChain()
+    weth = chain.add_token(COMMON_TOKENS['WETH'], 'WETH', 18)
+    tokens = [
+        chain.add_token(stub_address(f"token{i}"), f"BT{i}", (6, 8, 18)[i % 3])
+        for i in range(token_count)
+    ]
+    wallets = [Account.from_key(BENCHMARK_KEY).address] + [
+        stub_address(f"wallet{i}") for i in range(1, wallet_count)
+    ]
+    
+    for i, token in enumerate(tokens):
+        unit = 10 ** chain.tokens[token.lower()]['decimals']
+        for j, wallet in enumerate(wallets):
+            if (i + j) % 3:
+                chain.set_balance(token, wallet, (i + 1) * (j + 1) * unit + i)
+            router = list(DEX_CONTRACTS.values())[(i + j) % len(DEX_CONTRACTS)]
+            chain.set_allowance(token, wallet, router, 2 ** 256 - 1 if i % 2 else 1000 * unit)
+        if i % 3:
+            chain.set_allowance(token, wallets[0], DEX_CONTRACTS['uniswap_v2_router'], 2 ** 256 - 1)
+    chain.set_balance(weth, wallets[0], 100 * 10 ** 18)
+    chain.set_allowance(weth, wallets[0], DEX_CONTRACTS['uniswap_v2_router'], 2 ** 256 - 1)
+
+    # Only the default (mainnet) routers; presets for other chains are not deployed here
+    for name in [name for name in V2_ROUTER_FEES if name in DEX_CONTRACTS]:
+        factory = stub_address(f"factory:{name}")
+        chain.add_router(DEX_CONTRACTS[name], factory)
+        for i, token in enumerate(tokens):
+            unit = 10 ** chain.tokens[token.lower()]['decimals']
+            pair = chain.add_pair(factory, stub_address(f"pair:{name}:{i}"), token, weth,
+                                  (1000000 + i) * unit, (500 + len(name)) * 10 ** 18)
+            for j, wallet in enumerate(wallets):
+                if (i + j) % 4 == 0:
+                    chain.set_lp_balance(pair, wallet, (j + 1) * 10 ** 15 + i)
+    
+    return chain, tokens, wallets
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """Nearest-rank percentile of samples (q in 0..100)"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def operation_calls(operation: str, dex: DEXExchange, tokens: List[str], wallets: List[str],
+                    iteration: int) -> List[Any]:
+    """Calls making up one iteration of an operation, each measured on its own"""
+    weth = COMMON_TOKENS['WETH']
+    
+    def as_wallet(wallet, fn):
+        def call():
+            previous = dex.address
+            dex.address = wallet
+            try:
+                fn()
+            finally:
+                dex.address = previous
+        return call
+    
+    if operation == 'fetch_positions':
+        return [as_wallet(wallet, lambda: dex.fetch_positions(tokens)) for wallet in wallets]
+    if operation == 'fetch_balance':
+        return [as_wallet(wallet, lambda: dex.fetch_balance()) for wallet in wallets]
+    if operation == 'fetch_approvals':
+        return [
+            as_wallet(wallet, lambda token=tokens[(iteration + j) % len(tokens)]: dex.fetch_approvals(token))
+            for j, wallet in enumerate(wallets)
+        ]
+    if operation == 'get_liquidity_positions':
+        return [lambda wallet=wallet: dex.get_liquidity_positions(wallet) for wallet in wallets]
+    if operation == 'add_liquidity':
+        held = [token for i, token in enumerate(tokens) if i % 3]
+        return [lambda: dex.add_liquidity(held[iteration % len(held)], weth, 1.5, 0.001)]
+    if operation == 'load_pools':
+        return [lambda: dex.load_pools([(token, weth) for token in tokens])]
+    if operation == 'quote':
+        return [lambda token=token: dex.quote(token, weth, 10 ** 6) for token in tokens]
+    raise ValueError(f"Unknown operation: {operation}")
+
+
+def run_scenario(token_count: int, wallet_count: int, operations: List[str], iterations: int, warmup: int,
+                 latency: float, jitter: float, seed: int) -> Dict[str, Any]:
+    """Benchmark each operation against a fresh stub node and exchange"""
+    chain, tokens, wallets = build_chain(token_count, wallet_count)
+    node = StubNode(chain, latency, jitter, seed).start()
+    
+    try:
+        dex = DEXExchange({
+            'rpcUrl': node.url,
+            'privateKey': BENCHMARK_KEY,
+            'chainId': chain.chain_id,
+            'receiptPollInterval': 0.005,
+            # Keep background fee refreshes out of the measured round trips
+            'feeRefreshInterval': 3600
+        })
+        # fetch_balance() scans common_tokens, so point it at the benchmark tokens
+        dex.common_tokens = {chain.tokens[token.lower()]['symbol']: token for token in tokens}
+        # Pools must exist before quoting; metadata is warmed by the warmup iterations
+        dex.load_pools([(token, COMMON_TOKENS['WETH']) for token in tokens])
+        
+        results = {}
+        for operation in operations:
+            samples = []
+            cpu = []
+            round_trips = 0
+            requests = 0
+            wall = 0.0
+            
+            for iteration in range(warmup + iterations):
+                # Each iteration sees a new head, so per-block caches start cold
+                chain.block += 1
+                for call in operation_calls(operation, dex, tokens, wallets, iteration):
+                    trips_before, requests_before, stub_cpu_before = node.counters()
+                    cpu_before = time.process_time()
+                    started = time.perf_counter()
+                    call()
+                    elapsed = time.perf_counter() - started
+                    cpu_used = time.process_time() - cpu_before
+                    trips_after, requests_after, stub_cpu_after = node.counters()
+                    
+                    if iteration < warmup:
+                        continue
+                    samples.append(elapsed)
+                    # The stub runs in this process; its CPU is not the client's
+                    cpu.append(max(0.0, cpu_used - (stub_cpu_after - stub_cpu_before)))
+                    round_trips += trips_after - trips_before
+                    requests += requests_after - requests_before
+                    wall += elapsed
+            
+            calls = len(samples)
+            results[operation] = {
+                'calls': calls,
+                'round_trips': round_trips / calls,
+                'requests': requests / calls,
+                'wall_s': wall,
+                'p50_ms': percentile(samples, 50) * 1000,
+                'p99_ms': percentile(samples, 99) * 1000,
+                'cpu_ms': sum(cpu) / calls * 1000
+            }
+        return results
+    finally:
+        node.stop()
+
+
+def run(args: Any) -> Dict[str, Any]:
+    """Run every (wallets, tokens) scenario and return the report"""
+    report = {
+        'config': {
+            'latency': args.latency,
+            'jitter': args.jitter,
+            'iterations': args.iterations,
+            'warmup': args.warmup
+        },
+        'scenarios': {}
+    }
+    
+    for wallet_count in args.wallets:
+        for token_count in args.tokens:
+            name = f"{wallet_count}w-{token_count}t"
+            report['scenarios'][name] = run_scenario(
+                token_count, wallet_count, args.operations, args.iterations, args.warmup,
+                args.latency, args.jitter, args.seed
+            )
+    
+    return report
+
+
+def run_startup(count: int) -> Dict[str, Any]:
+    """Import time, then construction time, first-use time and memory per DEXExchange instance"""
+    # Import in fresh interpreters; the fastest run is the least disturbed one
+    command = [sys.executable, '-c', 'import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)']
+    import_s = min(float(subprocess.check_output(command, text=True)) for _ in range(3))
+    
+    rpc_url = 'http://127.0.0.1:8545'  # never contacted: building the provider does not connect
+    cases = {
+        'plain': lambda: {'rpcUrl': rpc_url},
+        'privateKey': lambda: {'rpcUrl': rpc_url, 'privateKey': BENCHMARK_KEY},
+        'providerPool': lambda pool=ProviderPool(): {'rpcUrl': rpc_url, 'privateKey': BENCHMARK_KEY,
+                                                     'providerPool': pool}
+    }
+    
+    results = {}
+    for name, config in cases.items():
+        DEXExchange(config())  # warm up lazy imports and shared caches
+        
+        start = time.perf_counter()
+        instances = [DEXExchange(config()) for _ in range(count)]
+        construct_s = time.perf_counter() - start
+        start = time.perf_counter()
+        for dex in instances:
+            dex.w3, dex.address
+        first_use_s = time.perf_counter() - start
+        del instances
+        
+        # Memory in a second pass, as tracing slows allocation down
+        tracemalloc.start()
+        instances = [DEXExchange(config()) for _ in range(count)]
+        constructed_bytes = tracemalloc.get_traced_memory()[0]
+        for dex in instances:
+            dex.w3, dex.address
+        used_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        
+        results[name] = {
+            'instances': count,
+            'construct_ms': construct_s * 1000 / count,
+            'first_use_ms': first_use_s * 1000 / count,
+            'construct_kb': constructed_bytes / 1024 / count,
+            'in_use_kb': used_bytes / 1024 / count
+        }
+        del instances
+    
+    return {'import_s': import_s, 'cases': results}
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Regressions of `report` against `baseline`, as readable lines"""
+    regressions = []
+    
+    for scenario, operations in baseline.get('scenarios', {}).items():
+        for operation, expected in operations.items():
+            actual = report['scenarios'].get(scenario, {}).get(operation)
+            if actual is None:
+                continue
+            for metric, noise in BASELINE_METRICS.items():
+                limit = expected[metric] + noise
+                if metric != 'round_trips':
+                    limit = max(limit, expected[metric] * (1 + tolerance))
+                if actual[metric] > limit:
+                    regressions.append(
+                        f"{scenario} {operation} {metric}: {actual[metric]:.2f} > {limit:.2f} "
+                        f"(baseline {expected[metric]:.2f})"
+                    )
+    
+    return regressions
+
+
+def print_report(report: Dict[str, Any]):
+    config = report['config']
+    print(f"latency {config['latency'] * 1000:.1f} ms, jitter {config['jitter']}, "
+          f"{config['iterations']} iterations after {config['warmup']} warmup")
+    print(f"{'scenario':<12} {'operation':<24} {'calls':>6} {'rt/call':>8} {'req/call':>9} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'wall s':>8} {'cpu ms':>8}")
+    for scenario, operations in report['scenarios'].items():
+        for operation, result in operations.items():
+            print(f"{scenario:<12} {operation:<24} {result['calls']:>6} {result['round_trips']:>8.2f} "
+                  f"{result['requests']:>9.2f} {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+                  f"{result['wall_s']:>8.3f} {result['cpu_ms']:>8.2f}")
+
+
+def print_startup_report(report: Dict[str, Any]):
+    print(f"import app: {report['import_s'] * 1000:.0f} ms")
+    print(f"{'case':<14} {'instances':>9} {'construct ms':>13} {'first use ms':>13} {'KB built':>9} {'KB in use':>10}")
+    for name, result in report['cases'].items():
+        print(f"{name:<14} {result['instances']:>9} {result['construct_ms']:>13.3f} {result['first_use_ms']:>13.3f} "
+              f"{result['construct_kb']:>9.1f} {result['in_use_kb']:>10.1f}")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> Any:
+    def counts(value):
+        return [int(count) for count in value.split(',')]
+    
+    def operations(value):
+        names = value.split(',')
+        for name in names:
+            if name not in OPERATIONS:
+                raise argparse.ArgumentTypeError(f"unknown operation {name} (choose from {', '.join(OPERATIONS)})")
+        return names
+    
+    parser = argparse.ArgumentParser(description="Benchmark DEXExchange against a local JSON-RPC stub node")
+    parser.add_argument('--wallets', type=counts, default=[1, 10], help="Comma-separated wallet counts")
+    parser.add_argument('--tokens', type=counts, default=[10, 100], help="Comma-separated token counts")
+    parser.add_argument('--operations', type=operations, default=list(OPERATIONS),
+                        help="Comma-separated operations (default: all)")
+    parser.add_argument('--iterations', type=int, default=5, help="Measured iterations per operation")
+    parser.add_argument('--warmup', type=int, default=1, help="Unmeasured iterations first (fill caches)")
+    parser.add_argument('--latency', type=float, default=0.005, help="Injected seconds per round trip")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Mean extra latency as a fraction of --latency")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the latency jitter")
+    parser.add_argument('--json', help="Also write the report to this file")
+    parser.add_argument('--save-baseline', help="Write the report as a baseline file")
+    parser.add_argument('--baseline', help="Compare against a baseline file, exit 1 on regression")
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help="Allowed relative increase in p50 and CPU vs the baseline")
+    parser.add_argument('--startup', type=int, metavar='N',
+                        help="Measure import time and the cost of N instances instead of the RPC scenarios")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    if args.startup:
+        report = run_startup(args.startup)
+        print_startup_report(report)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+        return
+    
+    report = run(args)
+    print_report(report)
+    
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+    
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print("\nRegressions against " + args.baseline + ":", file=sys.stderr)
+            for line in regressions:
+                print("  " + line, file=sys.stderr)
+            sys.exit(1)
+        print("\nNo regressions against " + args.baseline)
+
+
+if __name__ == "__main__":
+    main()
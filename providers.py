@@ -0,0 +1,297 @@
+"""Web3 provider classes used by app.DEXExchange.
+
+They subclass web3's providers, and importing those loads all of web3, so
+they live here and app.py imports this module the first time it builds a
+provider.
+"""
+import json
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Any
+
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.providers.base import BaseProvider
+from web3.providers.rpc import HTTPProvider
+from web3._utils.request import make_post_request
+
+from app import AGGREGATE3_SELECTOR, RPCEndpoint, RPCMetrics, is_rate_limited
+
+
+class BatchHTTPProvider(HTTPProvider):
+    """HTTPProvider that can send JSON-RPC 2.0 batch arrays in one POST.
+    
+    `make_batch_request` sends a list of requests at once and routes the
+    responses back by id. With a `batch_window` (seconds), single requests
+    issued from several threads within the window are coalesced as well.
+    """
+    
+    def __init__(self, endpoint_uri: Optional[str] = None, batch_size: int = 100,
+                 batch_window: float = 0.0, request_kwargs: Optional[Any] = None, session: Optional[Any] = None):
+        super().__init__(endpoint_uri, request_kwargs, session)
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self._pending = []
+        self._pending_lock = threading.Condition()
+        self._flushing = False
+    
+    def make_batch_request(self, requests: List[tuple]) -> List[Dict[str, Any]]:
+        """Send (method, params) requests as batch arrays of up to batch_size.
+        
+        Returns one JSON-RPC response dict per request, in request order.
+        """
+        responses = []
+        
+        for start in range(0, len(requests), self.batch_size):
+            chunk = requests[start:start + self.batch_size]
+            payload = [
+                {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': next(self.request_counter)}
+                for method, params in chunk
+            ]
+            raw_response = make_post_request(
+                self.endpoint_uri, Web3.to_json(payload).encode(), **self.get_request_kwargs()
+            )
+            decoded = json.loads(raw_response)
+            
+            if isinstance(decoded, dict):
+                # Node rejected the whole batch
+                responses.extend({'jsonrpc': '2.0', 'id': item['id'], 'error': decoded.get('error', decoded)}
+                                 for item in payload)
+                continue
+            
+            by_id = {item.get('id'): item for item in decoded}
+            for item in payload:
+                responses.append(by_id.get(item['id']) or {
+                    'jsonrpc': '2.0', 'id': item['id'],
+                    'error': {'code': -32603, 'message': 'Missing response in batch'}
+                })
+        
+        return responses
+    
+    def make_request(self, method: str, params: Any) -> Dict[str, Any]:
+        if self.batch_window <= 0:
+            return super().make_request(method, params)
+        
+        # Coalesce requests from concurrent threads into one batch
+        entry = {'request': (method, params), 'event': threading.Event(), 'response': None}
+        with self._pending_lock:
+            self._pending.append(entry)
+            leader = not self._flushing
+            if leader:
+                self._flushing = True
+            elif len(self._pending) >= self.batch_size:
+                self._pending_lock.notify()
+        
+        if leader:
+            with self._pending_lock:
+                self._pending_lock.wait_for(lambda: len(self._pending) >= self.batch_size, self.batch_window)
+                batch, self._pending = self._pending, []
+                self._flushing = False
+            try:
+                responses = self.make_batch_request([item['request'] for item in batch])
+            except Exception as e:
+                responses = [{'jsonrpc': '2.0', 'id': 0, 'error': {'code': -32603, 'message': str(e)}}] * len(batch)
+            for item, response in zip(batch, responses):
+                item['response'] = response
+                item['event'].set()
+        
+        entry['event'].wait()
+        return entry['response']
+
+
+class RPCPool(BaseProvider):
+    """Provider that routes requests over several RPC endpoints.
+    
+    Reads go to the fastest healthy endpoint and are hedged: if no answer
+    arrives within that endpoint's p95 latency (`hedge_after` until enough
+    samples exist), the same request is sent to the next endpoint and the
+    first good response wins. Failed or rate-limited reads fail over to the
+    next endpoint. Writes and filter calls (stateful on the node) are not
+    hedged; writes only fail over on transport errors.
+    """
+    
+    STICKY_METHODS = ('eth_newFilter', 'eth_newBlockFilter', 'eth_getFilterChanges', 'eth_uninstallFilter')
+    WRITE_METHODS = ('eth_sendRawTransaction', 'eth_sendTransaction')
+    
+    def __init__(self, endpoints: List[RPCEndpoint], hedge_after: float = 0.5, max_workers: Optional[int] = None):
+        self.endpoints = endpoints
+        self.hedge_after = hedge_after
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or 8 * len(endpoints))
+        super().__init__()
+    
+    @property
+    def endpoint_uri(self) -> str:
+        return self.endpoints[0].url
+    
+    def ranked(self) -> List[RPCEndpoint]:
+        """Endpoints by preference: healthy ones by score, then ejected ones by earliest return"""
+        healthy = sorted((endpoint for endpoint in self.endpoints if endpoint.healthy), key=lambda endpoint: endpoint.score())
+        ejected = sorted((endpoint for endpoint in self.endpoints if not endpoint.healthy), key=lambda endpoint: endpoint.ejected_until)
+        return healthy + ejected
+    
+    def make_request(self, method: str, params: Any) -> Dict[str, Any]:
+        if method in self.STICKY_METHODS:
+            # Filters live on one node: always use the first configured endpoint
+            return self.endpoints[0].provider.make_request(method, params)
+        return self._route(lambda provider: provider.make_request(method, params), 1, method not in self.WRITE_METHODS)
+    
+    def make_batch_request(self, requests: List[tuple]) -> List[Dict[str, Any]]:
+        """Send a batch to one endpoint, hedged like a single read unless it contains writes"""
+        methods = set(method for method, _ in requests)
+        if methods & set(self.STICKY_METHODS):
+            return self.endpoints[0].provider.make_batch_request(requests)
+        read = not methods & set(self.WRITE_METHODS)
+        return self._route(lambda provider: provider.make_batch_request(requests), len(requests), read)
+    
+    def is_connected(self, show_traceback: bool = False) -> bool:
+        return any(endpoint.provider.is_connected(show_traceback) for endpoint in self.endpoints)
+    
+    def close(self):
+        """Shut down the hedging thread pool"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+    
+    def stats(self) -> List[Dict[str, Any]]:
+        """Per-endpoint latency, error and health statistics"""
+        return [endpoint.stats() for endpoint in self.endpoints]
+    
+    def _route(self, send: Any, cost: int, read: bool) -> Any:
+        candidates = self.ranked()
+        if not read or len(candidates) == 1:
+            error = None
+            for endpoint in candidates:
+                try:
+                    response, retry = self._call(endpoint, send, cost)
+                except Exception as e:
+                    error = e
+                    continue
+                if not (retry and read):
+                    return response
+                error = response
+            if isinstance(error, Exception):
+                raise error
+            return error
+        
+        # Hedged read: start on the best endpoint, add the next one on timeout or failure
+        pending = {}
+        remaining = list(candidates)
+        last = None
+        
+        def launch():
+            endpoint = remaining.pop(0)
+            pending[self._executor.submit(self._call, endpoint, send, cost)] = endpoint
+            return endpoint
+        
+        first = launch()
+        deadline = first.p95() or self.hedge_after
+        while pending:
+            done, _ = wait(list(pending), timeout=deadline, return_when=FIRST_COMPLETED)
+            if not done:
+                if remaining:
+                    launch()
+                deadline = None
+                continue
+            for future in done:
+                pending.pop(future)
+                try:
+                    response, retry = future.result()
+                except Exception as e:
+                    last = e
+                else:
+                    if not retry:
+                        return response
+                    last = response
+                if remaining and len(pending) == 0:
+                    launch()
+        
+        if isinstance(last, Exception):
+            raise last
+        return last
+    
+    def _call(self, endpoint: RPCEndpoint, send: Any, cost: int) -> tuple:
+        """Send through one endpoint, returning (response, retry_elsewhere)"""
+        delay = endpoint.acquire(cost)
+        while delay:
+            time.sleep(delay)
+            delay = endpoint.acquire(cost)
+        
+        started = time.monotonic()
+        try:
+            response = send(endpoint.provider)
+        except Exception:
+            endpoint.record(None, error=True)
+            raise
+        
+        responses = response if isinstance(response, list) else [response]
+        limited = any(self._is_rate_limited(item.get('error')) for item in responses if isinstance(item, dict))
+        endpoint.record(time.monotonic() - started, error=limited)
+        return response, limited
+    
+    def _is_rate_limited(self, error: Any) -> bool:
+        """Whether a JSON-RPC error means this endpoint is throttling us"""
+        return is_rate_limited(error)
+
+
+class InstrumentedProvider(BaseProvider):
+    """Provider wrapper that records every request into an RPCMetrics.
+    
+    Wraps any provider (BatchHTTPProvider, RPCPool, ...) and forwards
+    single and batch requests unchanged. Other attributes (stats(),
+    batch_size, ...) are looked up on the wrapped provider.
+    """
+    
+    def __init__(self, provider: Any, metrics: RPCMetrics):
+        self.provider = provider
+        self.metrics = metrics
+        super().__init__()
+    
+    def __getattr__(self, name: str) -> Any:
+        # Only reached for attributes this wrapper does not define
+        provider = self.__dict__.get('provider')
+        if provider is None:
+            raise AttributeError(name)
+        return getattr(provider, name)
+    
+    @property
+    def endpoint_uri(self) -> Any:
+        return getattr(self.provider, 'endpoint_uri', None)
+    
+    def make_request(self, method: str, params: Any) -> Dict[str, Any]:
+        return self._send([(method, params)], lambda: [self.provider.make_request(method, params)])[0]
+    
+    def make_batch_request(self, requests: List[tuple]) -> List[Dict[str, Any]]:
+        if not hasattr(self.provider, 'make_batch_request'):
+            return [self.make_request(method, params) for method, params in requests]
+        return self._send(requests, lambda: self.provider.make_batch_request(requests))
+    
+    def is_connected(self, show_traceback: bool = False) -> bool:
+        return self.provider.is_connected(show_traceback)
+    
+    def _send(self, requests: List[tuple], send: Any) -> List[Dict[str, Any]]:
+        request_bytes = len(Web3.to_json([{'method': method, 'params': params} for method, params in requests]))
+        started = time.monotonic()
+        try:
+            responses = send()
+        except Exception as e:
+            self.metrics.record_round_trip(requests, None, time.monotonic() - started, request_bytes,
+                                           error=type(e).__name__)
+            raise
+        latency = time.monotonic() - started
+        
+        self.metrics.record_round_trip(requests, responses, latency, request_bytes,
+                                       len(Web3.to_json(responses)))
+        
+        # Contract calls made directly (aggregate3 counts its inner calls itself)
+        calls = []
+        successes = []
+        for (method, params), response in zip(requests, responses):
+            if method in ('eth_call', 'eth_estimateGas') and params and isinstance(params[0], dict):
+                data = params[0].get('data') or params[0].get('input')
+                selector = data[:10] if isinstance(data, str) else data[:4] if data else None
+                if selector and HexBytes(selector) != AGGREGATE3_SELECTOR:
+                    calls.append(selector)
+                    successes.append(isinstance(response, dict) and not response.get('error')
+                                     and response.get('result') not in (None, '0x'))
+        if calls:
+            self.metrics.record_calls(calls, successes)
+        return responses
@@ -0,0 +1,336 @@
+"""Sharded wallet scanner.
+
+Reads addresses from a file (or stdin with "-"), splits them into chunks and
+scans the chunks in worker processes, each with its own DEXExchange and
+batched reader. Rows are streamed to JSONL or Parquet with checkpoint/resume.
+
+    python scanner.py addresses.txt -o balances.jsonl --rpc-url https://... --workers 8
+    python scanner.py addresses.txt -o balances --format parquet --approvals --resume
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, List, Optional, Any
+
+from app import (
+    COMMON_TOKENS,
+    DEX_CONTRACTS,
+    Amount,
+    DEXExchange,
+    RPCPool,
+    checksum,
+    decode_uint,
+    encode_balance_of,
+)
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional, only used for --format parquet
+    pa = None
+    pq = None
+
+# Per-process state, set up by init_worker
+_worker = {}
+
+
+def read_addresses(path: str) -> List[str]:
+    """Read one address per line, skipping blank lines and # comments"""
+    handle = sys.stdin if path == '-' else open(path)
+    try:
+        return [line.strip() for line in handle if line.strip() and not line.lstrip().startswith('#')]
+    finally:
+        if handle is not sys.stdin:
+            handle.close()
+
+
+def init_worker(config: Dict[str, Any], semaphores: Dict[str, Any]):
+    """Create this process's DEXExchange and apply per-endpoint concurrency caps"""
+    dex = DEXExchange(config)
+    provider = dex.w3.provider
+    providers = [endpoint.provider for endpoint in provider.endpoints] if isinstance(provider, RPCPool) else [provider]
+    for endpoint_provider in providers:
+        semaphore = semaphores.get(endpoint_provider.endpoint_uri)
+        if semaphore is not None:
+            limit_provider(endpoint_provider, semaphore)
+    _worker['dex'] = dex
+
+
+def limit_provider(provider: Any, semaphore: Any):
+    """Hold `semaphore` (shared by all workers) around every request to this endpoint"""
+    for name in ('make_request', 'make_batch_request'):
+        send = getattr(provider, name)
+        
+        def capped(*args, _send=send):
+            with semaphore:
+                return _send(*args)
+        
+        setattr(provider, name, capped)
+
+
+def scan_chunk(chunk_id: int, addresses: List[str], tokens: List[str], spenders: List[str],
+               include_zero: bool = False) -> Dict[str, Any]:
+    """Scan balances (and approvals) of one chunk of addresses at one pinned block"""
+    dex = _worker['dex']
+    rows = []
+    errors = 0
+    
+    owners = []
+    for address in addresses:
+        try:
+            owners.append(checksum(address))
+        except ValueError:
+            errors += 1
+    
+    with dex.at_block() as block:
+        metadata = dex.get_tokens_metadata(tokens)
+        targets = [checksum(token) for token in tokens]
+        calls = [(target, encode_balance_of(owner)) for owner in owners for target in targets]
+        results = dex.multicall(calls)
+        
+        i = 0
+        for owner in owners:
+            for token in tokens:
+                ok, raw = results[i]
+                i += 1
+                token_metadata = metadata[token]
+                if not ok or len(raw) < 32 or isinstance(token_metadata, Exception):
+                    errors += 1
+                    continue
+                balance = decode_uint(raw)
+                if balance == 0 and not include_zero:
+                    continue
+                rows.append({
+                    'kind': 'balance', 'address': owner, 'token': token, 'symbol': token_metadata['symbol'],
+                    'spender': None, 'raw': str(balance), 'amount': str(Amount(balance, token_metadata['decimals'])),
+                    'block': block
+                })
+        
+        if spenders and owners:
+            matrix = dex.fetch_approval_matrix(tokens, spenders, owners, {'nonzero': not include_zero})
+            for j in range(len(matrix['owner'])):
+                if not matrix['ok'][j]:
+                    errors += 1
+                    continue
+                rows.append({
+                    'kind': 'approval', 'address': matrix['owner'][j], 'token': matrix['token'][j],
+                    'symbol': matrix['symbol'][j], 'spender': matrix['spender'][j],
+                    'raw': str(matrix['raw_allowance'][j]), 'amount': str(matrix['allowance'][j]), 'block': block
+                })
+    
+    return {'chunk': chunk_id, 'rows': rows, 'addresses': len(addresses), 'errors': errors}
+
+
+class JSONLSink:
+    """Appends rows to one JSONL file; the checkpoint stores the file size after each chunk"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.handle = open(path, 'a')
+    
+    def truncate(self, offset: int):
+        """Drop rows written after the last checkpoint (a chunk interrupted mid-write)"""
+        self.handle.close()
+        # a+ creates the file if it was deleted while the checkpoint survived
+        with open(self.path, 'a+') as handle:
+            size = handle.seek(0, os.SEEK_END)
+            if size > offset:
+                handle.truncate(offset)
+            elif size < offset:
+                print(f"Output {self.path} is shorter than its checkpoint; rows of completed chunks are missing",
+                      file=sys.stderr)
+        self.handle = open(self.path, 'a')
+    
+    def write(self, chunk_id: int, rows: List[Dict[str, Any]]) -> int:
+        for row in rows:
+            self.handle.write(json.dumps(row) + '\n')
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        return self.handle.tell()
+    
+    def close(self):
+        self.handle.close()
+
+
+class ParquetSink:
+    """Writes each chunk to its own part file in a directory (renamed into place when complete)"""
+    
+    def __init__(self, path: str):
+        if pa is None:
+            raise ImportError("pyarrow is required for --format parquet")
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.schema = pa.schema([
+            ('kind', pa.string()), ('address', pa.string()), ('token', pa.string()), ('symbol', pa.string()),
+            ('spender', pa.string()), ('raw', pa.string()), ('amount', pa.string()), ('block', pa.int64())
+        ])
+    
+    def truncate(self, offset: int):
+        pass
+    
+    def write(self, chunk_id: int, rows: List[Dict[str, Any]]) -> int:
+        table = pa.Table.from_pylist(rows, schema=self.schema)
+        final = os.path.join(self.path, f"part-{chunk_id:06d}.parquet")
+        pq.write_table(table, final + '.tmp')
+        os.replace(final + '.tmp', final)
+        return 0
+    
+    def close(self):
+        pass
+
+
+def load_checkpoint(path: str, chunk_size: int) -> tuple:
+    """Completed chunk ids and the last output offset from a checkpoint file"""
+    done = set()
+    offset = 0
+    if not os.path.exists(path):
+        return done, offset
+    
+    with open(path) as handle:
+        for line in handle:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Partially written last line
+                continue
+            if 'chunk_size' in entry and entry['chunk_size'] != chunk_size:
+                raise ValueError(f"Checkpoint was written with --chunk-size {entry['chunk_size']}")
+            if 'chunk' in entry:
+                done.add(entry['chunk'])
+                offset = max(offset, entry.get('offset', 0))
+    return done, offset
+
+
+def run(args: Any) -> Dict[str, Any]:
+    """Scan all addresses and stream rows to the output; returns final counters"""
+    addresses = read_addresses(args.input)
+    chunks = [addresses[start:start + args.chunk_size] for start in range(0, len(addresses), args.chunk_size)]
+    
+    checkpoint_path = args.checkpoint or args.output + '.checkpoint'
+    done, offset = load_checkpoint(checkpoint_path, args.chunk_size) if args.resume else (set(), 0)
+    if not args.resume:
+        if os.path.isdir(args.output):
+            for name in os.listdir(args.output):
+                if name.startswith('part-'):
+                    os.remove(os.path.join(args.output, name))
+        for path in (checkpoint_path, args.output):
+            if os.path.isfile(path):
+                os.remove(path)
+    
+    sink = ParquetSink(args.output) if args.format == 'parquet' else JSONLSink(args.output)
+    if args.resume:
+        sink.truncate(offset)
+    checkpoint = open(checkpoint_path, 'a')
+    if not done:
+        checkpoint.write(json.dumps({'chunk_size': args.chunk_size, 'addresses': len(addresses)}) + '\n')
+    
+    rpc_urls = args.rpc_url or [os.getenv('RPC_URL', 'https://mainnet.infura.io/v3/YOUR_INFURA_KEY')]
+    config = {
+        'rpcUrl': rpc_urls if len(rpc_urls) > 1 else rpc_urls[0],
+        'multicallChunkSize': args.multicall_chunk_size,
+        'tokenCachePath': args.token_cache
+    }
+    context = multiprocessing.get_context()
+    semaphores = {url: context.BoundedSemaphore(args.max_concurrency) for url in rpc_urls} if args.max_concurrency else {}
+    
+    tokens = args.tokens.split(',') if args.tokens else list(COMMON_TOKENS.values())
+    spenders = (args.spenders.split(',') if args.spenders else list(DEX_CONTRACTS.values())) if args.approvals else []
+    
+    stats = {'addresses': sum(len(chunk) for i, chunk in enumerate(chunks) if i in done), 'total': len(addresses),
+             'rows': 0, 'errors': 0, 'failed_chunks': 0}
+    started = time.monotonic()
+    last_report = 0.0
+    attempts = {}
+    
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context,
+                             initializer=init_worker, initargs=(config, semaphores)) as executor:
+        queue = [i for i in range(len(chunks)) if i not in done]
+        pending = {}
+        
+        def submit(chunk_id):
+            attempts[chunk_id] = attempts.get(chunk_id, 0) + 1
+            future = executor.submit(scan_chunk, chunk_id, chunks[chunk_id], tokens, spenders, args.include_zero)
+            pending[future] = chunk_id
+        
+        # Keep a bounded number of chunks in flight so results stream out as they finish
+        while queue or pending:
+            while queue and len(pending) < args.workers * 2:
+                submit(queue.pop(0))
+            
+            finished, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in finished:
+                chunk_id = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if attempts[chunk_id] <= args.retries:
+                        queue.append(chunk_id)
+                    else:
+                        stats['failed_chunks'] += 1
+                        print(f"Chunk {chunk_id} failed: {e}", file=sys.stderr)
+                    continue
+                
+                # Rows first, then the checkpoint, so a crash never skips a chunk
+                offset = sink.write(chunk_id, result['rows'])
+                checkpoint.write(json.dumps({'chunk': chunk_id, 'offset': offset}) + '\n')
+                checkpoint.flush()
+                stats['addresses'] += result['addresses']
+                stats['rows'] += len(result['rows'])
+                stats['errors'] += result['errors']
+            
+            now = time.monotonic()
+            if now - last_report >= args.progress_interval:
+                last_report = now
+                print_progress(stats, now - started)
+    
+    checkpoint.close()
+    sink.close()
+    print_progress(stats, time.monotonic() - started)
+    return stats
+
+
+def print_progress(stats: Dict[str, Any], elapsed: float):
+    """Print throughput and error counters to stderr"""
+    rate = stats['addresses'] / elapsed if elapsed > 0 else 0.0
+    print(
+        f"[{elapsed:7.1f}s] {stats['addresses']}/{stats['total']} addresses, {rate:.1f} addr/s, "
+        f"{stats['rows']} rows, {stats['errors']} errors, {stats['failed_chunks']} failed chunks",
+        file=sys.stderr
+    )
+
+
+def parse_args(argv: Optional[List[str]] = None) -> Any:
+    parser = argparse.ArgumentParser(description="Scan wallet balances and approvals across worker processes")
+    parser.add_argument('input', help="File with one address per line, or - for stdin")
+    parser.add_argument('-o', '--output', required=True, help="JSONL file, or a directory for --format parquet")
+    parser.add_argument('--format', choices=['jsonl', 'parquet'], default='jsonl')
+    parser.add_argument('--rpc-url', action='append', help="RPC endpoint (repeat for a pool; default $RPC_URL)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help="Worker processes")
+    parser.add_argument('--chunk-size', type=int, default=500, help="Addresses per chunk")
+    parser.add_argument('--multicall-chunk-size', type=int, default=500, help="Calls per aggregate3 batch")
+    parser.add_argument('--max-concurrency', type=int, default=0,
+                        help="In-flight requests per endpoint across all workers (0 for no cap)")
+    parser.add_argument('--tokens', help="Comma-separated token addresses (default: common tokens)")
+    parser.add_argument('--approvals', action='store_true', help="Also scan allowances")
+    parser.add_argument('--spenders', help="Comma-separated spender addresses (default: DEX routers)")
+    parser.add_argument('--include-zero', action='store_true', help="Also write zero balances and allowances")
+    parser.add_argument('--token-cache', help="SQLite file for token metadata shared by workers")
+    parser.add_argument('--checkpoint', help="Checkpoint file (default: <output>.checkpoint)")
+    parser.add_argument('--resume', action='store_true', help="Skip chunks already in the checkpoint")
+    parser.add_argument('--retries', type=int, default=2, help="Retries per failed chunk")
+    parser.add_argument('--progress-interval', type=float, default=5.0, help="Seconds between progress lines")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    stats = run(parse_args(argv))
+    sys.exit(1 if stats['failed_chunks'] else 0)
+
+
+if __name__ == "__main__":
+    main()